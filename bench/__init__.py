@@ -0,0 +1,7 @@
+""" Benchmarks for the broker and streaming pieces
+
+Each module is runnable with `python -m bench.<module>` and writes its results as JSON such that
+runs can be compared.
+
+@author lestarch
+"""
@@ -0,0 +1,162 @@
+""" Broker worker scaling benchmark
+
+Runs the broker under gunicorn with an increasing number of worker processes sharing the SQLite
+session store, and drives each with the same signaling load: offers, answers, ICE candidates and
+polls as made by the `gst` Messenger and the browser clients. Reports requests per second for each
+worker count such that throughput scaling with cores can be checked.
+
+Example:
+    python -m bench.broker --workers 1 2 4 --clients 64 --duration 10
+
+@author lestarch
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from bench import clients
+
+
+def negotiate(session: requests.Session, host: str, name: str) -> int:
+    """ Run one complete signaling exchange between a simulated offerer and answerer
+
+    Args:
+        session: HTTP session used for the requests
+        host: broker URL
+        name: unique name of this exchange used to derive client ids and label
+
+    Returns:
+        number of requests made
+    """
+    requests_made = 0
+
+    def call(_, method, path, **kwargs):
+        """ Make a request, counting it """
+        nonlocal requests_made
+        requests_made += 1
+        response = session.request(method, f"{host}{path}", timeout=10, **kwargs)
+        response.raise_for_status()
+        return response
+    clients.negotiate(call, name)
+    return requests_made
+
+
+def load_process(host: str, threads: int, duration: float, process_index: int) -> dict:
+    """ Drive negotiations from several threads for the given duration
+
+    Returns:
+        dictionary of request count, error count and per-negotiation latencies
+    """
+    results = {"requests": 0, "errors": 0, "latencies": []}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(thread_index):
+        session = requests.Session()
+        count = 0
+        while time.monotonic() < deadline:
+            name = f"bench-{process_index}-{thread_index}-{count}"
+            count += 1
+            start = time.monotonic()
+            try:
+                made = negotiate(session, host, name)
+            except requests.exceptions.RequestException:
+                with lock:
+                    results["errors"] += 1
+                continue
+            with lock:
+                results["requests"] += made
+                results["latencies"].append(time.monotonic() - start)
+
+    pool = [threading.Thread(target=worker, args=(index, )) for index in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return results
+
+
+def start_broker(workers: int, port: int, store: str, store_path: Path) -> subprocess.Popen:
+    """ Start gunicorn serving the broker and wait until it responds """
+    environment = dict(os.environ, FLASK_STORE=store, FLASK_STORE_PATH=str(store_path))
+    process = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "--workers", str(workers), "--worker-class", "gthread",
+        "--threads", "16", "--bind", f"127.0.0.1:{port}", "--log-level", "warning",
+        "server.app:create_app()"
+    ], env=environment, cwd=Path(__file__).parent.parent)
+    if clients.wait_for_broker(f"http://127.0.0.1:{port}"):
+        return process
+    process.terminate()
+    raise RuntimeError(f"Broker failed to start with {workers} workers")
+
+
+def run(workers: int, args) -> dict:
+    """ Benchmark the broker with the given number of workers """
+    with tempfile.TemporaryDirectory() as directory:
+        broker = start_broker(workers, args.port, args.store, Path(directory) / "broker.sqlite3")
+        try:
+            host = f"http://127.0.0.1:{args.port}"
+            threads = max(1, args.clients // args.processes)
+            with multiprocessing.Pool(args.processes) as pool:
+                outcomes = pool.starmap(load_process, [
+                    (host, threads, args.duration, index) for index in range(args.processes)
+                ])
+        finally:
+            broker.terminate()
+            broker.wait()
+    latencies = sorted(latency for outcome in outcomes for latency in outcome["latencies"])
+    total = sum(outcome["requests"] for outcome in outcomes)
+    return {
+        "workers": workers,
+        "store": args.store,
+        "clients": threads * args.processes,
+        "duration": args.duration,
+        "requests": total,
+        "errors": sum(outcome["errors"] for outcome in outcomes),
+        "requests_per_second": total / args.duration,
+        "negotiations_per_second": len(latencies) / args.duration,
+        "negotiation_p50": statistics.median(latencies) if latencies else None,
+        "negotiation_p99": latencies[int(len(latencies) * 0.99)] if latencies else None,
+    }
+
+
+def main():
+    """ Run the benchmark for each worker count and record the results """
+    parser = argparse.ArgumentParser(description="Benchmark broker throughput against worker count")
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker counts to benchmark")
+    parser.add_argument("-c", "--clients", type=int, default=64,
+                        help="Concurrent simulated negotiations")
+    parser.add_argument("-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="Load generating processes")
+    parser.add_argument("-d", "--duration", type=float, default=10.0,
+                        help="Seconds to run each worker count")
+    parser.add_argument("--store", choices=["sqlite", "memory"], default="sqlite",
+                        help="Broker session store (memory is only valid with one worker)")
+    parser.add_argument("--port", type=int, default=5099, help="Port to run the broker on")
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_broker.json"),
+                        help="File to write JSON results to")
+    args = parser.parse_args()
+
+    results = []
+    for workers in args.workers:
+        result = run(workers, args)
+        results.append(result)
+        print(f"workers={workers:3d} req/s={result['requests_per_second']:9.1f} "
+              f"negotiations/s={result['negotiations_per_second']:8.1f} "
+              f"errors={result['errors']}")
+    args.output.write_text(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+""" Capture path benchmark: raw video fed to the encoder with and without conversion
+
+Runs the encoding pipeline of setup_pipeline, without sessions, behind several sources in turn:
+
+    test-converted: the test source captured as YUY2 and converted, as before ENCODER_FORMATS
+    test:           the test source as setup_pipeline builds it, feeding the encoder directly
+    device-yuy2:    a fake device offering only YUY2, converted as such devices still are
+    device-nv12:    a fake device offering NV12, feeding the encoder directly
+
+Fake devices replay raw frames, written once to files, at the pace of the clock. Each run reports
+the CPU used (cores) and the per-frame latency percentiles from capture to the encoder's input and
+to its output, matching frames by timestamp.
+
+Example:
+    python -m bench.capture --duration 10
+
+@author lestarch
+"""
+import argparse
+import json
+import logging
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from gst.pipeline import ENCODING_PIPELINE, TEST_SOURCE, raw_source
+
+LOGGER = logging.getLogger(__name__)
+
+# Frames written for fake devices, replayed in a loop, and their frame rate
+FAKE_DEVICE_FRAMES = 30
+FAKE_DEVICE_FRAMERATE = 30
+# Writes the frames of a fake device, the format, size and location are filled in
+FAKE_DEVICE_FRAMES_DESC = '''
+videotestsrc pattern=ball num-buffers={frames} !
+    video/x-raw,format={format},width={width},height={height} !
+    multifilesink location={location}
+'''
+# Replays the frames of a fake device as a live source, captured at the pace of the clock
+FAKE_DEVICE_DESC = '''
+multifilesrc location={location} loop=true !
+    rawvideoparse format={format} width={width} height={height} framerate={framerate}/1 !
+    identity name=captured sync=true
+'''
+# Ends the encoding pipeline where the payloader would be
+SINK_DESC = "queue name=payload_queue ! fakesink sync=false"
+
+
+class Timing(object):
+    """ Times frames from capture to the encoder's input and output """
+    def __init__(self, pipeline) -> None:
+        """ Attach the timing probes
+
+        Args:
+            pipeline: pipeline with 'captured', 'vencoder_queue' and 'payload_queue' elements
+        """
+        self.captured = {}
+        self.frames = 0
+        self.converted = []
+        self.encoded = []
+        probes = (("captured", "src", self.on_captured),
+                  ("vencoder_queue", "sink", self.on_converted),
+                  ("payload_queue", "sink", self.on_encoded))
+        for name, pad, probe in probes:
+            pipeline.get_by_name(name).get_static_pad(pad).add_probe(Gst.PadProbeType.BUFFER,
+                                                                     probe)
+
+    def on_captured(self, _, info) -> Gst.PadProbeReturn:
+        """ Record the capture time of a frame (streaming thread) """
+        self.frames += 1
+        self.captured[info.get_buffer().pts] = time.perf_counter()
+        return Gst.PadProbeReturn.OK
+
+    def on_converted(self, _, info) -> Gst.PadProbeReturn:
+        """ Record the time a frame took to reach the encoder (streaming thread) """
+        captured = self.captured.get(info.get_buffer().pts, None)
+        if captured is not None:
+            self.converted.append(time.perf_counter() - captured)
+        return Gst.PadProbeReturn.OK
+
+    def on_encoded(self, _, info) -> Gst.PadProbeReturn:
+        """ Record the time a frame took to be encoded (streaming thread) """
+        captured = self.captured.pop(info.get_buffer().pts, None)
+        if captured is not None:
+            self.encoded.append(time.perf_counter() - captured)
+        return Gst.PadProbeReturn.OK
+
+    def report(self) -> dict:
+        """ Frame counts and latency percentiles (ms) """
+        result = {"frames_captured": self.frames, "frames_encoded": len(self.encoded)}
+        for stage, latencies in (("convert", self.converted), ("encode", self.encoded)):
+            latencies = sorted(latency * 1000 for latency in latencies)
+            for percent in (50, 95, 99):
+                result[f"{stage}_latency_p{percent}_ms"] = \
+                    latencies[int(len(latencies) * percent / 100)] if latencies else None
+        return result
+
+
+def write_frames(directory: Path, video_format: str, width: int, height: int) -> Path:
+    """ Write the raw frames of a fake device
+
+    Args:
+        directory: directory to write the frames to
+        video_format: raw video format of the frames
+        width: width of the frames
+        height: height of the frames
+
+    Returns:
+        location pattern of the frames
+    """
+    location = directory / f"frame-%05d.{video_format.lower()}"
+    pipeline = Gst.parse_launch(FAKE_DEVICE_FRAMES_DESC.format(
+        frames=FAKE_DEVICE_FRAMES, format=video_format, width=width, height=height,
+        location=location
+    ))
+    pipeline.set_state(Gst.State.PLAYING)
+    message = pipeline.get_bus().timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        raise RuntimeError(f"Failed to write {video_format} frames: {message.parse_error()[0]}")
+    return location
+
+
+def fake_device(location: Path, video_format: str, width: int, height: int) -> str:
+    """ Source fragment of a fake device offering a single format """
+    return raw_source(FAKE_DEVICE_DESC.format(
+        location=location, format=video_format.lower(), width=width, height=height,
+        framerate=FAKE_DEVICE_FRAMERATE
+    ).strip(), video_format)
+
+
+def run(name: str, source: str, duration: float) -> dict:
+    """ Encode the given source for the given duration
+
+    Args:
+        name: name of the run
+        source: source fragment ending in raw video, with an element named 'captured'
+        duration: seconds to run
+
+    Returns:
+        results of the run
+    """
+    description = f"{source} ! vencoder_queue.\n{ENCODING_PIPELINE}\n{SINK_DESC}"
+    LOGGER.debug("Running %s:\n%s", name, description)
+    pipeline = Gst.parse_launch(description)
+    timing = Timing(pipeline)
+    pipeline.set_state(Gst.State.PLAYING)
+    pipeline.get_state(Gst.CLOCK_TIME_NONE)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    message = pipeline.get_bus().timed_pop_filtered(int(duration * Gst.SECOND),
+                                                    Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = time.perf_counter() - start
+    ended = resource.getrusage(resource.RUSAGE_SELF)
+    pipeline.set_state(Gst.State.NULL)
+    if message is not None:
+        raise RuntimeError(f"Run {name} stopped early: {message.type}")
+    cpu = (ended.ru_utime - usage.ru_utime) + (ended.ru_stime - usage.ru_stime)
+    return {"name": name, "duration": elapsed, "cpu_cores": cpu / elapsed, **timing.report()}
+
+
+def named(source: str) -> str:
+    """ Name the first element, a live source, of a source fragment 'captured' """
+    element, rest = source.strip().split(None, 1)
+    return f"{element} name=captured {rest}"
+
+
+def main():
+    """ Run the capture benchmark and record the results """
+    parser = argparse.ArgumentParser(description="Capture path conversion benchmark")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds per run")
+    parser.add_argument("--width", type=int, default=1920, help="Width of fake device frames")
+    parser.add_argument("--height", type=int, default=1080, help="Height of fake device frames")
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_capture.json"),
+                        help="File to write JSON results to")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose/debugging output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    Gst.init(None)
+
+    size = f"width={args.width},height={args.height}"
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        sources = {
+            "test-converted": named(raw_source("videotestsrc is-live=true pattern=ball", "YUY2",
+                                               size)),
+            "test": named(TEST_SOURCE),
+        }
+        for video_format in ("YUY2", "NV12"):
+            location = write_frames(Path(directory), video_format, args.width, args.height)
+            sources[f"device-{video_format.lower()}"] = \
+                fake_device(location, video_format, args.width, args.height)
+        for name, source in sources.items():
+            result = run(name, source, args.duration)
+            results.append(result)
+            print(f"{name}: cpu={result['cpu_cores']:.2f} cores "
+                  f"frames={result['frames_encoded']}/{result['frames_captured']} "
+                  f"convert p50={result['convert_latency_p50_ms']}ms "
+                  f"encode p50={result['encode_latency_p50_ms']}ms "
+                  f"p99={result['encode_latency_p99_ms']}ms")
+    args.output.write_text(json.dumps({"duration": args.duration, "results": results}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
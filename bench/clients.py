@@ -0,0 +1,109 @@
+""" Simulated signaling clients and a local broker, shared by the broker benchmarks
+
+Offerers and answerers speak the protocol of the `gst` Messenger and the browser's fetcher.js with
+synthetic SDP and ICE candidate payloads. Their requests are made through a function called as
+`call(route, method, path, **kwargs)` and returning the response, such that each benchmark counts or
+times requests as it needs.
+
+@author lestarch
+"""
+import logging
+import time
+from typing import Callable
+
+import requests
+
+# Number of ICE candidates each simulated peer posts
+CANDIDATES_PER_PEER = 4
+# Seconds to wait for the broker to start serving
+STARTUP_TIMEOUT = 20
+
+
+def synthetic_sdp(kind: str, name: str) -> dict:
+    """ Session description of roughly the size of a real single video track SDP """
+    lines = ["v=0", f"o=- {abs(hash(name))} 2 IN IP4 127.0.0.1", "s=-", "t=0 0",
+             "a=group:BUNDLE video0", "m=video 9 UDP/TLS/RTP/SAVPF 96", "c=IN IP4 0.0.0.0",
+             f"a=ice-ufrag:{name[-8:]}", "a=ice-pwd:" + "p" * 24, "a=fingerprint:sha-256 " +
+             ":".join(["AB"] * 32), "a=setup:actpass", "a=mid:video0", "a=sendrecv",
+             "a=rtcp-mux", "a=rtpmap:96 H264/90000", "a=rtcp-fb:96 nack pli",
+             "a=fmtp:96 packetization-mode=1;profile-level-id=42e01f"]
+    lines.extend(f"a=extmap:{index} urn:ietf:params:rtp-hdrext:{index}" for index in range(1, 12))
+    return {"type": kind, "sdp": "\r\n".join(lines) + "\r\n"}
+
+
+def synthetic_candidate(index: int) -> dict:
+    """ ICE candidate message as produced by a browser or webrtcbin """
+    return {
+        "sdpMLineIndex": 0,
+        "candidate": f"candidate:{index} 1 UDP {2122260223 - index} 192.168.1.{index + 2} "
+                     f"{50000 + index} typ host generation 0"
+    }
+
+
+def make_offer(call: Callable, label: str, offerer: str) -> requests.Response:
+    """ Post an offer of the given label as the offerer """
+    return call("POST /make-offer", "POST", "/make-offer", json={
+        "label": label, "offerer": offerer, "offer": synthetic_sdp("offer", offerer)
+    })
+
+
+def send_offerer_candidates(call: Callable, offerer: str) -> None:
+    """ Post the offerer's candidates in a single request, as the Messenger coalesces them """
+    call("POST /ice", "POST", f"/ice/{offerer}",
+         json=[synthetic_candidate(candidate) for candidate in range(CANDIDATES_PER_PEER)])
+
+
+def make_answer(call: Callable, offerer: str, answerer: str) -> requests.Response:
+    """ Post the answerer's answer to the offerer's offer """
+    return call("POST /make-answer", "POST", "/make-answer", json={
+        "offerer": offerer, "answerer": answerer, "answer": synthetic_sdp("answer", answerer)
+    })
+
+
+def send_answerer_candidates(call: Callable, answerer: str) -> None:
+    """ Post the answerer's candidates one per request, as browsers produce them """
+    for candidate in range(CANDIDATES_PER_PEER):
+        call("POST /ice", "POST", f"/ice/{answerer}", json=synthetic_candidate(candidate))
+
+
+def negotiate(call: Callable, name: str) -> None:
+    """ Run one complete signaling exchange, the simulated offerer and answerer taking turns
+
+    Args:
+        call: function making the requests
+        name: unique name of this exchange used to derive client ids and label
+    """
+    offerer, answerer = f"{name}-o", f"{name}-a"
+    make_offer(call, name, offerer)
+    send_offerer_candidates(call, offerer)
+    call("GET /offers", "GET", "/offers", params={"metadata": 1, "label": name})
+    call("GET /offer", "GET", f"/offer/{offerer}")
+    make_answer(call, offerer, answerer)
+    send_answerer_candidates(call, answerer)
+    call("POST /poll", "POST", "/poll", json={"answers": [offerer], "ice": {answerer: 0}})
+    call("GET /ice", "GET", f"/ice/{offerer}", params={"since": 0})
+    call("POST /withdraw", "POST", f"/withdraw/{offerer}")
+
+
+def serve(port: int, config: dict) -> None:
+    """ Serve the broker (child process) """
+    from werkzeug.serving import make_server
+    from server import create_app
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    make_server("127.0.0.1", port, create_app(config), threaded=True).serve_forever()
+
+
+def wait_for_broker(host: str, timeout: float=STARTUP_TIMEOUT) -> bool:
+    """ Wait until the broker at the given URL serves requests
+
+    Returns:
+        True once the broker responds, False when it did not within the timeout
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{host}/offers", timeout=1).raise_for_status()
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    return False
@@ -0,0 +1,381 @@
+""" Local loopback end-to-end latency benchmark
+
+Runs the producer pipeline of `setup_pipeline("test", ...)` and, in the same process, a receiving
+`webrtcbin` that depacketizes and decodes the stream. Signaling goes through an in-memory stand-in
+for the Messenger, such that no broker and no network beyond the loopback interface are involved.
+
+Each raw frame is stamped, before it is encoded, with a frame counter drawn as black and white
+blocks into the luma plane. The receiver reads the counter back from each decoded frame and matches
+it to the time the frame was stamped. Reports, per stream: frame latency percentiles (stamping to
+decoding, i.e. encode, payload, transport, jitter buffer and decode), time-to-first-frame, achieved
+frames per second and lost frames. CPU use is measured for the whole process, so it is reported as
+the loopback total of producers and receivers together (and divided per stream), not as the cost
+of serving a stream. bench/capture.py measures the encoding pipeline alone.
+
+Stamping writes into buffers from a pad probe, which needs the writable buffer mapping of the
+gst-python overrides.
+
+Example:
+    python -m bench.loopback --streams 4 --duration 20
+
+@author lestarch
+"""
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import statistics
+import time
+from pathlib import Path
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstSdp', '1.0')
+from gi.repository import GstSdp
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+
+from gst.bridge import EventBridge
+from gst.pipeline import setup_pipeline
+from gst.session import SessionManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Bits of the stamped frame counter and the size (pixels) of the square block drawn for each bit
+STAMP_BITS = 16
+STAMP_BLOCK = 32
+# Luma of blocks for set and clear bits, and the threshold telling them apart once decoded
+LUMA_SET = 235
+LUMA_CLEAR = 16
+LUMA_THRESHOLD = 128
+# Receiving pipeline linked to each RTP stream pad of the receiving webrtcbin
+RECEIVER_DESC = '''
+queue ! rtph264depay ! h264parse ! avdec_h264 ! videoconvert ! video/x-raw,format=I420 !
+    fakesink name=sink sync=false
+'''
+
+
+def luma_plane(buffer, pad, flags):
+    """ Map a raw video buffer and locate its luma plane
+
+    Returns:
+        tuple of map info (to unmap) and the offset and stride of the luma plane, None when mapping
+        fails
+    """
+    info = GstVideo.VideoInfo.new_from_caps(pad.get_current_caps())
+    success, mapping = buffer.map(flags)
+    if not success:
+        return None
+    return mapping, info.offset[0], info.stride[0]
+
+
+class Stream(object):
+    """ Stamps and times the frames of a single stream """
+    def __init__(self, label: str, pipeline) -> None:
+        """ Attach the stamping probe ahead of the encoder queue of the test pipeline
+
+        Args:
+            label: label of the stream
+            pipeline: producer pipeline built by setup_pipeline("test", ...)
+        """
+        self.label = label
+        self.pipeline = pipeline
+        self.counter = 0
+        self.stamped = {}
+        self.latencies = []
+        self.received = 0
+        self.unknown = 0
+        self.started = None
+        self.first_frame = None
+        self.last_frame = None
+        stamp_pad = pipeline.get_by_name("vencoder_queue").get_static_pad("sink")
+        stamp_pad.add_probe(Gst.PadProbeType.BUFFER, self.stamp)
+
+    def stamp(self, pad, info) -> Gst.PadProbeReturn:
+        """ Draw the frame counter into the frame and record the time (streaming thread) """
+        plane = luma_plane(info.get_buffer(), pad, Gst.MapFlags.WRITE)
+        if plane is None:
+            return Gst.PadProbeReturn.OK
+        mapping, offset, stride = plane
+        frame_id = self.counter % (1 << STAMP_BITS)
+        self.counter += 1
+        row = b"".join(
+            bytes([LUMA_SET if frame_id >> bit & 1 else LUMA_CLEAR]) * STAMP_BLOCK
+            for bit in range(STAMP_BITS)
+        )
+        for line in range(STAMP_BLOCK):
+            start = offset + line * stride
+            mapping.data[start:start + len(row)] = row
+        info.get_buffer().unmap(mapping)
+        self.stamped[frame_id] = time.perf_counter()
+        return Gst.PadProbeReturn.OK
+
+    def read(self, pad, info) -> Gst.PadProbeReturn:
+        """ Read the counter of a decoded frame and record its latency (streaming thread) """
+        now = time.perf_counter()
+        plane = luma_plane(info.get_buffer(), pad, Gst.MapFlags.READ)
+        if plane is None:
+            return Gst.PadProbeReturn.OK
+        mapping, offset, stride = plane
+        center = offset + (STAMP_BLOCK // 2) * stride + STAMP_BLOCK // 2
+        frame_id = sum(
+            (mapping.data[center + bit * STAMP_BLOCK] > LUMA_THRESHOLD) << bit
+            for bit in range(STAMP_BITS)
+        )
+        info.get_buffer().unmap(mapping)
+        stamped = self.stamped.pop(frame_id, None)
+        if stamped is None:
+            self.unknown += 1
+            return Gst.PadProbeReturn.OK
+        if self.first_frame is None:
+            self.first_frame = now
+        self.last_frame = now
+        self.received += 1
+        self.latencies.append(now - stamped)
+        return Gst.PadProbeReturn.OK
+
+    def report(self) -> dict:
+        """ Latency, time-to-first-frame, frame rate and loss of the stream """
+        latencies = sorted(latency * 1000 for latency in self.latencies)
+        elapsed = (self.last_frame - self.first_frame) if self.received > 1 else None
+
+        def percentile(fraction):
+            """ Sample at the given fraction of the sorted latencies """
+            return latencies[int(len(latencies) * fraction)] if latencies else None
+        return {
+            "label": self.label,
+            "frames_stamped": self.counter,
+            "frames_received": self.received,
+            "frames_unreadable": self.unknown,
+            "time_to_first_frame": (self.first_frame - self.started)
+                if self.first_frame is not None else None,
+            "fps": (self.received - 1) / elapsed if elapsed else None,
+            "latency_mean_ms": statistics.fmean(latencies) if latencies else None,
+            "latency_p50_ms": percentile(0.50),
+            "latency_p95_ms": percentile(0.95),
+            "latency_p99_ms": percentile(0.99),
+        }
+
+
+class Receiver(object):
+    """ Receiving `webrtcbin` answering the offer of a single stream """
+    def __init__(self, stream: Stream, channel: "LoopbackChannel", bridge: EventBridge) -> None:
+        """ Construct and start the receiving pipeline
+
+        Args:
+            stream: stream whose frames are read back
+            channel: producer channel the receiver answers
+            bridge: event bridge of the asyncio loop
+        """
+        self.stream = stream
+        self.channel = channel
+        self.bridge = bridge
+        self.pipeline = Gst.Pipeline.new(f"receiver-{stream.label}")
+        self.webrtc = Gst.ElementFactory.make("webrtcbin", "receiver")
+        self.webrtc.set_property("latency", 0)
+        self.webrtc.connect("on-ice-candidate", self.on_ice_candidate)
+        self.webrtc.connect("pad-added", self.on_pad_added)
+        self.pipeline.add(self.webrtc)
+        bridge.watch_bus(self.pipeline)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def offer(self, offer_text: str) -> None:
+        """ Set the producer's offer as remote description and answer it """
+        _, sdp = GstSdp.SDPMessage.new()
+        GstSdp.sdp_message_parse_buffer(bytes(offer_text.encode()), sdp)
+        offer = GstWebRTC.WebRTCSessionDescription.new(GstWebRTC.WebRTCSDPType.OFFER, sdp)
+        promise = Gst.Promise.new_with_change_func(self.on_remote_set, None)
+        self.webrtc.emit("set-remote-description", offer, promise)
+
+    def on_remote_set(self, _, __) -> None:
+        """ Create the answer once the offer is set (GStreamer thread) """
+        promise = Gst.Promise.new_with_change_func(self.on_answer_created, None)
+        self.webrtc.emit("create-answer", None, promise)
+
+    def on_answer_created(self, promise, _) -> None:
+        """ Set the answer as local description and hand it to the producer (GStreamer thread) """
+        reply = promise.get_reply()  # MUST be a separate variable to keep data alive
+        answer = reply.get_value("answer")
+        promise = Gst.Promise.new()
+        self.webrtc.emit("set-local-description", answer, promise)
+        promise.interrupt()
+        self.bridge.submit(self.channel.receive_answer, answer.sdp.as_text())
+
+    def add_ice(self, index: int, candidate: str) -> None:
+        """ Add a candidate of the producer """
+        self.webrtc.emit("add-ice-candidate", index, candidate)
+
+    def on_ice_candidate(self, _, index: int, candidate: str) -> None:
+        """ Hand a local candidate to the producer (GStreamer thread) """
+        self.bridge.submit(self.channel.receive_ice, index, candidate)
+
+    def on_pad_added(self, _, pad) -> None:
+        """ Decode a newly received RTP stream and read the stamps of its frames """
+        if pad.get_direction() != Gst.PadDirection.SRC:
+            return
+        decoder = Gst.parse_bin_from_description(RECEIVER_DESC, True)
+        self.pipeline.add(decoder)
+        decoder.sync_state_with_parent()
+        pad.link(decoder.get_static_pad("sink"))
+        sink = decoder.get_by_name("sink").get_static_pad("sink")
+        sink.add_probe(Gst.PadProbeType.BUFFER, self.stream.read)
+
+
+class LoopbackChannel(object):
+    """ In-memory stand-in for a messaging Channel, see messaging.py
+
+    The first channel of each stream is answered by a Receiver. Later channels (opened by the
+    session manager for further viewers) are never answered, as with a broker without viewers.
+    """
+    def __init__(self, messenger: "LoopbackMessenger", client_id: str, label: str) -> None:
+        """ Construct the channel """
+        self.messenger = messenger
+        self.client_id = client_id
+        self.label = label
+        self.answer_cb = None
+        self.ice_cb = None
+        self.remote_id = None
+        self.receiver = None
+        self.pending_ice = []
+
+    async def send_offer(self, offer_text: str, answer_cb, ice_cb) -> None:
+        """ Hand the offer to a new receiver when the stream has none yet """
+        self.answer_cb = answer_cb
+        self.ice_cb = ice_cb
+        stream = self.messenger.streams.get(self.label, None)
+        if stream is None or self.label in self.messenger.answered:
+            return
+        self.messenger.answered.add(self.label)
+        self.receiver = Receiver(stream, self, self.messenger.bridge)
+        self.receiver.offer(offer_text)
+        for index, candidate in self.pending_ice:
+            self.receiver.add_ice(index, candidate)
+        self.pending_ice = []
+
+    def send_ice(self, index: int, candidate: str) -> None:
+        """ Hand a candidate to the receiver, held until the offer is sent """
+        if self.receiver is None:
+            self.pending_ice.append((index, candidate))
+        else:
+            self.receiver.add_ice(index, candidate)
+
+    def receive_answer(self, answer_text: str) -> None:
+        """ Pass the receiver's answer to the producer, like Channel.handle_answer """
+        self.remote_id = f"receiver-{self.label}"
+        answer_cb, self.answer_cb = self.answer_cb, None
+        if answer_cb is not None:
+            answer_cb(answer_text)
+
+    def receive_ice(self, index: int, candidate: str) -> None:
+        """ Pass a candidate of the receiver to the producer, like Channel.handle_ice """
+        if self.ice_cb is not None:
+            self.ice_cb(index, candidate)
+
+    async def withdraw(self) -> None:
+        """ Nothing to withdraw without a broker """
+        self.answer_cb = None
+        self.ice_cb = None
+
+
+class LoopbackMessenger(object):
+    """ In-memory stand-in for the Messenger, see messaging.py """
+    def __init__(self, bridge: EventBridge, label: str="loopback") -> None:
+        """ Construct the messenger
+
+        Args:
+            bridge: event bridge of the asyncio loop
+            label: default label of the streams
+        """
+        self.bridge = bridge
+        self.label = label
+        self.base_id = "loopback"
+        self.channels = {}
+        self.streams = {}
+        self.answered = set()
+
+    def open_channel(self, label: str=None) -> LoopbackChannel:
+        """ Open a new channel """
+        channel = LoopbackChannel(self, f"{self.base_id}-{len(self.channels)}", label or self.label)
+        self.channels[channel.client_id] = channel
+        return channel
+
+    async def close_channel(self, channel: LoopbackChannel) -> None:
+        """ Close a channel """
+        if self.channels.pop(channel.client_id, None) is not None:
+            await channel.withdraw()
+
+    def receivers(self) -> list:
+        """ Receivers of all channels """
+        return [channel.receiver for channel in self.channels.values() if channel.receiver]
+
+
+async def run(args) -> dict:
+    """ Stream for the given duration and summarize the results """
+    bridge = EventBridge()
+    messenger = LoopbackMessenger(bridge)
+    managers = []
+    for index in range(args.streams):
+        label = f"loopback{index + 1:03d}"
+        pipeline = setup_pipeline("test", None)
+        messenger.streams[label] = Stream(label, pipeline)
+        sessions = SessionManager(pipeline, messenger, bridge, label)
+        bridge.watch_bus(pipeline)
+        managers.append(sessions)
+
+    task = asyncio.ensure_future(bridge.run())
+    await asyncio.sleep(0)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    for sessions in managers:
+        messenger.streams[sessions.label].started = time.perf_counter()
+        sessions.start()
+    try:
+        await asyncio.wait_for(asyncio.shield(task), args.duration)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+    ended = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (ended.ru_utime - usage.ru_utime) + (ended.ru_stime - usage.ru_stime)
+    for sessions in managers:
+        sessions.pipeline.set_state(Gst.State.NULL)
+    for receiver in messenger.receivers():
+        receiver.pipeline.set_state(Gst.State.NULL)
+    task.cancel()
+    return {
+        "streams": args.streams,
+        "duration": elapsed,
+        # Producers and receivers share the process, their CPU use is measured together
+        "loopback_cpu_cores": cpu / elapsed,
+        "loopback_cpu_cores_per_stream": cpu / elapsed / args.streams,
+        "results": [stream.report() for stream in messenger.streams.values()],
+    }
+
+
+def main():
+    """ Run the loopback benchmark and record the results """
+    parser = argparse.ArgumentParser(description="Loopback end-to-end latency benchmark")
+    parser.add_argument("-c", "--streams", type=int, default=1, help="Streams to run at once")
+    parser.add_argument("-d", "--duration", type=float, default=20.0, help="Seconds to stream")
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_loopback.json"),
+                        help="File to write JSON results to")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Enable verbose/debugging output")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    result = asyncio.run(run(args))
+    for stream in result["results"]:
+        print(f"{stream['label']} frames={stream['frames_received']}/{stream['frames_stamped']} "
+              f"first={stream['time_to_first_frame']}s fps={stream['fps']} "
+              f"p50={stream['latency_p50_ms']}ms p99={stream['latency_p99_ms']}ms")
+    print(f"loopback cpu={result['loopback_cpu_cores']:.2f} cores "
+          f"({result['loopback_cpu_cores_per_stream']:.2f} per stream, producers and receivers)")
+    args.output.write_text(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
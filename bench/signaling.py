@@ -0,0 +1,259 @@
+""" Signaling load generator for the broker
+
+Starts the broker (`create_app()`) locally in a child process and simulates N offerers and M
+answerers speaking the same protocol as the `gst` Messenger and the browser's fetcher.js, using
+synthetic SDP and ICE candidate payloads:
+
+    Offerer:  POST /make-offer, POST /ice/<offerer> (candidates coalesced), long-poll
+              GET /answer/<offerer>, then long-poll GET /ice/<answerer> for the answerer's
+              candidates, finally POST /withdraw/<offerer> and start over as a new client.
+    Answerer: long-poll GET /offers (metadata only, by version), GET /offer/<offerer>, long-poll
+              GET /ice/<offerer> for the offerer's candidates, then POST /make-answer and
+              POST /ice/<answerer> (one candidate per request).
+
+Reports requests per second, latency percentiles per route, time-to-negotiated per session (from
+posting the offer until the offerer holds the answer and the answerer's candidates) and broker
+memory (resident set size) growth over the run.
+
+Example:
+    python -m bench.signaling --offerers 32 --answerers 32 --duration 20 --store sqlite
+
+@author lestarch
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import random
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from bench.clients import (make_answer, make_offer, send_answerer_candidates,
+                           send_offerer_candidates, serve, wait_for_broker)
+
+# Seconds a simulated client asks the broker to hold its long-polls
+LONG_POLL_WAIT = 10
+# Seconds between samples of the broker's memory
+MEMORY_INTERVAL = 0.5
+
+
+def poll_wait(deadline: float) -> float:
+    """ Long-poll time, shortened such that the poll ends by the deadline """
+    return max(min(LONG_POLL_WAIT, deadline - time.monotonic()), 0)
+
+
+class Recorder(object):
+    """ Thread-safe record of request latencies by route and session negotiation times """
+    def __init__(self) -> None:
+        """ Construct an empty record """
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+        self.conflicts = 0
+        self.negotiations = []
+
+    def call(self, session: requests.Session, host: str, route: str, method: str, path: str,
+             **kwargs) -> requests.Response:
+        """ Make a request, recording its latency under the route
+
+        Raises:
+            requests.exceptions.RequestException: on failed requests and error statuses
+        """
+        start = time.monotonic()
+        try:
+            response = session.request(method, f"{host}{path}", timeout=LONG_POLL_WAIT + 10,
+                                       **kwargs)
+            if response.status_code >= 400 and response.status_code != 404:
+                response.raise_for_status()
+        except requests.exceptions.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+        with self.lock:
+            self.latencies.setdefault(route, []).append(time.monotonic() - start)
+        return response
+
+
+def offerer(host: str, index: int, recorder: Recorder, deadline: float) -> None:
+    """ Simulated offerer: offer, await the answer and the answerer's candidates, repeat """
+    session = requests.Session()
+    call = functools.partial(recorder.call, session, host)
+    count = 0
+    while time.monotonic() < deadline:
+        client_id = f"bench-o{index}-{count}"
+        count += 1
+        try:
+            start = time.monotonic()
+            make_offer(call, "bench", client_id)
+            send_offerer_candidates(call, client_id)
+            answerer_id = None
+            while answerer_id is None and time.monotonic() < deadline:
+                answerer_id = call("GET /answer", "GET", f"/answer/{client_id}",
+                                   params={"wait": poll_wait(deadline)}
+                                   ).json().get("answerer", None)
+            messages = []
+            while answerer_id is not None and not messages and time.monotonic() < deadline:
+                messages = call("GET /ice", "GET", f"/ice/{answerer_id}",
+                                params={"wait": poll_wait(deadline), "since": 0}
+                                ).json().get("messages", [])
+            if messages:
+                with recorder.lock:
+                    recorder.negotiations.append(time.monotonic() - start)
+            call("POST /withdraw", "POST", f"/withdraw/{client_id}")
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+
+def answerer(host: str, index: int, recorder: Recorder, deadline: float) -> None:
+    """ Simulated answerer: await an open offer, answer it and await the offerer's candidates """
+    session = requests.Session()
+    call = functools.partial(recorder.call, session, host)
+    version = None
+    count = 0
+    while time.monotonic() < deadline:
+        client_id = f"bench-a{index}-{count}"
+        count += 1
+        try:
+            params = {"metadata": 1, "label": "bench", "wait": poll_wait(deadline)}
+            if version is not None:
+                params["version"] = version
+            response = call("GET /offers", "GET", "/offers", params=params)
+            if response.status_code == 304:
+                continue
+            version = response.json()["version"]
+            offers = response.json()["offers"]
+            if not offers:
+                continue
+            offerer_id = random.choice(offers)["offerer"]
+            if call("GET /offer", "GET", f"/offer/{offerer_id}").status_code == 404:
+                continue
+            # Like the browser, follow the offerer's candidates before answering
+            messages = []
+            while not messages and time.monotonic() < deadline:
+                messages = call("GET /ice", "GET", f"/ice/{offerer_id}",
+                                params={"wait": poll_wait(deadline), "since": 0}
+                                ).json().get("messages", [])
+            response = make_answer(call, offerer_id, client_id)
+            if response.status_code == 404:
+                # Another answerer took the offer first
+                with recorder.lock:
+                    recorder.conflicts += 1
+                continue
+            send_answerer_candidates(call, client_id)
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+
+def resident_memory(pid: int) -> int:
+    """ Resident set size of a process in bytes, None where /proc is unavailable """
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentiles(samples: list) -> dict:
+    """ Count, mean and p50/p90/p99 (seconds) of the samples """
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": samples[int(len(samples) * 0.50)],
+        "p90": samples[int(len(samples) * 0.90)],
+        "p99": samples[int(len(samples) * 0.99)],
+    }
+
+
+def run(args) -> dict:
+    """ Run the load against a freshly started broker and summarize the results """
+    with tempfile.TemporaryDirectory() as directory:
+        config = {"STORE": args.store, "STORE_PATH": str(Path(directory) / "broker.sqlite3")}
+        broker = multiprocessing.Process(target=serve, args=(args.port, config), daemon=True)
+        broker.start()
+        host = f"http://127.0.0.1:{args.port}"
+        try:
+            if not wait_for_broker(host):
+                raise RuntimeError("Broker failed to start")
+            recorder = Recorder()
+            memory = [resident_memory(broker.pid)]
+            deadline = time.monotonic() + args.duration
+            clients = [
+                threading.Thread(target=offerer, args=(host, index, recorder, deadline))
+                for index in range(args.offerers)
+            ] + [
+                threading.Thread(target=answerer, args=(host, index, recorder, deadline))
+                for index in range(args.answerers)
+            ]
+            start = time.monotonic()
+            for client in clients:
+                client.start()
+            while any(client.is_alive() for client in clients):
+                memory.append(resident_memory(broker.pid))
+                time.sleep(MEMORY_INTERVAL)
+            elapsed = time.monotonic() - start
+            memory.append(resident_memory(broker.pid))
+        finally:
+            broker.terminate()
+            broker.join()
+
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    memory = [sample for sample in memory if sample is not None]
+    return {
+        "offerers": args.offerers,
+        "answerers": args.answerers,
+        "store": args.store,
+        "duration": elapsed,
+        "requests": total,
+        "errors": recorder.errors,
+        "answer_conflicts": recorder.conflicts,
+        "requests_per_second": total / elapsed,
+        "latency": percentiles([
+            latency for latencies in recorder.latencies.values() for latency in latencies
+        ]),
+        "routes": {
+            route: percentiles(latencies) for route, latencies in sorted(recorder.latencies.items())
+        },
+        "negotiations_per_second": len(recorder.negotiations) / elapsed,
+        "time_to_negotiated": percentiles(recorder.negotiations),
+        "memory_start": memory[0] if memory else None,
+        "memory_peak": max(memory) if memory else None,
+        "memory_end": memory[-1] if memory else None,
+        "memory_growth": memory[-1] - memory[0] if memory else None,
+    }
+
+
+def main():
+    """ Run the signaling benchmark and record the results """
+    parser = argparse.ArgumentParser(description="Signaling load generator for the broker")
+    parser.add_argument("-n", "--offerers", type=int, default=16, help="Simulated offerers")
+    parser.add_argument("-m", "--answerers", type=int, default=16, help="Simulated answerers")
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds to run")
+    parser.add_argument("--store", choices=["memory", "sqlite"], default="memory",
+                        help="Broker session store")
+    parser.add_argument("--port", type=int, default=5098, help="Port to run the broker on")
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_signaling.json"),
+                        help="File to write JSON results to")
+    args = parser.parse_args()
+
+    result = run(args)
+    negotiated = result["time_to_negotiated"]
+    print(f"req/s={result['requests_per_second']:9.1f} "
+          f"negotiations/s={result['negotiations_per_second']:8.1f} "
+          f"p50={negotiated.get('p50', float('nan')):.4f}s "
+          f"p99={negotiated.get('p99', float('nan')):.4f}s errors={result['errors']} "
+          f"memory growth={(result['memory_growth'] or 0) / 1024:.0f} KiB")
+    args.output.write_text(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
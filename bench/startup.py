@@ -0,0 +1,170 @@
+""" Stream startup time benchmark, cold and from standby
+
+Starts the broker (`create_app()`) locally in a child process, then repeatedly launches a fresh
+Python process that starts one test stream cold and one from standby (see gst/standby.py) against
+it. The cold start is broken down into the phases a viewer waits for before an offer is listed:
+
+    interpreter: from spawning the process until its code runs
+    import:      importing `gi`, GStreamer and the `gst` package
+    init:        Gst.init
+    build:       parsing the pipeline description (setup_pipeline)
+    preroll:     from starting the pipeline until `webrtcbin` asks for negotiation
+    offer:       from then until the offer is created and posted to the broker
+
+The standby stream is prepared in the same process, timed from preparing it until its offer is
+produced and held, then from binding it to a label until its offer is posted. Reports the median
+and maximum of each phase.
+
+Example:
+    python -m bench.startup --runs 10
+
+@author lestarch
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from bench.clients import serve, wait_for_broker
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between checks of a session's negotiation progress
+POLL_INTERVAL = 0.001
+# Seconds to wait for an offer to be produced and posted
+OFFER_TIMEOUT = 20
+# Phases of a cold start, each ending at the named timestamp and starting at the previous one
+PHASES = (("interpreter", "started"), ("import", "imported"), ("init", "initialized"),
+          ("build", "built"), ("preroll", "negotiating"), ("offer", "posted"))
+
+
+async def until(condition, timeout: float=OFFER_TIMEOUT) -> float:
+    """ Wait until the condition holds
+
+    Returns:
+        time (seconds since the epoch) the condition was seen to hold
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Stream did not post its offer in time")
+        await asyncio.sleep(POLL_INTERVAL)
+    return time.time()
+
+
+def child(args) -> None:
+    """ Start a stream cold and one from standby, printing the timestamps as JSON (child process)
+
+    GStreamer and the `gst` package are imported here, such that importing them is timed.
+    """
+    stamps = {"spawned": args.spawned, "started": time.time()}
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst
+    from gst.bridge import EventBridge
+    from gst.messaging import Messenger
+    from gst.pipeline import setup_pipeline
+    from gst.session import SessionManager
+    stamps["imported"] = time.time()
+    Gst.init(None)
+    stamps["initialized"] = time.time()
+    pipeline = setup_pipeline("test", None)
+    stamps["built"] = time.time()
+
+    async def measure():
+        """ Time the cold stream's offer, then prepare, bind and time a standby stream """
+        bridge = EventBridge()
+        messenger = Messenger(args.messaging_url, label="startup")
+        bridge_task = asyncio.ensure_future(bridge.run())
+        await asyncio.sleep(0)
+        cold = SessionManager(pipeline, messenger, bridge, "startup-cold")
+        cold.start()
+        session = next(iter(cold.sessions.values()))
+        stamps["negotiating"] = await until(lambda: session.rtc.offer_requested)
+        stamps["posted"] = await until(lambda: session.rtc.channel.offer_sent)
+
+        standby = SessionManager(setup_pipeline("test", None), messenger, bridge, standby=True)
+        stamps["preparing"] = time.time()
+        standby.prepare()
+        channel = next(iter(standby.sessions.values())).rtc.channel
+        stamps["binding"] = await until(lambda: channel.held_offer is not None)
+        await standby.bind("startup-standby")
+        stamps["bound"] = await until(lambda: channel.offer_sent)
+
+        for sessions in (cold, standby):
+            sessions.pipeline.set_state(Gst.State.NULL)
+        await messenger.withdraw()
+        bridge_task.cancel()
+    asyncio.run(measure())
+    print(json.dumps(stamps))
+
+
+def summarize(samples: list) -> dict:
+    """ Median and maximum (seconds) of the samples """
+    return {"p50": statistics.median(samples), "max": max(samples)}
+
+
+def run(args) -> dict:
+    """ Launch the runs against a freshly started broker and summarize them """
+    broker = multiprocessing.Process(target=serve, args=(args.port, {"STORE": "memory"}),
+                                     daemon=True)
+    broker.start()
+    host = f"http://127.0.0.1:{args.port}"
+    try:
+        if not wait_for_broker(host):
+            raise RuntimeError("Broker failed to start")
+        runs = []
+        for _ in range(args.runs):
+            command = [sys.executable, "-m", "bench.startup", "--child", "--spawned",
+                       str(time.time()), "--messaging-url", host]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+    finally:
+        broker.terminate()
+    phases = {}
+    previous = "spawned"
+    for phase, stamp in PHASES:
+        phases[phase] = summarize([stamps[stamp] - stamps[previous] for stamps in runs])
+        previous = stamp
+    return {
+        "runs": args.runs,
+        "cold_phases": phases,
+        "cold_total": summarize([stamps["posted"] - stamps["spawned"] for stamps in runs]),
+        "standby_prepare": summarize([stamps["binding"] - stamps["preparing"] for stamps in runs]),
+        "standby_bind": summarize([stamps["bound"] - stamps["binding"] for stamps in runs]),
+    }
+
+
+def main():
+    """ Run the startup benchmark and record the results """
+    parser = argparse.ArgumentParser(description="Stream startup time benchmark")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Processes to launch")
+    parser.add_argument("--port", type=int, default=5097, help="Port to run the broker on")
+    parser.add_argument("-o", "--output", type=Path, default=Path("bench_startup.json"),
+                        help="File to write JSON results to")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--spawned", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--messaging-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.child:
+        child(args)
+        return
+
+    result = run(args)
+    for phase, times in result["cold_phases"].items():
+        print(f"{phase:>12}: p50={times['p50'] * 1000:8.1f}ms max={times['max'] * 1000:8.1f}ms")
+    print(f"{'cold total':>12}: p50={result['cold_total']['p50'] * 1000:8.1f}ms")
+    print(f"{'standby prep':>12}: p50={result['standby_prepare']['p50'] * 1000:8.1f}ms")
+    print(f"{'standby bind':>12}: p50={result['standby_bind']['p50'] * 1000:8.1f}ms")
+    args.output.write_text(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 """ Entrypoint for the `gst` module
 
-Launches the GST pipeline and attaches it to the WebRTC handler and messagging system. Handles the
+Launches the GST pipelines, one per hosted stream, and attaches each to a WebRTC session manager.
+All streams share one GLib main loop, one messagging system and one signaling poll. Handles the
 input arguments to launch the various peices.
 
 @author lestarch
 """
 import argparse
 import asyncio
+import functools
 import logging
+import os
+import signal
+import sys
 from pathlib import Path
 
 
@@ -16,10 +21,18 @@ gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 
 
+from .bridge import EventBridge, PipelineError
+from .builder import PipelineBuilder
 from .pipeline import setup_pipeline
 from .messaging import Messenger
-from .rtc import WebRTC
-from .replay import ReplayFile
+from .metrics import MetricsCollector
+from .rate import RateController
+from .session import SessionManager
+from .testclip import cached_test_clip, default_cache_dir
+from .trace import PipelineTracer, write_report
+from .replay import Clip, ReplayFile
+from .scheduler import POLICIES, parse_cpus, plan
+from .standby import StandbyPool
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,36 +53,250 @@ def parse():
                        help="Label the produced WebRTC stream set")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose/debugging output")
-    parser.add_argument("-s", "--stream-type", choices=["test", "device", "file"], default="test",
-                        help="Set the type of the stream running to GStreamer")
+    parser.add_argument("-s", "--stream-type", choices=["test", "test-cached", "device", "file"],
+                        default="test", help="Set the type of the stream running to GStreamer, "
+                        "test-cached replays a test clip encoded once instead of encoding live")
     parser.add_argument("-f", "--file", help="Path to file (only used with -s file)", type=Path)
+    parser.add_argument("--cache-dir", type=Path, default=default_cache_dir(),
+                        help="Directory caching the encoded test clip (only used with -s "
+                             "test-cached)")
+    parser.add_argument("--switchable", action="store_true",
+                        help="Build pipelines whose source is swapped without restarting, by "
+                             "lines read from stdin: test, test-cached, device or file <path>")
+    parser.add_argument("--renditions", action="store_true",
+                        help="Also encode a low resolution rendition, offered to viewers as a "
+                             "second track they switch to for thumbnails (only with -s test or "
+                             "-s device)")
+    parser.add_argument("--telemetry", action="store_true",
+                        help="Send per-frame metadata to viewers on a binary 'telemetry' data "
+                             "channel")
+    parser.add_argument("--trace", type=Path, nargs="?", const=Path("trace_pipeline.json"),
+                        help="Trace per-element latency and queue levels, writing a report to the "
+                             "given file (default: trace_pipeline.json) at exit")
+    parser.add_argument("-c", "--count", type=int, default=1,
+                        help="Number of streams hosted by this process, labelled <label>001 "
+                             "onwards when more than one (e.g. -l scale -c 40)")
+    parser.add_argument("--standby", type=int, default=0, metavar="N",
+                        help="Keep N streams prepared with their offers produced, instead of "
+                             "starting -c streams, and start one for each label read from stdin")
+    parser.add_argument("--schedule", action="store_true",
+                        help="Place the encoders of the streams on the available cores, sizing "
+                             "their threads and downscaling or refusing streams beyond the CPU "
+                             "budget")
+    parser.add_argument("--cpus", type=parse_cpus, default=sorted(os.sched_getaffinity(0)),
+                        help="Cores the scheduled streams run on, e.g. 0-7,16-23 (default: the "
+                             "cores of the process, only used with --schedule)")
+    parser.add_argument("--over-budget", choices=POLICIES, default=POLICIES[0],
+                        help="Downscale all streams or refuse the streams beyond the CPU budget "
+                             "(only used with --schedule)")
     args = parser.parse_args()
     if args.stream_type == "file" and (args.file is None or not args.file.exists()):
         raise TypeError("-f must be specified and must exist")
+    if args.count < 1:
+        raise TypeError("-c must be at least 1")
+    if args.count > 1 and args.stream_type == "device":
+        raise TypeError("-c greater than 1 cannot share a single device, use -s test or -s file")
+    if args.renditions and (args.stream_type not in ("test", "device") or args.switchable):
+        raise TypeError("--renditions needs -s test or -s device and cannot be --switchable")
+    if args.standby < 0:
+        raise TypeError("--standby must not be negative")
+    if args.standby and (args.switchable or args.schedule):
+        raise TypeError("--standby cannot be combined with --switchable or --schedule")
+    if args.standby > 1 and args.stream_type == "device":
+        raise TypeError("--standby greater than 1 cannot share a single device")
+    if args.schedule and args.stream_type not in ("test", "device") and not args.switchable:
+        raise TypeError("--schedule needs streams with an encoder: -s test, -s device or "
+                        "--switchable")
     logging_level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=logging_level)
     return args
 
 
+async def stop_stream(managers: list, sessions: SessionManager, reason: str) -> None:
+    """ Stop a stream whose pipeline failed, leaving the others streaming
+
+    Args:
+        managers: session managers of all streams
+        sessions: session manager of the failed stream
+        reason: reason the pipeline failed
+
+    Raises:
+        PipelineError: once every stream has failed
+    """
+    LOGGER.error("Stopping stream %s on pipeline error: %s", sessions.label, reason)
+    await sessions.stop()
+    if all(manager.stopped for manager in managers):
+        raise PipelineError(reason)
+
+
+def load_clip(stream_type: str, file: Path, cache_dir: Path) -> Clip:
+    """ Clip replayed by the given stream type
+
+    Args:
+        stream_type: type of the stream
+        file: path to the file of "file" streams
+        cache_dir: directory caching the encoded test clip of "test-cached" streams
+
+    Returns:
+        clip demuxed into memory, None for stream types encoding live
+    """
+    if stream_type == "file":
+        return Clip.load(file)
+    if stream_type == "test-cached":
+        return Clip.load(cached_test_clip(cache_dir))
+    return None
+
+
+async def read_sources(builders: list, cache_dir: Path) -> None:
+    """ Swap the source of every stream on each line read from stdin, until stdin closes
+
+    Lines name the stream type, followed by the path for files, e.g. 'file clip.mp4'. Invalid lines
+    are logged and ignored.
+
+    Args:
+        builders: pipeline builders of all streams
+        cache_dir: directory caching the encoded test clip
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        LOGGER.warning("Sources cannot be switched, stdin is not a terminal or pipe")
+        return
+    while line := await reader.readline():
+        words = line.decode().split()
+        if not words:
+            continue
+        stream_type, file = words[0], Path(" ".join(words[1:])) if words[1:] else None
+        try:
+            if stream_type == "device" and len(builders) > 1:
+                raise TypeError("several streams cannot share a single device")
+            if stream_type == "file" and (file is None or not file.exists()):
+                raise TypeError("file must be followed by the path to an existing file")
+            clip = await asyncio.to_thread(load_clip, stream_type, file, cache_dir)
+            for builder in builders:
+                await builder.swap_source(stream_type, clip)
+        except (TypeError, PipelineError) as exc:
+            LOGGER.error("Cannot switch the source to '%s': %s", line.decode().strip(), exc)
+
+
+def stream_labels(label: str, count: int) -> list:
+    """ Labels of the streams hosted by this process
+
+    Args:
+        label: label supplied by the user
+        count: number of streams
+
+    Returns:
+        the label itself for a single stream, otherwise the label suffixed with 001, 002, etc.
+    """
+    if count == 1:
+        return [label]
+    return [f"{label}{index:03d}" for index in range(1, count + 1)]
+
+
 def main():
     """ Hi Lewis!!! """
     args = parse()
-
-    pipeline = setup_pipeline(args.stream_type, args.file)
+    bridge = EventBridge()
     messenger = Messenger(args.messaging_url, label=f"{args.label}")
-    webrtc = WebRTC(pipeline, messenger)
-    replayer = ReplayFile(pipeline)
-    try:
-        # Stream the pipeline and start the message polling
-        pipeline.set_state(Gst.State.PLAYING)
+    # Each stream has its own pipeline such that a failing stream does not take the others down
+    managers = []
+    replayers = []
+    builders = []
+    tracers = []
+    # Files are demuxed into memory once and replayed by every stream
+    clip = load_clip(args.stream_type, args.file, args.cache_dir)
+    labels = stream_labels(args.label, args.count) if not args.standby else []
+    placements = {}
+    if args.schedule:
+        placements = {
+            placement.label: placement
+            for placement in plan(labels, args.stream_type, args.cpus, args.over_budget,
+                                  args.renditions)
+        }
+        labels = [label for label in labels if label in placements]
+    for label in labels:
+        if args.switchable:
+            builders.append(PipelineBuilder())
+            pipeline = builders[-1].build(args.stream_type, clip)
+        else:
+            pipeline = setup_pipeline(args.stream_type, args.file, args.renditions)
+            if clip is not None:
+                replayers.append(ReplayFile(pipeline, clip))
+        if label in placements:
+            placements[label].apply(pipeline)
+        if args.trace is not None:
+            tracers.append(PipelineTracer(pipeline, label))
+        sessions = SessionManager(pipeline, messenger, bridge, label, args.telemetry)
+        bridge.watch_bus(pipeline, functools.partial(stop_stream, managers, sessions))
+        managers.append(sessions)
 
-        async def async_main():
-            await asyncio.gather(
-                messenger.poll(),
-            )
+    def build_standby():
+        """ Build the pipeline of a standby stream """
+        pipeline = setup_pipeline(args.stream_type, args.file, args.renditions)
+        if clip is not None:
+            replayers.append(ReplayFile(pipeline, clip))
+        return pipeline
+
+    async def async_main():
+        """ Run the event bridge and message polling until cancelled or all pipelines fail """
+        controllers = [RateController(sessions) for sessions in managers]
+        for controller in controllers:
+            if controller.sessions.label in placements:
+                controller.top_rung = placements[controller.sessions.label].rung
+        metrics = MetricsCollector(managers, messenger)
+        switching = [read_sources(builders, args.cache_dir)] if builders else []
+        telemetry = [sessions.telemetry.run() for sessions in managers if sessions.telemetry]
+        # Standby streams are controlled, measured and traced from the moment they are bound
+        bound_tasks = []
+
+        def on_bound(sessions):
+            """ Run the rate control and telemetry of a bound standby stream """
+            managers.append(sessions)
+            metrics.add(sessions)
+            if args.trace is not None:
+                tracers.append(PipelineTracer(sessions.pipeline, sessions.label))
+            bound_tasks.append(asyncio.ensure_future(RateController(sessions).run()))
+            if sessions.telemetry is not None:
+                bound_tasks.append(asyncio.ensure_future(sessions.telemetry.run()))
+        pool = None
+        if args.standby:
+            pool = StandbyPool(args.standby, build_standby, messenger, bridge, on_bound,
+                               functools.partial(stop_stream, managers), args.telemetry)
+        standby = [pool.read_labels()] if pool is not None else []
+        task = asyncio.gather(bridge.run(), messenger.poll(), metrics.run(), *switching,
+                              *standby, *telemetry,
+                              *(controller.run() for controller in controllers))
+        # Termination (e.g. pkill from bin/run) unwinds like Ctrl-C such that offers are withdrawn
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            # Stream the pipelines once the bridge is servicing the signaling
+            await asyncio.sleep(0)
+            for sessions in managers:
+                sessions.start()
+            if pool is not None:
+                pool.fill()
+            await task
+        except asyncio.CancelledError:
+            pass
+        except PipelineError as exc:
+            LOGGER.error("Stopping on pipeline error: %s", exc)
+        finally:
+            task.cancel()
+            for bound_task in bound_tasks:
+                bound_task.cancel()
+            for sessions in managers + (list(pool.ready) if pool is not None else []):
+                sessions.pipeline.set_state(Gst.State.NULL)
+            await messenger.withdraw()
+    try:
         asyncio.run(async_main())
-    except asyncio.CancelledError:
+    except KeyboardInterrupt:
         pass
+    finally:
+        if tracers:
+            write_report(tracers, args.trace)
 
 
 if __name__ == "__main__":
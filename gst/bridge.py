@@ -0,0 +1,165 @@
+""" Bridge between the GLib main loop and the asyncio event loop
+
+GStreamer delivers bus messages through the GLib main loop and emits element signals (e.g. from
+`webrtcbin`) on its own streaming threads. Signaling, on the other hand, runs in the asyncio event
+loop. This file runs a GLib main loop on a dedicated thread and provides a thread-safe hand-off
+queue from GStreamer threads into the asyncio loop such that GStreamer threads never block on
+network I/O.
+
+@author lestarch
+"""
+import asyncio
+import functools
+import logging
+import threading
+from typing import Callable
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PipelineError(Exception):
+    """ Error reported by a GStreamer pipeline on its bus """
+    pass
+
+
+class EventBridge(object):
+    """ Runs the GLib main loop and hands work from GStreamer threads to the asyncio loop
+
+    Work submitted from any thread is queued and then started by the `run` coroutine in the asyncio
+    loop. Submitted functions may be plain functions or coroutine functions. Work is run in lanes:
+    functions bound to the same object (e.g. a messaging channel) run in submission order, each
+    once the previous is done, while separate lanes run concurrently such that slow requests of one
+    stream do not hold up the signaling of others. Errors raised by submitted work are logged and do
+    not stop the bridge.
+    """
+    def __init__(self) -> None:
+        """ Construct the bridge, `run` must be awaited for it to operate """
+        self.loop = None
+        self.queue = None
+        # Last work started in each lane, by the object its functions are bound to
+        self.lanes = {}
+        self.tasks = set()
+        self.failure = None
+        self.glib_loop = GLib.MainLoop()
+        self.glib_thread = threading.Thread(target=self.glib_loop.run, name="glib-main-loop",
+                                            daemon=True)
+
+    def submit(self, function: Callable, *args) -> None:
+        """ Queue a function to be run in the asyncio loop, callable from any thread
+
+        Args:
+            function: function or coroutine function to run
+            *args: arguments to pass to the function
+        """
+        if self.loop is None:
+            LOGGER.warning("Event bridge not running, dropping %s",
+                           getattr(function, "__name__", repr(function)))
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (function, args))
+
+    def watch_bus(self, pipeline, on_error: Callable=None) -> None:
+        """ Service the bus messages of the pipeline in the GLib main loop
+
+        Args:
+            pipeline: GStreamer pipeline whose bus messages are handled
+            on_error: function run in the asyncio loop with the reason of a pipeline error, defaults
+                      to raising a PipelineError stopping the bridge
+        """
+        bus = pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message", self.on_bus_message, pipeline, on_error or self.fail)
+
+    def on_bus_message(self, _, message, pipeline, on_error: Callable) -> None:
+        """ Handle a pipeline bus message (GLib main loop thread)
+
+        Errors are handed to the asyncio loop's `on_error`. Warnings and end-of-stream are logged,
+        and latency changes are redistributed across the pipeline.
+
+        Args:
+            _: unused bus
+            message: bus message
+            pipeline: pipeline owning the bus
+            on_error: function run in the asyncio loop with the reason of a pipeline error
+        """
+        if message.type == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            LOGGER.error("Pipeline error from %s: %s", message.src.get_name(), error.message)
+            LOGGER.debug("Pipeline error details: %s", debug)
+            self.submit(on_error, f"{message.src.get_name()}: {error.message}")
+        elif message.type == Gst.MessageType.WARNING:
+            warning, _ = message.parse_warning()
+            LOGGER.warning("Pipeline warning from %s: %s", message.src.get_name(), warning.message)
+        elif message.type == Gst.MessageType.EOS:
+            LOGGER.info("Pipeline reached end-of-stream")
+        elif message.type == Gst.MessageType.LATENCY:
+            pipeline.recalculate_latency()
+        elif message.type == Gst.MessageType.STATE_CHANGED and message.src == pipeline:
+            old, new, _ = message.parse_state_changed()
+            LOGGER.debug("Pipeline state changed: %s -> %s", old.value_nick, new.value_nick)
+
+    @staticmethod
+    def fail(reason: str) -> None:
+        """ Raise a pipeline error in the asyncio loop, ending `run` """
+        raise PipelineError(reason)
+
+    @staticmethod
+    def lane(function: Callable):
+        """ Object the function, or the function wrapped by a partial, is bound to, else None """
+        return getattr(getattr(function, "func", function), "__self__", None)
+
+    async def call(self, function: Callable, args: tuple, previous: asyncio.Task=None) -> None:
+        """ Run submitted work once the previous work of its lane is done
+
+        Args:
+            function: function or coroutine function to run
+            args: arguments to pass to the function
+            previous: previous work of the lane, None when the lane is idle
+        """
+        if previous is not None:
+            await asyncio.wait((previous,))
+        try:
+            result = function(*args)
+            if asyncio.iscoroutine(result):
+                await result
+        except PipelineError as exc:
+            # Wake `run` to raise the error
+            self.failure = exc
+            self.queue.put_nowait((None, ()))
+        except Exception as exc:
+            LOGGER.exception("Failed to run %s: %s", getattr(function, "__name__", repr(function)),
+                             exc)
+
+    def on_done(self, lane, task: asyncio.Task) -> None:
+        """ Forget finished work, and its lane once idle """
+        self.tasks.discard(task)
+        if self.lanes.get(lane, None) is task:
+            del self.lanes[lane]
+
+    async def run(self) -> None:
+        """ Start the GLib main loop and process submitted work until cancelled or failed
+
+        Raises:
+            PipelineError: when a pipeline reports an error on its bus
+        """
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.glib_thread.start()
+        try:
+            while True:
+                function, args = await self.queue.get()
+                if self.failure is not None:
+                    raise self.failure
+                lane = self.lane(function)
+                task = asyncio.ensure_future(self.call(function, args, self.lanes.get(lane, None)))
+                self.lanes[lane] = task
+                self.tasks.add(task)
+                task.add_done_callback(functools.partial(self.on_done, lane))
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.loop = None
+            self.glib_loop.quit()
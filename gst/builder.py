@@ -0,0 +1,198 @@
+""" Programmatic pipeline construction with a hot-swappable source
+
+Builds the topology of setup_pipeline from element objects, with the source branch feeding the
+encoder through an `input-selector`. Swapping the source adds the new branch to the running
+pipeline, selects it, asks the encoder for a keyframe and then removes the old branch. The encoder,
+payloader, tee and every `webrtcbin` keep running, such that viewers stay connected and see the new
+source after the next keyframe.
+
+Every source is raw video ahead of the encoder, files (and the cached test clip) are decoded from
+memory for this. This costs a decode over setup_pipeline's file streams, in exchange for one
+encoder configuration across all sources.
+
+@author lestarch
+"""
+import asyncio
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .bridge import PipelineError
+from .pipeline import ENCODED_CAPS, ENCODER_ELEMENT_NAME, ENCODER_SETTINGS, FILE_SOURCE, \
+    PAYLOADER_SETTINGS, RTP_CAPS, RTP_TEE_ELEMENT_NAME, SCALE_CAPS_ELEMENT_NAME, TEST_SOURCE, \
+    device_source, request_keyframe
+from .replay import Clip, ReplayFile
+
+LOGGER = logging.getLogger(__name__)
+
+SELECTOR_ELEMENT_NAME = "vselector"
+# Source branches by stream type, each ending in raw video. Devices are probed for their formats
+# when their branch is built
+SOURCE_BRANCHES = {
+    "test": TEST_SOURCE,
+    "device": None,
+    "file": f"{FILE_SOURCE} ! h264parse ! avdec_h264 ! videoconvert",
+    "test-cached": f"{FILE_SOURCE} ! h264parse ! avdec_h264 ! videoconvert",
+}
+
+
+def make(factory: str, name: str=None, settings: str="", **properties):
+    """ Make an element, applying its settings
+
+    Args:
+        factory: element factory name
+        name: name of the element, generated when None
+        settings: space separated 'property=value' strings, as in a pipeline description
+        properties: property values, underscores in names standing for dashes
+
+    Returns:
+        new element
+
+    Raises:
+        PipelineError: when the element is not installed
+    """
+    element = Gst.ElementFactory.make(factory, name)
+    if element is None:
+        raise PipelineError(f"GStreamer element {factory} is not available")
+    for setting in settings.split():
+        key, value = setting.split("=", 1)
+        Gst.util_set_object_arg(element, key, value)
+    for key, value in properties.items():
+        element.set_property(key.replace("_", "-"), value)
+    return element
+
+
+def capsfilter(caps: str, name: str=None):
+    """ Make a capsfilter of the given caps string """
+    return make("capsfilter", name, caps=Gst.Caps.from_string(caps))
+
+
+class SourceBranch(object):
+    """ Bin producing the raw video of one source """
+    def __init__(self, stream_type: str, clip: Clip=None) -> None:
+        """ Construct the source branch
+
+        Args:
+            stream_type: one of the SOURCE_BRANCHES
+            clip: clip replayed by "file" and "test-cached" branches
+        """
+        if stream_type not in SOURCE_BRANCHES:
+            raise PipelineError(f"Invalid stream choice: {stream_type}")
+        if (clip is None) != (stream_type not in ("file", "test-cached")):
+            raise PipelineError(f"Stream type {stream_type} needs a clip exactly when replaying")
+        self.stream_type = stream_type
+        description = SOURCE_BRANCHES[stream_type] or device_source()
+        self.bin = Gst.parse_bin_from_description(description, True)
+        self.replayer = ReplayFile(self.bin, clip) if clip is not None else None
+        self.selector_pad = None
+
+    def restamp(self, running_time: int) -> None:
+        """ Start the branch's timestamps at the pipeline's running time (nanoseconds)
+
+        Device sources timestamp by the pipeline clock already. Test and replayed sources count
+        from zero and would otherwise be late by the time the pipeline has been running.
+        """
+        if self.replayer is not None:
+            self.replayer.start = running_time
+        elif self.stream_type == "test":
+            iterator = self.bin.iterate_sources()
+            _, source = iterator.next()
+            source.set_property("timestamp-offset", running_time)
+
+
+class PipelineBuilder(object):
+    """ Builds the streaming pipeline and swaps its source while it runs
+
+    Elements carry the names of setup_pipeline's elements, such that sessions, rate control,
+    metrics and tracing apply unchanged.
+    """
+    def __init__(self) -> None:
+        """ Construct an empty pipeline """
+        Gst.init(None)
+        self.pipeline = Gst.Pipeline.new()
+        self.selector = None
+        self.branch = None
+
+    def build(self, stream_type: str, clip: Clip=None):
+        """ Build the pipeline with the given initial source, without starting it
+
+        Args:
+            stream_type: initial source, one of the SOURCE_BRANCHES
+            clip: clip replayed by "file" and "test-cached" sources
+
+        Returns:
+            initialized but not started pipeline
+        """
+        LOGGER.debug("Building pipeline with swappable source, initially: %s", stream_type)
+        self.selector = make("input-selector", SELECTOR_ELEMENT_NAME, sync_streams=False)
+        self.link([
+            self.selector,
+            make("queue", "vencoder_queue"),
+            make("videoscale"),
+            make("videorate", drop_only=True),
+            capsfilter("video/x-raw", SCALE_CAPS_ELEMENT_NAME),
+            make("x264enc", ENCODER_ELEMENT_NAME, ENCODER_SETTINGS),
+            capsfilter(ENCODED_CAPS),
+            make("queue", "payload_queue"),
+            make("h264parse"),
+            make("rtph264pay", settings=PAYLOADER_SETTINGS),
+            capsfilter(RTP_CAPS),
+            make("tee", RTP_TEE_ELEMENT_NAME, allow_not_linked=True),
+        ])
+        self.branch = self.attach(SourceBranch(stream_type, clip))
+        return self.pipeline
+
+    def link(self, elements: list) -> None:
+        """ Add elements to the pipeline and link them in order
+
+        Raises:
+            PipelineError: when two elements cannot be linked
+        """
+        for element in elements:
+            self.pipeline.add(element)
+        for upstream, downstream in zip(elements, elements[1:]):
+            if not upstream.link(downstream):
+                raise PipelineError(f"Failed to link {upstream.get_name()} to "
+                                    f"{downstream.get_name()}")
+
+    def attach(self, branch: SourceBranch) -> SourceBranch:
+        """ Add a source branch to the pipeline, linked to a new selector input
+
+        Raises:
+            PipelineError: when the branch cannot be linked
+        """
+        self.pipeline.add(branch.bin)
+        branch.selector_pad = self.selector.request_pad_simple("sink_%u")
+        if branch.bin.get_static_pad("src").link(branch.selector_pad) != Gst.PadLinkReturn.OK:
+            raise PipelineError(f"Failed to link {branch.stream_type} source")
+        return branch
+
+    def running_time(self) -> int:
+        """ Current running time of the pipeline (nanoseconds), zero before it runs """
+        clock = self.pipeline.get_clock()
+        if clock is None:
+            return 0
+        return max(clock.get_time() - self.pipeline.get_base_time(), 0)
+
+    async def swap_source(self, stream_type: str, clip: Clip=None) -> None:
+        """ Switch the running pipeline to a new source, then remove the old one
+
+        Args:
+            stream_type: new source, one of the SOURCE_BRANCHES
+            clip: clip replayed by "file" and "test-cached" sources
+        """
+        old = self.branch
+        branch = self.attach(SourceBranch(stream_type, clip))
+        branch.restamp(self.running_time())
+        branch.bin.sync_state_with_parent()
+        self.selector.set_property("active-pad", branch.selector_pad)
+        self.branch = branch
+        request_keyframe(self.pipeline)
+        LOGGER.info("Swapped source from %s to %s", old.stream_type, stream_type)
+
+        await asyncio.to_thread(old.bin.set_state, Gst.State.NULL)
+        old.bin.get_static_pad("src").unlink(old.selector_pad)
+        self.selector.release_request_pad(old.selector_pad)
+        self.pipeline.remove(old.bin)
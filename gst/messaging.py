@@ -3,44 +3,79 @@
 WebRTC needs a side-channel for message passing outside the protocol. This application uses a flask
 REST-like webserver to pass messages about. This file handles these functions. 
 
+A Messenger owns the connection to the server and any number of Channels, one per WebRTC session.
+Each channel is a separate client of the server with its own offer, answer and ICE candidates, and
+all channels are polled together through the server's batch poll.
+
+All messaging functions are coroutines run in the asyncio event loop. GStreamer threads hand work to
+the loop via the EventBridge (see bridge.py) and so never block on the network.
+
 @author lestarch
 """
 import asyncio
+import functools
+import itertools
 import logging
 import requests
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 LOGGER = logging.getLogger(__name__)
 
+# Seconds the messaging server is asked to hold a long-poll open before returning empty-handed
+LONG_POLL_WAIT = 10
+# Seconds to idle between polls when there is nothing to poll for (e.g. no offer made yet)
+IDLE_POLL_INTERVAL = 0.1
+# Seconds between heartbeats keeping this client's offer alive on the server (below its session TTL)
+HEARTBEAT_INTERVAL = 20
+# Seconds allowed to establish a connection to the messaging server
+CONNECT_TIMEOUT = 3.05
+# Seconds allowed for the server to respond to a (non long-poll) request
+REQUEST_TIMEOUT = 10
+# Retries of failed requests, spaced by exponential backoff of RETRY_BACKOFF * 2^(retry - 1) seconds
+RETRY_COUNT = 4
+RETRY_BACKOFF = 0.1
+# Seconds to gather a burst of locally produced ICE candidates into a single POST
+ICE_COALESCE_DELAY = 0.02
+# Seconds to gather a burst of newly sent offers before restarting the outstanding long-poll
+REFRESH_DELAY = 0.1
+# Worker threads (and pooled connections) running requests. Each channel may have a request
+# outstanding, and an abandoned long-poll holds a worker until the server answers it (see poll).
+REQUEST_THREADS = 32
 
-class Messenger(object):
-    """ Object for controlling the REST-like API
-    
-    The side-channel REST-like API processing the following messages:
 
-    1. Send Offer: sends WebRTC offers to the REST-like messaging server
-    2. Send ICE: sends WebRTC ICE candidate messages to the REST-like messaging server
-    3. Poll for Answer: polls for WebRTC answers that come into the REST-like messaging server
-    4. Poll for ICE: polls for WebRTC ICE candidate messages that come into the server 
+class Channel(object):
+    """ Signaling of a single WebRTC session
+
+    A channel is one client of the messaging server: it sends one offer, receives the answer to it
+    and exchanges ICE candidates with the answering client. Channels are created by, and polled
+    through, a Messenger.
     """
-    def __init__(self, host: str, label: str="GStreamer") -> None:
-        """ Constructor for messaging
-        
-        Initialize the messaging connection with given host and lable for remote client.
+    def __init__(self, messenger: "Messenger", client_id: str, label: str) -> None:
+        """ Constructor for a channel
 
         Args:
-            host: host url as a string
-            label: client label
+            messenger: messenger owning this channel
+            client_id: id of this channel on the messaging server
+            label: label of the offered stream, None for standby channels holding their offer until
+                   bound to a label
         """
-        self.host = host
-        self.client_id = f"{round(time.time() * 1000)}"
+        self.messenger = messenger
+        self.client_id = client_id
         self.label = label
+        self.held_offer = None
         self.answer_cb = None
+        self.ice_cb = None
         self.remote_id = None
-        self.seen_candidates = set()
+        self.ice_cursor = 0
+        self.offer_sent = False
+        self.pending_ice = []
 
-    def send_offer(self, offer, answer_cb: Callable, ice_cb: Callable) -> None:
+    async def send_offer(self, offer_text: str, answer_cb: Callable, ice_cb: Callable) -> None:
         """ Send a WEbRTC offer
         
         Sends an WebRTC offer package with the supplied label, client id used by the messaging
@@ -48,12 +83,15 @@ class Messenger(object):
         that result from this offer.
 
         Args:
-            offer: offer text to send to client
+            offer_text: offer SDP text to send to client
             answer_cb: callback used to process the answer to this offer
             ice_cb: callback to process ICE candidates from the answering clienit
         """
-        LOGGER.info("Sending WebRTC offer")
-        offer_text = offer.sdp.as_text()
+        if self.label is None:
+            LOGGER.info("Holding WebRTC offer from %s until bound to a label", self.client_id)
+            self.held_offer = (offer_text, answer_cb, ice_cb)
+            return
+        LOGGER.info("Sending WebRTC offer from %s", self.client_id)
         LOGGER.debug("Offer text: %s", offer_text)
         data_packet = {
             "label": self.label,
@@ -61,12 +99,27 @@ class Messenger(object):
             "offer": {"type": "offer", "sdp": offer_text}
         }
         try:
-            response = requests.post(f"{self.host}/make-offer", json=data_packet)
-            response.raise_for_status()
+            await self.messenger.request("POST", "/make-offer", json=data_packet)
             self.answer_cb = answer_cb
             self.ice_cb = ice_cb
+            self.messenger.refresh()
         except requests.exceptions.RequestException as exc:
-            LOGGER.warning("Failed to send offer: %s %s", str(exc), response.text)
+            LOGGER.warning("Failed to send offer: %s", str(exc))
+            return
+        # Candidates produced before the offer was stored would be cleared by it, send them now
+        self.offer_sent = True
+        await self.flush_ice()
+
+    async def bind(self, label: str) -> None:
+        """ Bind a standby channel to a label, sending its held offer if it was produced already
+
+        Args:
+            label: label of the offered stream
+        """
+        self.label = label
+        held_offer, self.held_offer = self.held_offer, None
+        if held_offer is not None:
+            await self.send_offer(*held_offer)
 
     def send_ice(self, index: int, candidate: str) -> None:
         """ Send ICE candidate messages
@@ -75,98 +128,315 @@ class Messenger(object):
         These messages are POSTed to the server at the current client's address. The remote client
         is expected to POLL for these messages with the local client's ID.
 
+        Candidates are produced in bursts. They are queued and sent together after a short delay,
+        and are held until the offer has been sent. Must be called from the event loop.
+
         Args:
             index: sdpMLineIndex of the candidate message
             candidate: candidate message text
         """
-        LOGGER.info("Sending WebRTC ice candidate")
         LOGGER.debug("Candidate index: %d text: %s", index, candidate)
-        data_packet = {
+        self.pending_ice.append({
             "sdpMLineIndex": index,
             "candidate": candidate
-        }
+        })
+        if self.offer_sent and len(self.pending_ice) == 1:
+            asyncio.get_running_loop().call_later(
+                ICE_COALESCE_DELAY, lambda: asyncio.ensure_future(self.flush_ice())
+            )
+
+    async def flush_ice(self) -> None:
+        """ POST all queued ICE candidate messages in a single request """
+        data_packet, self.pending_ice = self.pending_ice, []
+        if not data_packet:
+            return
+        LOGGER.info("Sending %d WebRTC ice candidates from %s", len(data_packet), self.client_id)
         try:
-            response = requests.post(f"{self.host}/ice/{self.client_id}", json=data_packet)
-            response.raise_for_status()
+            await self.messenger.request("POST", f"/ice/{self.client_id}", json=data_packet)
         except requests.exceptions.RequestException as exc:
-            LOGGER.warning("Failed to send ICE: %s %s", str(exc), response.text)
+            LOGGER.warning("Failed to send ICE: %s", str(exc))
 
-    def poll_answer(self):
-        """ POLL for an answer to a previous offer
-        
-        POLLs for answers to a previous answer. Should an answer arrive, the `answer_cb` is called
-        with the answer data, otherwise the function breaks early.
+    async def heartbeat(self) -> None:
+        """ Send a heartbeat
+
+        The messaging server evicts clients that have not been seen within its session TTL. This
+        lets the server know this client, and thus its offer, is still alive. Standby channels
+        have nothing on the server yet.
         """
-        # Check we should be polling for an answer
-        if self.answer_cb is None:
-            return None
+        if self.label is None:
+            return
+        try:
+            await self.messenger.request("POST", f"/heartbeat/{self.client_id}")
+        except requests.exceptions.RequestException as exc:
+            LOGGER.warning("Failed to send heartbeat: %s", str(exc))
+
+    async def withdraw(self) -> None:
+        """ Withdraw this client's offer and ICE candidates from the messaging server
 
+        Used when the session ends such that the offer does not linger until the server expires it.
+        Standby channels have nothing to withdraw.
+        """
+        if self.label is None:
+            return
+        LOGGER.info("Withdrawing WebRTC offer from %s", self.client_id)
+        self.answer_cb = None
+        self.ice_cb = None
         try:
-            response = requests.get(f"{self.host}/answer/{self.client_id}")
-            response.raise_for_status()
+            await self.messenger.request("POST", f"/withdraw/{self.client_id}")
+        except requests.exceptions.RequestException as exc:
+            LOGGER.warning("Failed to withdraw offer: %s", str(exc))
 
-            # Process response from server
-            data_packet = response.json()
-            answer = data_packet.get("answer", None)
-            self.remote_id = data_packet.get("answerer", None)
+    @property
+    def awaiting_answer(self) -> bool:
+        """ True while the answer to the sent offer is wanted """
+        return self.answer_cb is not None
 
-            # No answer found yet
-            if answer is None or self.remote_id is None:
-                return
+    @property
+    def awaiting_ice(self) -> bool:
+        """ True while ICE candidates of the answering client are wanted """
+        return self.remote_id is not None and self.ice_cb is not None
 
-            # Attempt to process valid answer
-            LOGGER.info(f"Received WebRTC answer from: %s", self.remote_id)
-            self.answer_cb(answer.get("sdp", None))
-            self.answer_cb = None
-        except Exception as exc:
-            LOGGER.warn("Failed to poll answer: %s", str(exc))
+    def handle_answer(self, data_packet: dict) -> None:
+        """ Process an answer data packet from the server
+
+        Records the answering client as the remote and passes the answer to the `answer_cb`.
+        Packets without an answer are ignored.
 
-    def poll_ice(self) -> None:
-        """ POLL for ICE candidate messages
+        Args:
+            data_packet: dictionary with 'answer' and 'answerer' fields
+        """
+        answer = data_packet.get("answer", None)
+        remote_id = data_packet.get("answerer", None)
+
+        # No answer found yet
+        if answer is None or remote_id is None or self.answer_cb is None:
+            return
+
+        # Attempt to process valid answer
+        LOGGER.info(f"Received WebRTC answer from: %s", remote_id)
+        self.remote_id = remote_id
+        answer_cb, self.answer_cb = self.answer_cb, None
+        answer_cb(answer.get("sdp", None))
+
+    def handle_ice(self, data_packet: dict) -> None:
+        """ Process an ICE data packet from the server
+
+        Advances the ICE cursor and passes each new candidate to the `ice_cb`. The server only
+        returns candidates after the cursor, so no filtering of previously seen messages is needed.
+
+        Args:
+            data_packet: dictionary with 'messages' and 'cursor' fields
+        """
+        if self.ice_cb is None:
+            return
+        ice_messages = data_packet.get("messages", [])
+        self.ice_cursor = data_packet.get("cursor", self.ice_cursor)
+        if ice_messages:
+            LOGGER.info("Received %d ICE candidate messages from %s", len(ice_messages),
+                        self.remote_id)
+        for ice_message in ice_messages:
+            index = ice_message.get("sdpMLineIndex", None)
+            candidate = ice_message.get("candidate", None)
+            if index is not None and candidate is not None:
+                self.ice_cb(index, candidate)
+
+
+class Messenger(object):
+    """ Object for controlling the REST-like API
+    
+    The side-channel REST-like API processing the following messages for each channel:
+
+    1. Send Offer: sends WebRTC offers to the REST-like messaging server
+    2. Send ICE: sends WebRTC ICE candidate messages to the REST-like messaging server
+    3. Poll for Answer: polls for WebRTC answers that come into the REST-like messaging server
+    4. Poll for ICE: polls for WebRTC ICE candidate messages that come into the server 
+    5. Heartbeat: keeps each channel's offer from expiring on the server
+    6. Withdraw: removes each channel's offer from the server when closed and on shutdown
+
+    Answers and candidates of every channel are requested with a single long-poll: the server holds
+    the request open until there is data to return, such that answers and candidates are handled as
+    soon as they are posted.
+
+    All requests share one pooled keep-alive HTTP session with bounded timeouts. Requests failing to
+    connect are retried with exponential backoff. The blocking HTTP calls run on worker threads such
+    that the event loop remains free.
+    """
+    def __init__(self, host: str, label: str="GStreamer") -> None:
+        """ Constructor for messaging
         
-        POLLs for ICE candidate messages from the remote client. If new messages were received,
-        then these messages are passed to the `ice_cb` function. Otherwise the function breaks
-        out early.
+        Initialize the messaging connection with given host and lable for remote client.
+
+        Args:
+            host: host url as a string
+            label: default label of the offered streams
+        """
+        self.host = host
+        self.label = label
+        self.base_id = f"{round(time.time() * 1000)}"
+        self.channel_ids = itertools.count()
+        self.channels = {}
+        self.last_heartbeat = time.monotonic()
+        self.refreshed = asyncio.Event()
+        # Worker futures of the latest long-poll and of the last one abandoned by a refresh
+        self.long_poll = None
+        self.abandoned = None
+        self.session = self.create_session()
+        self.executor = ThreadPoolExecutor(REQUEST_THREADS, thread_name_prefix="messenger")
+
+    @staticmethod
+    def create_session() -> requests.Session:
+        """ Create the pooled HTTP session used for all requests
+
+        Connections are kept alive and reused. Requests failing to connect never reached the server
+        and are retried with exponential backoff. Requests timing out or answered by a gateway error
+        may have been applied already, and are only retried for idempotent methods. The messaging
+        API's POSTs are not repeated, as some are not safe to repeat (e.g. /ice appends candidates).
+
+        Returns:
+            configured requests session
+        """
+        retry = Retry(
+            total=RETRY_COUNT,
+            read=1,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False
+        )
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=REQUEST_THREADS))
+        session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=REQUEST_THREADS))
+        return session
+
+    async def request(self, method: str, path: str, wait: float=0, **kwargs) -> requests.Response:
+        """ Make a request to the messaging server without blocking the event loop
+
+        Args:
+            method: HTTP method
+            path: path on the messaging server
+            wait: seconds the server may hold the request (long-poll), extends the timeout
+            **kwargs: further arguments for requests (e.g. json, params)
+
+        Returns:
+            response of a successful request
+
+        Raises:
+            requests.exceptions.RequestException: on failed requests and error statuses
         """
-        if self.remote_id is None or self.ice_cb is None:
+        call = functools.partial(self.session.request, method, f"{self.host}{path}",
+                                 timeout=(CONNECT_TIMEOUT, wait + REQUEST_TIMEOUT), **kwargs)
+        future = self.executor.submit(call)
+        if wait:
+            self.long_poll = future
+        response = await asyncio.wrap_future(future)
+        response.raise_for_status()
+        return response
+
+    def open_channel(self, label: str=None, standby: bool=False) -> Channel:
+        """ Open a new channel, i.e. a new client of the messaging server
+
+        Args:
+            label: label of the stream offered on the channel, defaults to the messenger's label
+            standby: hold the offer of the channel until it is bound to a label, see Channel.bind
+
+        Returns:
+            new channel with a unique client id
+        """
+        label = None if standby else (label or self.label)
+        channel = Channel(self, f"{self.base_id}-{next(self.channel_ids)}", label)
+        self.channels[channel.client_id] = channel
+        return channel
+
+    async def close_channel(self, channel: Channel) -> None:
+        """ Close a channel, withdrawing its offer from the server
+
+        Args:
+            channel: channel to close
+        """
+        if self.channels.pop(channel.client_id, None) is not None:
+            await channel.withdraw()
+
+    def refresh(self) -> None:
+        """ Restart any outstanding long-poll such that newly awaited answers are included """
+        self.refreshed.set()
+
+    async def heartbeat(self) -> None:
+        """ Send a heartbeat for each open channel """
+        self.last_heartbeat = time.monotonic()
+        await asyncio.gather(*(channel.heartbeat() for channel in list(self.channels.values())))
+
+    async def withdraw(self) -> None:
+        """ Close all channels, withdrawing their offers
+
+        Used on shutdown such that offers do not linger until the server expires them.
+        """
+        channels = list(self.channels.values())
+        await asyncio.gather(*(self.close_channel(channel) for channel in channels))
+
+    async def poll_batch(self, wait: float=0) -> None:
+        """ POLL for the answers and ICE candidate messages of all channels in one request
+
+        Uses the server's batch poll to request the answers of channels awaiting one and the remote
+        clients' ICE candidates of answered channels together. Answers are processed before
+        candidates such that the remote description is set before candidates are added.
+
+        Args:
+            wait: seconds the server may hold the request waiting for any new data (long-poll)
+        """
+        channels = list(self.channels.values())
+        answer_ids = [channel.client_id for channel in channels if channel.awaiting_answer]
+        ice_cursors = {
+            channel.remote_id: channel.ice_cursor for channel in channels if channel.awaiting_ice
+        }
+        if not answer_ids and not ice_cursors:
             return None
         try:
-            response = requests.get(f"{self.host}/ice/{self.remote_id}")
-            response.raise_for_status()
+            response = await self.request("POST", "/poll", wait, params={"wait": wait},
+                                          json={"answers": answer_ids, "ice": ice_cursors})
             data_packet = response.json()
-            ice_messages = data_packet.get("messages", [])
-            # Process the messages into tuples that are non-None and have not been received before
-            ice_messages = [
-                (ice_message.get("sdpMLineIndex", None), ice_message.get("candidate", None))
-                for ice_message in ice_messages
-            ]
-            ice_messages = [
-                (index, candidate)
-                for index, candidate in ice_messages
-                if index is not None and candidate is not None
-            ]
-            ice_messages = [
-                ice_tuple
-                for ice_tuple in ice_messages
-                if ice_tuple not in self.seen_candidates
-            ]
-
-            # Process new messages
-            if ice_messages:
-                LOGGER.info("Received %d ICE candidate messages from %s", len(ice_messages),
-                            self.remote_id)
-            for index, candidate in ice_messages:
-                self.ice_cb(index, candidate)
-                self.seen_candidates.add((index, candidate))
+            answers = data_packet.get("answers", {})
+            for channel in channels:
+                if channel.client_id in answers:
+                    channel.handle_answer(answers[channel.client_id])
+            ice = data_packet.get("ice", {})
+            for channel in channels:
+                if channel.remote_id in ice:
+                    channel.handle_ice(ice[channel.remote_id])
         except Exception as exc:
-            LOGGER.warn("Failed to poll ice: %s", str(exc))
+            LOGGER.warning("Failed to poll: %s", str(exc))
 
     async def poll(self):
         """ Repetitivly POLL for both ICE candidates and answers
         
-        Polls on a 1 second bases for answers and ICE candidates in that order.
+        Long-polls for the answers and ICE candidates of all channels using the server's batch poll.
+        When there is nothing to poll for, a short idle sleep is used instead. Heartbeats are
+        interleaved as needed. An outstanding long-poll is abandoned when a channel sends an offer,
+        as the poll was issued without it. Data is kept by the server, so nothing is lost. Bursts of
+        offers (e.g. at startup with many streams) restart the poll once.
+
+        An abandoned long-poll keeps its worker thread until the server answers it. So a long-poll
+        is only abandoned while no other abandoned one is still running, and otherwise runs to its
+        end, the next poll including the new offers. At most one worker is thus held by abandoned
+        polls, however often offers are sent.
         """
         while True:
-            await asyncio.sleep(1)
-            self.poll_answer()
-            self.poll_ice()
+            if time.monotonic() - self.last_heartbeat > HEARTBEAT_INTERVAL:
+                await self.heartbeat()
+            self.refreshed.clear()
+            if any(channel.awaiting_answer or channel.awaiting_ice
+                   for channel in self.channels.values()):
+                poll_task = asyncio.ensure_future(self.poll_batch(LONG_POLL_WAIT))
+                awaited = [poll_task]
+                if self.abandoned is None or self.abandoned.done():
+                    awaited.append(asyncio.ensure_future(self.refreshed.wait()))
+                try:
+                    await asyncio.wait(awaited, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in awaited:
+                        task.cancel()
+                if not poll_task.done() or poll_task.cancelled():
+                    self.abandoned = self.long_poll
+                if self.refreshed.is_set():
+                    await asyncio.sleep(REFRESH_DELAY)
+            else:
+                await asyncio.sleep(IDLE_POLL_INTERVAL)
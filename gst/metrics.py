@@ -0,0 +1,223 @@
+""" Collection of stream metrics reported to the messaging server
+
+Periodically gathers, for every stream hosted by the process: the `webrtcbin` statistics of each
+viewer (bytes and packets sent, packets lost, round-trip time and jitter from RTCP receiver
+reports), the number of frames encoded and the time they took to encode, the pipeline latency, the
+time-to-first-frame of newly connected viewers and the fill level of each queue. The metrics are
+POSTed to the messaging server, which exports those of all producers (see /metrics).
+
+Counters (bytes, packets, frames) are totals since the process started. They keep growing as
+viewers come and go.
+
+@author lestarch
+"""
+import asyncio
+import logging
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .messaging import Messenger
+from .pipeline import ENCODER_ELEMENT_NAME
+from .rtc import WebRTC
+from .session import SessionManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between metrics reports
+METRICS_INTERVAL = 5.0
+# Frames awaited from the encoder beyond which their start times are dropped, e.g. when the encoder
+# restamps frames
+ENCODING_LIMIT = 300
+
+
+class StreamMetrics(object):
+    """ Metrics of a single stream """
+    def __init__(self, sessions: SessionManager) -> None:
+        """ Construct the stream metrics, counting encoded frames from now on
+
+        Args:
+            sessions: session manager of the stream
+        """
+        self.sessions = sessions
+        self.frames_encoded = 0
+        # Times frames entered the encoder by timestamp, and encode times since the last report
+        self.encoding = {}
+        self.encode_times = []
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.packets_lost = 0
+        self.last_sent = {}
+        self.receivers = {}
+        self.encoder = sessions.pipeline.get_by_name(ENCODER_ELEMENT_NAME)
+        if self.encoder is not None:
+            self.encoder.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.start_frame)
+            self.encoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.count_frame)
+
+    def start_frame(self, _, info) -> Gst.PadProbeReturn:
+        """ Record the time a frame enters the encoder (streaming thread) """
+        if len(self.encoding) > ENCODING_LIMIT:
+            self.encoding.clear()
+        self.encoding[info.get_buffer().pts] = time.perf_counter()
+        return Gst.PadProbeReturn.OK
+
+    def count_frame(self, _, info) -> Gst.PadProbeReturn:
+        """ Count a frame leaving the encoder and the time it took (streaming thread) """
+        self.frames_encoded += 1
+        started = self.encoding.pop(info.get_buffer().pts, None)
+        if started is not None:
+            self.encode_times.append(time.perf_counter() - started)
+        return Gst.PadProbeReturn.OK
+
+    def encode_time(self) -> dict:
+        """ Median, 95th percentile and highest encode time (seconds) of the frames encoded since
+        the previous report, None without frames
+        """
+        times, self.encode_times = sorted(self.encode_times), []
+        if not times:
+            return {"encode_time_p50": None, "encode_time_p95": None, "encode_time_max": None}
+        return {
+            "encode_time_p50": times[len(times) // 2],
+            "encode_time_p95": times[int(len(times) * 0.95)],
+            "encode_time_max": times[-1]
+        }
+
+    def on_stats(self, rtc: WebRTC, stats: dict) -> None:
+        """ Accumulate the statistics of a viewer
+
+        Sent and lost counts are accumulated by their change since the viewer's previous statistics,
+        such that the totals do not drop when the viewer leaves.
+
+        Args:
+            rtc: WebRTC bridge of the viewer's session
+            stats: statistics by type, see WebRTC.request_stats
+        """
+        client_id = rtc.channel.client_id
+        senders = stats.get("outbound-rtp", [])
+        receivers = stats.get("remote-inbound-rtp", [])
+        sent = (
+            sum(sender.get("bytes-sent", 0) for sender in senders),
+            sum(sender.get("packets-sent", 0) for sender in senders),
+            sum(max(receiver.get("packets-lost", 0), 0) for receiver in receivers)
+        )
+        last = self.last_sent.get(client_id, (0, 0, 0))
+        self.bytes_sent += max(sent[0] - last[0], 0)
+        self.packets_sent += max(sent[1] - last[1], 0)
+        self.packets_lost += max(sent[2] - last[2], 0)
+        self.last_sent[client_id] = sent
+        if receivers:
+            self.receivers[client_id] = (
+                max(receiver.get("round-trip-time", 0.0) for receiver in receivers),
+                max(receiver.get("jitter", 0.0) for receiver in receivers)
+            )
+
+    def latency(self) -> float:
+        """ Minimum latency of the pipeline (seconds), None when it cannot be queried """
+        query = Gst.Query.new_latency()
+        if not self.sessions.pipeline.query(query):
+            return None
+        _, minimum, _ = query.parse_latency()
+        return minimum / Gst.SECOND
+
+    def time_to_first_frame(self) -> float:
+        """ Highest time-to-first-frame (seconds) of viewers connected since the previous report,
+        None when none connected
+        """
+        times, self.sessions.first_frame_times = self.sessions.first_frame_times, []
+        return max(times, default=None)
+
+    def queues(self) -> dict:
+        """ Fill level of each queue of the pipeline, by name, as buffers and seconds """
+        levels = {}
+        iterator = self.sessions.pipeline.iterate_recurse()
+        while True:
+            result, element = iterator.next()
+            if result == Gst.IteratorResult.RESYNC:
+                iterator.resync()
+                continue
+            if result != Gst.IteratorResult.OK:
+                break
+            factory = element.get_factory()
+            if factory is None or factory.get_name() != "queue":
+                continue
+            levels[element.get_name()] = {
+                "buffers": element.get_property("current-level-buffers"),
+                "seconds": element.get_property("current-level-time") / Gst.SECOND
+            }
+        return levels
+
+    def report(self) -> dict:
+        """ Metrics of the stream as sent to the messaging server """
+        for client_id in list(self.last_sent):
+            if client_id not in self.sessions.sessions:
+                del self.last_sent[client_id]
+                self.receivers.pop(client_id, None)
+        rtts = [rtt for rtt, _ in self.receivers.values()]
+        jitters = [jitter for _, jitter in self.receivers.values()]
+        return {
+            "viewers": sum(session.rtc.channel.remote_id is not None
+                           for session in self.sessions.sessions.values()),
+            "bytes_sent": self.bytes_sent,
+            "packets_sent": self.packets_sent,
+            "packets_lost": self.packets_lost,
+            "frames_encoded": self.frames_encoded if self.encoder is not None else None,
+            "encoder_bitrate": self.encoder.get_property("bitrate") * 1000
+                if self.encoder is not None else None,
+            "encoder_threads": self.encoder.get_property("threads")
+                if self.encoder is not None else None,
+            **self.encode_time(),
+            "rtt": max(rtts, default=None),
+            "jitter": max(jitters, default=None),
+            "latency": self.latency(),
+            "time_to_first_frame": self.time_to_first_frame(),
+            "queues": self.queues(),
+            "running": not self.sessions.stopped
+        }
+
+
+class MetricsCollector(object):
+    """ Collects the metrics of all streams of the process and reports them periodically
+
+    The collector runs in the asyncio loop. Statistics requested at one report are included in the
+    next.
+    """
+    def __init__(self, managers: list, messenger: Messenger) -> None:
+        """ Construct the collector
+
+        Args:
+            managers: session managers of the streams
+            messenger: messenger used to POST the metrics
+        """
+        self.streams = [StreamMetrics(sessions) for sessions in managers]
+        self.messenger = messenger
+
+    def add(self, sessions: SessionManager) -> None:
+        """ Collect the metrics of a stream started later, e.g. a bound standby stream
+
+        Args:
+            sessions: session manager of the stream
+        """
+        self.streams.append(StreamMetrics(sessions))
+
+    async def run(self) -> None:
+        """ Report the metrics of all streams, periodically """
+        while True:
+            for stream in self.streams:
+                for session in list(stream.sessions.sessions.values()):
+                    if session.rtc.channel.remote_id is not None:
+                        session.rtc.request_stats(stream.on_stats)
+            await asyncio.sleep(METRICS_INTERVAL)
+            await self.report()
+
+    async def report(self) -> None:
+        """ POST the metrics of all streams to the messaging server """
+        data_packet = {
+            "producer": self.messenger.base_id,
+            "streams": {stream.sessions.label: stream.report() for stream in self.streams}
+        }
+        try:
+            await self.messenger.request("POST", "/metrics", json=data_packet)
+        except Exception as exc:
+            LOGGER.warning("Failed to send metrics: %s", str(exc))
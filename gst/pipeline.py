@@ -1,8 +1,9 @@
 """ GStreamer pipeline functions
 
 Provides the functions and definitions used to setup the GStreamer pipeline. This pipeline consists
-of two streams (audio and video) that are packed into an RTP payload before being pushed into a
-webrpcbin element.
+of two streams (audio and video) that are packed into an RTP payload before being pushed into a tee.
+Each viewer is served by a `webrtcbin` element fed from this tee (see session.py), such that the
+stream is encoded once regardless of the number of viewers.
 
 @author lestarch
 """
@@ -12,27 +13,61 @@ from pathlib import Path
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-WEBRTC_ELEMENT_NAME = "webrtcsender"
-FILESRC_ELEMENT_NAME = "filesrc1"
-FILEQUEUE_ELEMENT_NAME = "fileq1"
-
-
-ENCODING_PIPELINE = '''
+RTP_TEE_ELEMENT_NAME = "rtptee"
+LOOPSRC_ELEMENT_NAME = "loopsrc1"
+ENCODER_ELEMENT_NAME = "vencoder"
+SCALE_CAPS_ELEMENT_NAME = "vscalecaps"
+# Encoder settings of live encodes and of the cached test clip (see testclip.py)
+ENCODER_SETTINGS = "tune=zerolatency speed-preset=ultrafast key-int-max=15"
+ENCODED_CAPS = "video/x-h264, profile=constrained-baseline"
+# Raw formats the encoder ingests without conversion, in order of preference. Only 4:2:0 formats
+# as the constrained-baseline profile needs
+ENCODER_FORMATS = ("I420", "NV12")
+TEST_CAPS = f"video/x-raw,format={ENCODER_FORMATS[0]},width=1920,height=1080"
+# Capture from driver buffers mapped into memory, pushed downstream without copying. Drivers and
+# encoders sharing dma-buf file descriptors may use "dmabuf" instead.
+DEVICE_ELEMENT = "v4l2src io-mode=mmap"
+DEVICE_CAPS = "framerate=15/1"
+# Captured from devices offering none of the ENCODER_FORMATS, converted for the encoder
+DEVICE_FALLBACK_FORMAT = "YUY2"
+PAYLOADER_SETTINGS = "aggregate-mode=zero-latency config-interval=-1"
+# Viewers are offered picture loss indication and full intra requests, answered with a keyframe
+RTP_CAPS = "application/x-rtp,media=video,encoding-name=H264,payload=96," \
+    "rtcp-fb-nack-pli=true,rtcp-fb-ccm-fir=true"
+# Low resolution rendition for thumbnail viewers (see session.py), offered as a second track
+LOW_RTP_TEE_ELEMENT_NAME = "rtptee_low"
+LOW_ENCODER_ELEMENT_NAME = "vencoder_low"
+LOW_RENDITION_CAPS = "video/x-raw,width=480,height=270,framerate=15/1"
+LOW_RENDITION_BITRATE = 300
+LOW_RTP_CAPS = RTP_CAPS.replace("payload=96", "payload=97")
+
+
+# The scaled caps and encoder bitrate are adjusted at runtime by the rate controller (see rate.py)
+ENCODING_PIPELINE = f'''
 queue name=vencoder_queue !
-x264enc tune=zerolatency speed-preset=ultrafast key-int-max=15 !
-    video/x-h264, profile=constrained-baseline ! payload_queue.
+videoscale !
+videorate drop-only=true !
+capsfilter name={SCALE_CAPS_ELEMENT_NAME} caps=video/x-raw !
+x264enc name={ENCODER_ELEMENT_NAME} {ENCODER_SETTINGS} !
+    {ENCODED_CAPS} ! payload_queue.
 '''
 
-TEST_PIPELINE = f'''
+# Raw video sources, linked to the encoder (see also builder.py). Devices are probed for their
+# formats, see device_source
+TEST_SOURCE = f'''
 videotestsrc is-live=true pattern=ball !
-    video/x-raw,width=1920,height=1080 !
-    videoconvert                       !
-    vencoder_queue.
+    {TEST_CAPS}
+'''
+
+TEST_PIPELINE = f'''
+{TEST_SOURCE} ! vencoder_queue.
 '''
 '''
 audiotestsrc is-live=true              !
@@ -41,12 +76,6 @@ audiotestsrc is-live=true              !
     aencoder_queue.
 '''
 
-DEVICE_PIPELINE = f'''
-v4l2src                                    !
-    video/x-raw,format=YUY2,framerate=15/1 !
-    videoconvert                           !
-    vencoder_queue.
-'''
 '''
 alsasrc device=hw:2,0 !
     audioconvert !
@@ -54,19 +83,36 @@ alsasrc device=hw:2,0 !
     aencoder_queue.
 '''
 
+# Fed with the file's access units from memory (see replay.py), paced to the clock by identity
+FILE_SOURCE = f'''
+appsrc name={LOOPSRC_ELEMENT_NAME} is-live=true format=time ! identity sync=true
+'''
 FILE_PIPELINE = f'''
-filesrc name={FILESRC_ELEMENT_NAME} location={{}} ! queue ! qtdemux ! payload_queue.
+{FILE_SOURCE} ! payload_queue.
+'''
+
+# Encodes the raw video of 'rawtee' a second time, at low resolution, into its own RTP tee
+LOW_RENDITION_PIPELINE = f'''
+rawtee. ! queue name=lowenc_queue leaky=2 max-size-buffers=2 !
+videoscale !
+videorate drop-only=true !
+{LOW_RENDITION_CAPS} !
+x264enc name={LOW_ENCODER_ELEMENT_NAME} {ENCODER_SETTINGS} bitrate={LOW_RENDITION_BITRATE} !
+    {ENCODED_CAPS} !
+queue !
+        h264parse !
+        rtph264pay {PAYLOADER_SETTINGS} !
+        {LOW_RTP_CAPS} !
+        tee name={LOW_RTP_TEE_ELEMENT_NAME} allow-not-linked=true
 '''
 
 
 BASE_PIPELINE_DESC = f'''
-webrtcbin name={WEBRTC_ELEMENT_NAME} latency=0
 queue name=payload_queue !
         h264parse !
-        rtph264pay aggregate-mode=zero-latency config-interval=-1 !
-        application/x-rtp,media=video,encoding-name=H264,payload=96 !
-        queue !
-        {WEBRTC_ELEMENT_NAME}.
+        rtph264pay {PAYLOADER_SETTINGS} !
+        {RTP_CAPS} !
+        tee name={RTP_TEE_ELEMENT_NAME} allow-not-linked=true
 '''
 
 '''
@@ -74,11 +120,63 @@ queue name=aencoder_queue !
         opusenc !
         rtpopuspay !
         queue ! application/x-rtp,media=audio,encoding-name=OPUS !
-        {WEBRTC_ELEMENT_NAME}.
+        {RTP_TEE_ELEMENT_NAME}.
 '''
 
 
-def setup_pipeline(stream_type:str, file:Path):
+def raw_source(source: str, video_format: str, caps: str="") -> str:
+    """ Pipeline fragment of a raw video source, converted only when the encoder needs it
+
+    Sources producing one of the ENCODER_FORMATS feed the encoder directly, without the copy and
+    per-pixel work of `videoconvert`. Others are converted to the preferred encoder format.
+
+    Args:
+        source: description of the source element
+        video_format: raw video format to capture
+        caps: further caps fields of the capture, comma separated
+
+    Returns:
+        pipeline fragment ending in raw video the encoder ingests
+    """
+    fields = f",{caps}" if caps else ""
+    fragment = f"{source} !\n    video/x-raw,format={video_format}{fields}"
+    if video_format not in ENCODER_FORMATS:
+        fragment += f" !\n    videoconvert ! video/x-raw,format={ENCODER_FORMATS[0]}"
+    return fragment
+
+
+def device_format(source: str=DEVICE_ELEMENT) -> str:
+    """ Raw video format to capture from a device, preferring the ENCODER_FORMATS
+
+    The device is opened briefly to query the formats it offers. Devices that cannot be opened
+    fall back to DEVICE_FALLBACK_FORMAT, failing as before once the pipeline starts.
+
+    Args:
+        source: description of the source element
+
+    Returns:
+        first of the ENCODER_FORMATS offered, DEVICE_FALLBACK_FORMAT otherwise
+    """
+    element = Gst.parse_launch(source)
+    if element.set_state(Gst.State.READY) == Gst.StateChangeReturn.FAILURE:
+        element.set_state(Gst.State.NULL)
+        return DEVICE_FALLBACK_FORMAT
+    offered = element.get_static_pad("src").query_caps(None)
+    element.set_state(Gst.State.NULL)
+    for video_format in ENCODER_FORMATS:
+        if offered.can_intersect(Gst.Caps.from_string(f"video/x-raw,format={video_format}")):
+            return video_format
+    LOGGER.info("Device offers none of %s, converting from %s", ", ".join(ENCODER_FORMATS),
+                DEVICE_FALLBACK_FORMAT)
+    return DEVICE_FALLBACK_FORMAT
+
+
+def device_source() -> str:
+    """ Pipeline fragment capturing the device in the format it shares with the encoder, if any """
+    return raw_source(DEVICE_ELEMENT, device_format(), DEVICE_CAPS)
+
+
+def setup_pipeline(stream_type:str, file:Path, renditions: bool=False):
     """ Setup the GStreamer pipline with given stream choice
     
     Initializes GSTreamer libraries, parses the pipleine with the chose source fragment, and
@@ -87,12 +185,19 @@ def setup_pipeline(stream_type:str, file:Path):
     Several pipelines can be chosen:
         1. Test Pipeline: uses test sources for a quick test of the system
         2. Device Pipeline: uses video4linux and alsa to pull in web cam settings
+        3. File Pipeline: replays a file from memory (see replay.py)
+        4. Cached Test Pipeline: replays a test clip encoded once (see testclip.py)
+
+    With renditions the raw video of test and device pipelines is also encoded as a low resolution
+    rendition, see LOW_RENDITION_PIPELINE.
 
     In order to ensure that WebRTC is configured before streamining, this function does not start
     the pipeline.
         
     Args:
-        stream_type: one of "device" or "test" for the pipeline source to use
+        stream_type: one of "device", "test", "file" or "test-cached" for the pipeline source
+        file: path of the file (unused, files are fed from memory by replay.py)
+        renditions: add the low resolution rendition, only for "test" and "device"
 
     Returns:
         initialized but on started pipeline
@@ -100,14 +205,40 @@ def setup_pipeline(stream_type:str, file:Path):
     Gst.init(None)
     LOGGER.debug("Initializing GStreamer (%d.%d) with stream type: %s", Gst.version().major,
                  Gst.version().minor, stream_type)
-    if stream_type == "test":
+    assert not renditions or stream_type in ("test", "device"), \
+        f"Renditions need a raw video source, not: {stream_type}"
+    if stream_type in ("test", "device") and renditions:
+        source = TEST_SOURCE if stream_type == "test" else device_source()
+        chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{ENCODING_PIPELINE}\n{LOW_RENDITION_PIPELINE}\n" \
+                          f"{source} ! tee name=rawtee ! vencoder_queue."
+    elif stream_type == "test":
         chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{ENCODING_PIPELINE}\n{TEST_PIPELINE}"
     elif stream_type == "device":
-        chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{ENCODING_PIPELINE}\n{DEVICE_PIPELINE}"
-    elif stream_type == "file":
-        chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{FILE_PIPELINE.format(file)}"
+        chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{ENCODING_PIPELINE}\n" \
+                          f"{device_source()} ! vencoder_queue."
+    elif stream_type in ("file", "test-cached"):
+        chosen_pipeline = f"{BASE_PIPELINE_DESC}\n{FILE_PIPELINE}"
     else:
         assert False, f"Invalid stream choice: {stream_type}"
     LOGGER.info("Running pipeline:\n%s", chosen_pipeline)
     pipeline = Gst.parse_launch(f"{chosen_pipeline}")
     return pipeline
+
+
+def request_keyframe(pipeline, tee_name: str=RTP_TEE_ELEMENT_NAME) -> bool:
+    """ Ask the pipeline's source of H.264 for a keyframe as soon as possible
+
+    The force-key-unit event travels upstream from the RTP tee as those of viewers' picture loss
+    indications do: to the encoder, or to the looping source of file pipelines (see replay.py).
+    The payloader sends the parameter sets ahead of the keyframe.
+
+    Args:
+        pipeline: pipeline as built by setup_pipeline
+        tee_name: RTP tee of the rendition needing the keyframe
+
+    Returns:
+        True when the request was handled upstream
+    """
+    tee = pipeline.get_by_name(tee_name)
+    event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+    return tee.get_static_pad("sink").get_peer().send_event(event)
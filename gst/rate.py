@@ -0,0 +1,178 @@
+""" Adaptive bitrate and resolution control
+
+The encoder of a stream is shared by all of its viewers (see session.py). This file periodically
+reads the statistics `webrtcbin` gathers from RTCP receiver reports of each viewer (loss, jitter and
+round-trip time), estimates the bandwidth available to the worst connected viewer, and adjusts the
+encoder bitrate accordingly. The encoded resolution and framerate follow the bitrate down (and back
+up) a ladder of renditions through a caps change, such that congested links degrade smoothly
+instead of building latency or freezing.
+
+The estimate is loss and delay based: heavy loss or round-trip times rising above the lowest seen
+(i.e. queues building along the path) back the bitrate off, while clean reports let it grow.
+
+@author lestarch
+"""
+import asyncio
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .pipeline import ENCODER_ELEMENT_NAME, SCALE_CAPS_ELEMENT_NAME
+from .rtc import WebRTC
+from .session import SessionManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Seconds between statistics requests and bitrate adjustments
+RATE_INTERVAL = 1.0
+# Encoder bitrate bounds and starting point (kbit/s)
+MIN_BITRATE = 150
+MAX_BITRATE = 6000
+START_BITRATE = 2500
+# Loss fraction above which the bitrate backs off in proportion, and below which it may grow
+LOSS_HIGH = 0.10
+LOSS_LOW = 0.02
+# Seconds of round-trip time above the lowest seen that are taken as queues building
+RTT_RISE = 0.1
+# Multiplicative back-off on rising round-trip time and growth on clean reports
+DELAY_BACKOFF = 0.85
+GROWTH = 1.08
+# Minimum relative change of the bitrate applied to the encoder
+APPLY_THRESHOLD = 0.05
+# Renditions as (minimum bitrate kbit/s, width, height, maximum framerate or None for the source's)
+LADDER = (
+    (2500, 1920, 1080, None),
+    (1200, 1280, 720, None),
+    (600, 960, 540, None),
+    (300, 640, 360, 15),
+    (0, 480, 270, 15),
+)
+# Factor by which the bitrate must exceed a higher rendition's minimum before switching up to it
+UPSWITCH_MARGIN = 1.25
+
+
+class RateController(object):
+    """ Adjusts the encoder of a stream to the bandwidth available to its viewers
+
+    The controller runs in the asyncio loop. Streams without an encoder (e.g. replayed files) are
+    not controlled.
+    """
+    def __init__(self, sessions: SessionManager) -> None:
+        """ Construct the rate controller
+
+        Args:
+            sessions: session manager of the stream, whose pipeline contains the named encoder
+        """
+        self.sessions = sessions
+        self.encoder = sessions.pipeline.get_by_name(ENCODER_ELEMENT_NAME)
+        self.scale_caps = sessions.pipeline.get_by_name(SCALE_CAPS_ELEMENT_NAME)
+        self.bitrate = START_BITRATE
+        self.applied_bitrate = None
+        self.rung = None
+        # Highest rendition allowed, lowered for streams downscaled to fit the CPU budget, bounding
+        # the bitrate too
+        self.top_rung = 0
+        self.reports = {}
+        self.min_rtt = {}
+
+    @property
+    def enabled(self) -> bool:
+        """ True when the stream has an encoder to control """
+        return self.encoder is not None and self.scale_caps is not None
+
+    @property
+    def max_bitrate(self) -> float:
+        """ Bitrate bound of the top rendition allowed, up to the next rendition's minimum """
+        return LADDER[self.top_rung - 1][0] if self.top_rung > 0 else MAX_BITRATE
+
+    async def run(self) -> None:
+        """ Request statistics of the connected viewers and adjust the encoder, periodically """
+        if not self.enabled:
+            return
+        self.bitrate = min(self.bitrate, self.max_bitrate)
+        self.apply()
+        while True:
+            await asyncio.sleep(RATE_INTERVAL)
+            self.adjust()
+            for session in list(self.sessions.sessions.values()):
+                if session.rtc.channel.remote_id is not None:
+                    session.rtc.request_stats(self.on_stats)
+
+    def on_stats(self, rtc: WebRTC, stats: dict) -> None:
+        """ Record the latest remote receiver statistics of a viewer
+
+        Args:
+            rtc: WebRTC bridge of the viewer's session
+            stats: statistics by type, see WebRTC.request_stats
+        """
+        client_id = rtc.channel.client_id
+        if client_id not in self.sessions.sessions:
+            self.min_rtt.pop(client_id, None)
+            return
+        receivers = stats.get("remote-inbound-rtp", [])
+        loss = max((receiver.get("fraction-lost", 0.0) for receiver in receivers), default=None)
+        rtt = max((receiver.get("round-trip-time", 0.0) for receiver in receivers), default=None)
+        if loss is None or rtt is None:
+            return
+        self.min_rtt[client_id] = min(self.min_rtt.get(client_id, rtt), rtt)
+        self.reports[client_id] = (loss, rtt - self.min_rtt[client_id])
+
+    def adjust(self) -> None:
+        """ Estimate the bitrate from the reports since the last adjustment and apply it
+
+        The worst viewer governs as all viewers share the encoder. Without reports the bitrate is
+        held.
+        """
+        reports, self.reports = self.reports, {}
+        for client_id in list(self.min_rtt):
+            if client_id not in self.sessions.sessions:
+                del self.min_rtt[client_id]
+        if not reports:
+            return
+        loss = max(loss for loss, _ in reports.values())
+        rtt_rise = max(rise for _, rise in reports.values())
+        if loss > LOSS_HIGH:
+            self.bitrate *= 1 - 0.5 * loss
+        elif rtt_rise > RTT_RISE:
+            self.bitrate *= DELAY_BACKOFF
+        elif loss < LOSS_LOW:
+            self.bitrate *= GROWTH
+        self.bitrate = min(max(self.bitrate, MIN_BITRATE), self.max_bitrate)
+        LOGGER.debug("Stream %s loss: %.3f rtt rise: %.3fs bitrate: %d kbit/s", self.sessions.label,
+                     loss, rtt_rise, self.bitrate)
+        self.apply()
+
+    def choose_rung(self) -> int:
+        """ Rendition for the current bitrate, switching up only with some margin and never above
+        the top rendition allowed
+
+        Returns:
+            index into LADDER
+        """
+        rung = next(index for index, (minimum, *_) in enumerate(LADDER) if self.bitrate >= minimum)
+        if self.rung is not None and rung < self.rung:
+            rung = next(
+                index for index, (minimum, *_) in enumerate(LADDER)
+                if self.bitrate >= minimum * UPSWITCH_MARGIN or index == self.rung
+            )
+        return max(rung, self.top_rung)
+
+    def apply(self) -> None:
+        """ Set the encoder bitrate and the scaled caps when they changed enough to matter """
+        if self.applied_bitrate is None or \
+                abs(self.bitrate - self.applied_bitrate) > APPLY_THRESHOLD * self.applied_bitrate:
+            self.applied_bitrate = self.bitrate
+            self.encoder.set_property("bitrate", int(self.bitrate))
+        rung = self.choose_rung()
+        if rung == self.rung:
+            return
+        _, width, height, framerate = LADDER[rung]
+        LOGGER.info("Stream %s switching to %dx%d at %d kbit/s", self.sessions.label, width, height,
+                    self.bitrate)
+        caps = f"video/x-raw,width={width},height={height}"
+        if framerate is not None:
+            caps += f",framerate=[1/1,{framerate}/1]"
+        self.scale_caps.set_property("caps", Gst.Caps.from_string(caps))
+        self.rung = rung
@@ -1,32 +1,348 @@
-from .pipeline import FILESRC_ELEMENT_NAME, FILEQUEUE_ELEMENT_NAME
+""" Gapless looping of file streams from memory
+
+The file is demuxed once, at startup, into the H.264 access units from its first keyframe to its
+end, held in memory. Each looping source (an `appsrc` in the file pipeline, see pipeline.py) then
+replays these access units endlessly, rewriting their timestamps by one clip period per loop, such
+that loops are seamless and keyframe aligned without seeking, flushing or reading the disk again.
+
+Access units are pushed as shallow copies sharing the clip's memory, so any number of streams can
+replay one clip.
+
+A file's keyframe interval may be long, and there is no encoder to produce a keyframe when a viewer
+connects or reports picture loss. Instead the last keyframe payloaded, preceded by the parameter
+sets the payloader sends with it, is kept as RTP packets (see KeyframeCache) and replayed into the
+branch of the single viewer needing it, restamped to fit in before its next frame. The other
+viewers are not affected.
+
+Force-key-unit requests still reaching the source itself replay it again from the last keyframe
+pushed, such that every viewer sees up to one GOP repeated. Such rewinds are rate limited.
+
+@author lestarch
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from pathlib import Path
+
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
+gi.require_version('GstRtp', '1.0')
+from gi.repository import GstRtp
+gi.require_version('GstVideo', '1.0')
+from gi.repository import GstVideo
+
+from .bridge import PipelineError
+from .pipeline import LOOPSRC_ELEMENT_NAME
+
+LOGGER = logging.getLogger(__name__)
+
+# Demuxes the H.264 video of a file into access units, the location is set on 'src'
+CLIP_PIPELINE_DESC = '''
+filesrc name=src ! qtdemux ! h264parse ! video/x-h264,alignment=au ! appsink name=sink sync=false
+'''
+# Seconds to wait for each access unit while demuxing a file
+CLIP_PULL_TIMEOUT = 10
+# Seconds between replays of the last keyframe to one viewer on its picture loss indications
+KEYFRAME_INTERVAL = 1.0
+# Seconds between rewinds of the looping source on force-key-unit requests reaching it
+REWIND_INTERVAL = 5.0
+# Range of RTP sequence numbers and timestamps
+RTP_SEQ_RANGE = 1 << 16
+RTP_TIMESTAMP_RANGE = 1 << 32
+
+
+class Clip(object):
+    """ H.264 access units of a file, in memory, from its first keyframe """
+    def __init__(self, caps, units: list, period: int) -> None:
+        """ Construct the clip
+
+        Args:
+            caps: caps of the access units
+            units: buffers of the access units, timestamped from zero
+            period: duration (nanoseconds) of one loop of the clip
+        """
+        self.caps = caps
+        self.units = units
+        self.period = period
+        self.keyframes = [index for index, unit in enumerate(units)
+                          if not unit.has_flags(Gst.BufferFlags.DELTA_UNIT)]
+
+    @staticmethod
+    def load(path: Path) -> "Clip":
+        """ Demux the video of a file into memory
+
+        Args:
+            path: path to the file
+
+        Returns:
+            clip of the file's video
+
+        Raises:
+            PipelineError: when the file cannot be demuxed or holds no keyframe
+        """
+        Gst.init(None)
+        pipeline = Gst.parse_launch(CLIP_PIPELINE_DESC)
+        pipeline.get_by_name("src").set_property("location", str(path))
+        sink = pipeline.get_by_name("sink")
+        pipeline.set_state(Gst.State.PLAYING)
+        caps = None
+        buffers = []
+        try:
+            while True:
+                sample = sink.emit("try-pull-sample", CLIP_PULL_TIMEOUT * Gst.SECOND)
+                if sample is None:
+                    break
+                caps = caps or sample.get_caps()
+                buffers.append(sample.get_buffer())
+            message = pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+            if message is not None:
+                error, _ = message.parse_error()
+                raise PipelineError(f"Failed to demux {path}: {error.message}")
+        finally:
+            pipeline.set_state(Gst.State.NULL)
+
+        keyframes = [index for index, buffer in enumerate(buffers)
+                     if not buffer.has_flags(Gst.BufferFlags.DELTA_UNIT)]
+        if not keyframes:
+            raise PipelineError(f"No H.264 keyframe in {path}")
+        buffers = buffers[keyframes[0]:]
+        base = min(Clip.decode_time(buffer) for buffer in buffers)
+        units = []
+        for buffer in buffers:
+            unit = buffer.copy()
+            unit.pts = buffer.pts - base
+            unit.dts = Clip.decode_time(buffer) - base
+            units.append(unit)
+        # The period runs to the end of the last access unit, estimated by the average spacing
+        spacing = units[-1].dts // max(len(units) - 1, 1)
+        last_duration = units[-1].duration if units[-1].duration != Gst.CLOCK_TIME_NONE else spacing
+        period = units[-1].dts + (last_duration or Gst.SECOND // 30)
+        LOGGER.info("Loaded %d access units (%.2fs) of %s in memory", len(units),
+                    period / Gst.SECOND, path)
+        return Clip(caps, units, period)
+
+    @staticmethod
+    def decode_time(buffer) -> int:
+        """ Decode timestamp of a buffer, its presentation timestamp when unset """
+        return buffer.dts if buffer.dts != Gst.CLOCK_TIME_NONE else buffer.pts
+
 
 class ReplayFile(object):
-    def __init__(self, pipeline):
-        """ Replay a file on EOS """
-        self.eos_count = 0
-        self.pipeline = pipeline
-
-        # Attach sink probe on file source
-        filesrc = pipeline.get_by_name(FILESRC_ELEMENT_NAME)
-        sink_pad = filesrc.get_static_pad("src")
-        sink_pad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.event)
-
-    def event(self, pad, info):
-        """ Process an event """
-        event_type = info.get_event().type
-        print("Event: ", event_type)
-        if event_type != Gst.EventType.EOS:
+    """ Replays a clip endlessly into the looping source of a pipeline """
+    def __init__(self, pipeline, clip: Clip) -> None:
+        """ Attach to the pipeline's looping source
+
+        Args:
+            pipeline: file pipeline as built by setup_pipeline
+            clip: clip to replay
+        """
+        self.clip = clip
+        self.index = 0
+        self.loops = 0
+        # Running time (nanoseconds) of the first access unit, non-zero when started mid-stream
+        self.start = 0
+        # Shift (nanoseconds) of the clip's timestamps, grown by each loop and keyframe jump
+        self.shift = 0
+        self.keyframe_requested = False
+        self.last_rewind = None
+        self.appsrc = pipeline.get_by_name(LOOPSRC_ELEMENT_NAME)
+        self.appsrc.set_property("caps", clip.caps)
+        self.appsrc.connect("need-data", self.on_need_data)
+        self.appsrc.get_static_pad("src").add_probe(Gst.PadProbeType.EVENT_UPSTREAM,
+                                                    self.on_upstream_event)
+
+    def on_upstream_event(self, _, info) -> Gst.PadProbeReturn:
+        """ Note force-key-unit requests, the next access unit pushed is then a keyframe, at most
+        once per REWIND_INTERVAL as every viewer sees the rewind
+        """
+        if not GstVideo.video_event_is_force_key_unit(info.get_event()):
             return Gst.PadProbeReturn.OK
-        self.eos_count += 1
-        if self.eos_count > 1:
-            print("EOS Count: ", self.eos_count, " - Restarting")
-            self.pipeline.set_state(Gst.State.PAUSED)
-            self.pipeline.seek(1.0, Gst.Format.TIME,
-                Gst.SeekFlags.KEY_UNIT | Gst.SeekFlags.FLUSH,
-                Gst.SeekType.SET, 0.0 , Gst.SeekType.NONE, -1)
-            self.pipeline.set_state(Gst.State.PLAYING)
-            return Gst.PadProbeReturn.DROP
+        now = time.monotonic()
+        if self.last_rewind is None or now - self.last_rewind >= REWIND_INTERVAL:
+            self.last_rewind = now
+            self.keyframe_requested = True
+        return Gst.PadProbeReturn.DROP
+
+    def rewind_to_keyframe(self) -> None:
+        """ Continue from the last keyframe pushed, shifting timestamps to keep them increasing """
+        keyframe = self.clip.keyframes[bisect.bisect_right(self.clip.keyframes, self.index) - 1]
+        if keyframe == self.index:
+            return
+        self.shift += self.clip.units[self.index].dts - self.clip.units[keyframe].dts
+        LOGGER.debug("Keyframe requested, replaying from access unit %d", keyframe)
+        self.index = keyframe
+
+    def on_need_data(self, appsrc, _) -> None:
+        """ Push the next access unit, restamped for the current loop (streaming thread) """
+        if self.keyframe_requested:
+            self.keyframe_requested = False
+            self.rewind_to_keyframe()
+        unit = self.clip.units[self.index]
+        offset = self.start + self.shift
+        buffer = unit.copy()
+        buffer.pts = unit.pts + offset
+        buffer.dts = unit.dts + offset
+        if self.index != 0 or self.loops != 0:
+            buffer.unset_flags(Gst.BufferFlags.DISCONT)
+        appsrc.emit("push-buffer", buffer)
+        self.index += 1
+        if self.index == len(self.clip.units):
+            self.index = 0
+            self.loops += 1
+            self.shift += self.clip.period
+            LOGGER.debug("File loop %d starting", self.loops)
+
+
+def packets_of(info) -> list:
+    """ Buffers of a probed buffer or buffer list """
+    if info.type & Gst.PadProbeType.BUFFER:
+        return [info.get_buffer()]
+    packets = info.get_buffer_list()
+    return [packets.get(index) for index in range(packets.length())]
+
+
+def rtp_header(packet) -> tuple:
+    """ Sequence number, timestamp and marker bit of an RTP packet """
+    _, rtp = GstRtp.RTPBuffer.map(packet, Gst.MapFlags.READ)
+    try:
+        return rtp.get_seq(), rtp.get_timestamp(), rtp.get_marker()
+    finally:
+        rtp.unmap()
+
+
+def restamp(packet, seq: int, timestamp: int=None, pts: int=None):
+    """ Copy of an RTP packet with a new sequence number, and optionally RTP timestamp and PTS """
+    packet = packet.copy_deep()
+    _, rtp = GstRtp.RTPBuffer.map(packet, Gst.MapFlags.WRITE)
+    try:
+        rtp.set_seq(seq % RTP_SEQ_RANGE)
+        if timestamp is not None:
+            rtp.set_timestamp(timestamp % RTP_TIMESTAMP_RANGE)
+    finally:
+        rtp.unmap()
+    if pts is not None:
+        packet.pts = pts
+    return packet
+
+
+class ViewerKeyframes(object):
+    """ Keyframe requests of a single viewer's branch and the shift of its sequence numbers """
+    def __init__(self) -> None:
+        """ Construct the state of a viewer that has not requested a keyframe yet """
+        self.requested = False
+        self.sent = None
+        # Packets inserted into the branch so far, by which later sequence numbers are shifted
+        self.shift = 0
+        # The next packet starts a frame, i.e. the previous one carried the marker bit
+        self.frame_start = False
+
+    def request(self) -> None:
+        """ Replay the last keyframe to the viewer before its next frame """
+        self.requested = True
+
+
+class KeyframeCache(object):
+    """ Last keyframe of a replayed stream, as RTP packets, replayed to single viewers on request
+
+    The packets of the last keyframe payloaded, parameter sets included, are kept from the RTP tee.
+    A viewer's branch (see session.py) is attached by its tee pad. Its force-key-unit requests are
+    then answered here instead of travelling upstream to the shared source: before the viewer's
+    next frame, the kept packets are inserted into its branch, restamped just ahead of that frame.
+    As packets are inserted, the sequence numbers of all later packets of the branch are shifted,
+    such that the viewer sees no gap or repeat. Picture loss indications are answered at most once
+    per KEYFRAME_INTERVAL.
+    """
+    def __init__(self, tee) -> None:
+        """ Keep the keyframes payloaded into the RTP tee
+
+        Args:
+            tee: RTP tee of the stream
+        """
+        self.lock = threading.Lock()
+        self.keyframe = []
+        self.partial = []
+        self.partial_timestamp = None
+        tee.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                                             self.on_packets)
+
+    def on_packets(self, _, info) -> Gst.PadProbeReturn:
+        """ Collect the packets of keyframes, keeping each once complete (streaming thread)
+
+        The parameter sets the payloader sends ahead of a keyframe share its RTP timestamp, and its
+        last packet carries the marker bit.
+        """
+        for packet in packets_of(info):
+            if packet.has_flags(Gst.BufferFlags.DELTA_UNIT):
+                continue
+            _, timestamp, marker = rtp_header(packet)
+            if timestamp != self.partial_timestamp:
+                self.partial, self.partial_timestamp = [], timestamp
+            self.partial.append(packet)
+            if marker:
+                with self.lock:
+                    self.keyframe = self.partial
+                self.partial, self.partial_timestamp = [], None
         return Gst.PadProbeReturn.OK
+
+    def attach(self, pad) -> ViewerKeyframes:
+        """ Serve the keyframe requests of the viewer fed by a pad of the RTP tee
+
+        Args:
+            pad: request pad of the RTP tee feeding the viewer's branch
+
+        Returns:
+            keyframe state of the viewer, to request keyframes on its connection
+        """
+        viewer = ViewerKeyframes()
+        pad.add_probe(Gst.PadProbeType.EVENT_UPSTREAM, functools.partial(self.on_request, viewer))
+        pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                      functools.partial(self.on_viewer_packets, viewer))
+        return viewer
+
+    @staticmethod
+    def on_request(viewer: ViewerKeyframes, _, info) -> Gst.PadProbeReturn:
+        """ Take a viewer's force-key-unit request off its way upstream, noting it when not
+        answered within KEYFRAME_INTERVAL already
+        """
+        if not GstVideo.video_event_is_force_key_unit(info.get_event()):
+            return Gst.PadProbeReturn.OK
+        if viewer.sent is None or time.monotonic() - viewer.sent >= KEYFRAME_INTERVAL:
+            viewer.request()
+        return Gst.PadProbeReturn.DROP
+
+    def on_viewer_packets(self, viewer: ViewerKeyframes, pad, info) -> Gst.PadProbeReturn:
+        """ Insert the kept keyframe ahead of the frame requested, shifting sequence numbers from
+        then on (streaming thread)
+
+        Once shifted, the restamped packets are pushed on to the branch here and the originals,
+        shared with the other viewers, are dropped.
+        """
+        packets = packets_of(info)
+        inserted = []
+        if viewer.requested:
+            with self.lock:
+                keyframe = self.keyframe
+            if viewer.frame_start and keyframe:
+                seq, timestamp, _ = rtp_header(packets[0])
+                # One tick ahead of the frame the keyframe is inserted before
+                inserted = [
+                    restamp(packet, seq + viewer.shift + index, timestamp - 1, packets[0].pts)
+                    for index, packet in enumerate(keyframe)
+                ]
+                viewer.shift += len(inserted)
+                viewer.requested = False
+                viewer.sent = time.monotonic()
+            else:
+                viewer.frame_start = rtp_header(packets[-1])[2]
+        if not viewer.shift:
+            return Gst.PadProbeReturn.OK
+        shifted = Gst.BufferList.new()
+        for packet in inserted:
+            shifted.insert(-1, packet)
+        for packet in packets:
+            shifted.insert(-1, restamp(packet, rtp_header(packet)[0] + viewer.shift))
+        pad.get_peer().chain_list(shifted)
+        return Gst.PadProbeReturn.DROP
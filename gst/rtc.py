@@ -1,11 +1,13 @@
 """ Handles WebRTC processing functions
 
 Links the GStreamer WebRTC implementation to the REST-like messanger side channel through the
-defined WebRTC object.
+defined WebRTC object. Signals from `webrtcbin` arrive on GStreamer threads and hand any messaging
+work to the asyncio loop via the EventBridge, such that these threads never wait on the network.
 
 @author lestarch
 """
 import logging
+from typing import Callable
 
 
 import gi
@@ -16,8 +18,9 @@ from gi.repository import GstWebRTC
 gi.require_version('GstSdp', '1.0')
 from gi.repository import GstSdp
 
-from .messaging import Messenger
-from .pipeline import WEBRTC_ELEMENT_NAME
+from .bridge import EventBridge
+from .messaging import Channel
+from .telemetry import TelemetrySender
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,29 +29,48 @@ class WebRTC(object):
     """ WebRTC to messaging channel bridge object
     
     WebRTC requires a side-channel for passing offers, answers, and ICE candidate connections
-    between WebRTC clients. This object bridges the GStreamer `webrtcbin` element to the 
-    messanger's REST-like interface for WebRTC messages. This is done by attaching GStreamer
+    between WebRTC clients. This object bridges a GStreamer `webrtcbin` element to a messaging
+    channel of the REST-like interface for WebRTC messages. This is done by attaching GStreamer
     events to local functions, and handling POLLing callbacks.
     """
-    def __init__(self, pipeline, messenger: Messenger):
+    def __init__(self, webrtc, channel: Channel, bridge: EventBridge,
+                 answered_cb: Callable=None, closed_cb: Callable=None, connected_cb: Callable=None,
+                 control_cb: Callable=None, telemetry: bool=False):
         """ Construct the WebRTC bridge object
         
-        Constructs the WebRTC bridge object between the given GStreamer pipeline and the given
-        messanger object. This also registers two event handlers: 'on-negotiation-needed' that
+        Constructs the WebRTC bridge object between the given `webrtcbin` element and the given
+        messaging channel. This also registers two event handlers: 'on-negotiation-needed' that
         triggers the start of the WebRTC offer exchange, and 'on-ice-candidate' that triggers
         when a new ICE candidate mssage needs to be handled.
 
         Args:
-            pipeline: GStreamer pipeline object containing a properly named `webrtcbin` element
-            messenger: REST-like messaging API handler
+            webrtc: GStreamer `webrtcbin` element
+            channel: REST-like messaging channel of this WebRTC session
+            bridge: event bridge running messaging work in the asyncio loop
+            answered_cb: called with this object (asyncio loop) once the offer is answered
+            closed_cb: called with this object (asyncio loop) once the connection failed or closed
+            connected_cb: called with this object (asyncio loop) once the connection is established
+            control_cb: called with this object and each message (asyncio loop) received from the
+                        remote on the 'control' data channel, offered only when supplied
+            telemetry: offer a 'telemetry' data channel, see telemetry.py
         """
-        self.webrtc = pipeline.get_by_name(WEBRTC_ELEMENT_NAME)
+        self.webrtc = webrtc
         self.offer_message = None
         self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
         self.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
         self.webrtc.connect('on-new-transceiver', self.on_new_transceiver)
         self.webrtc.connect('on-data-channel', self.on_data_channel)
-        self.messenger = messenger
+        self.webrtc.connect('notify::connection-state', self.on_connection_state)
+        self.channel = channel
+        self.bridge = bridge
+        self.answered_cb = answered_cb
+        self.closed_cb = closed_cb
+        self.connected_cb = connected_cb
+        self.control_cb = control_cb
+        self.control_channel = None
+        self.telemetry_requested = telemetry
+        self.telemetry = None
+        self.offer_requested = False
 
     def on_negotiation_needed(self, element) -> None:
         """ Produce an offer in response to a negotiation needed event
@@ -59,6 +81,16 @@ class WebRTC(object):
         Args:
             element: webrtc gstreamer element
         """
+        # Sessions are negotiated once, later requests (e.g. for the data channel) are ignored
+        if self.offer_requested:
+            return
+        self.offer_requested = True
+        if self.control_cb is not None:
+            self.control_channel = element.emit('create-data-channel', 'control', None)
+            self.control_channel.connect('on-message-string', self.on_control_message)
+        if self.telemetry_requested:
+            self.telemetry = TelemetrySender(element.emit('create-data-channel', 'telemetry', None),
+                                             self.bridge)
         LOGGER.debug("Starting WebRTC negotiations")
         promise = Gst.Promise.new_with_change_func(self.on_offer_created, element, None)
         element.emit('create-offer', None, promise)
@@ -66,22 +98,22 @@ class WebRTC(object):
     def on_offer_created(self, promise, _, __) -> None:
         """ Transmit offer via side channel
         
-        Wait for the supplied promise to be completed, then send the resultant offer to the remote
-        client using the messenger. The offer is also set as the WebRTC local description.
+        Called once the supplied promise is completed. The resultant offer is set as the WebRTC
+        local description and handed to the asyncio loop to be sent to the remote client.
 
         Args:
             promise: promise whose reply will contain the offer
             _: unused
             __: also unused
         """
-        promise.wait()
         LOGGER.debug("Creating WebRTC offer")
         reply = promise.get_reply()  # MUST be a separate variable to keep data alive
         offer = reply.get_value("offer")
         promise = Gst.Promise.new()
         self.webrtc.emit('set-local-description', offer, promise)
         promise.interrupt() # Don't wait up for this promise
-        self.messenger.send_offer(offer, self.on_answer, self.on_ice_received)
+        self.bridge.submit(self.channel.send_offer, offer.sdp.as_text(), self.on_answer,
+                           self.on_ice_received)
 
     def on_answer(self, answer_text: str) -> None:
         """ Receive an answer via side channel
@@ -100,6 +132,8 @@ class WebRTC(object):
         promise = Gst.Promise.new()
         self.webrtc.emit('set-remote-description', answer, promise)
         promise.interrupt() # Don't wait up for this promise
+        if self.answered_cb is not None:
+            self.answered_cb(self)
 
     def on_ice_received(self, sdpMLineIndex: int, candidate: str) -> None:
         """ Receive an ICE message
@@ -119,17 +153,91 @@ class WebRTC(object):
         """ Send ICE candidate message to messaging server
         
         Sends ICE candidate message produced locally to the REST-like messaging server to be polled
-        by the remote candidate.
+        by the remote candidate. The message is handed to the asyncio loop to be sent.
 
         Args:
             _: unused
             index: line index of candidate
             candidate: ICE candidate message
         """
-        self.messenger.send_ice(index, candidate)
+        self.bridge.submit(self.channel.send_ice, index, candidate)
 
-    def on_new_transceiver(self, _, __, ___):
-        LOGGER.warning("----- On NEW TRANSCEIVER -----")
+    def on_control_message(self, _, message: str) -> None:
+        """ Hand a message of the 'control' data channel to the asyncio loop (GStreamer thread)
 
-    def on_data_channel(self, _, __, ___):
-        LOGGER.warning("----- On DATA CHANNEL-----")
+        Args:
+            _: unused data channel
+            message: message text
+        """
+        self.bridge.submit(self.control_cb, self, message)
+
+    def on_connection_state(self, element, _) -> None:
+        """ Report an established peer connection via `connected_cb`, a failed or closed one via
+        `closed_cb`
+
+        Args:
+            element: webrtc gstreamer element
+            _: unused property specification
+        """
+        state = element.get_property("connection-state")
+        LOGGER.info("WebRTC connection of %s is %s", self.channel.client_id, state.value_nick)
+        if self.connected_cb is not None and \
+                state == GstWebRTC.WebRTCPeerConnectionState.CONNECTED:
+            self.bridge.submit(self.connected_cb, self)
+        if self.closed_cb is not None and state in (GstWebRTC.WebRTCPeerConnectionState.FAILED,
+                                                    GstWebRTC.WebRTCPeerConnectionState.CLOSED):
+            self.bridge.submit(self.closed_cb, self)
+
+    def request_stats(self, stats_cb: Callable) -> None:
+        """ Request the statistics gathered by `webrtcbin`, including those of RTCP reports
+
+        The statistics are passed, in the asyncio loop, to `stats_cb` along with this object. They
+        are grouped by statistic type (e.g. 'outbound-rtp', 'remote-inbound-rtp' for the remote
+        receiver) into lists of dictionaries of the statistic fields.
+
+        Args:
+            stats_cb: callback called with this object and the dictionary of statistics by type
+        """
+        promise = Gst.Promise.new_with_change_func(self.on_stats, stats_cb)
+        self.webrtc.emit('get-stats', None, promise)
+
+    def on_stats(self, promise, stats_cb: Callable) -> None:
+        """ Collect the statistics from a completed `get-stats` promise
+
+        Args:
+            promise: promise whose reply contains a structure per statistic set
+            stats_cb: callback to hand the statistics to
+        """
+        reply = promise.get_reply()
+        if reply is None:
+            return
+        by_type = {}
+        for index in range(reply.n_fields()):
+            stats = reply.get_value(reply.nth_field_name(index))
+            if not isinstance(stats, Gst.Structure) or not stats.has_field("type"):
+                continue
+            by_type.setdefault(stats.get_value("type").value_nick, []).append({
+                stats.nth_field_name(field): stats.get_value(stats.nth_field_name(field))
+                for field in range(stats.n_fields())
+            })
+        self.bridge.submit(stats_cb, self, by_type)
+
+    def on_new_transceiver(self, _, transceiver) -> None:
+        """ Log a transceiver added for a linked stream
+
+        Args:
+            _: unused webrtc gstreamer element
+            transceiver: new transceiver
+        """
+        LOGGER.debug("New transceiver %d of %s", transceiver.get_property("mlineindex"),
+                     self.channel.client_id)
+
+    def on_data_channel(self, _, data_channel) -> None:
+        """ Log a data channel opened by the remote, which is not used by this application
+
+        Args:
+            _: unused webrtc gstreamer element
+            data_channel: data channel opened by the remote
+        """
+        LOGGER.info("Ignoring data channel '%s' opened by the viewer of %s",
+                    data_channel.get_property("label"), self.channel.client_id)
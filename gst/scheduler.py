@@ -0,0 +1,183 @@
+""" CPU-aware placement of the encoders of the streams hosted by the process
+
+Left alone, the encoders of many streams (e.g. -c 40) each start as many threads as there are cores
+and the OS scatters them across all cores, such that they contend and pace frames unevenly. With
+`--schedule` the cost of each stream's encode is estimated from its pixel rate (width, height and
+frame rate) against CORE_PIXEL_RATE, and the streams are placed within the CPU budget:
+
+    - streams are given disjoint sets of cores while there are at least as many cores as streams,
+      encoding with one sliced thread per core of their set
+    - otherwise each stream is given a single core, shared round-robin, encoding with one thread
+    - when the budget is exceeded, streams are either downscaled down the rate controller's LADDER
+      until they fit, or the streams beyond the budget are refused
+
+The thread feeding each encoder (that of its queue) is pinned to the stream's cores before the
+encoder is opened, such that the encoder's own threads inherit the placement. The time each frame
+spends in the encoder is reported with the stream's metrics (see metrics.py) to verify placement.
+
+@author lestarch
+"""
+import logging
+import os
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .pipeline import ENCODER_ELEMENT_NAME, LOW_ENCODER_ELEMENT_NAME
+from .rate import LADDER
+
+LOGGER = logging.getLogger(__name__)
+
+# Pixels per second one core encodes with ENCODER_SETTINGS, measure with bench.loopback
+CORE_PIXEL_RATE = 1920 * 1080 * 30
+# Fraction of the cores given to encoders, the rest is left to payloading, WebRTC and signaling
+CORE_BUDGET = 0.8
+# Width, height and frame rate of the raw video of each stream type (see pipeline.py), others are
+# taken as 1080p at 30 fps
+SOURCE_FORMATS = {"test": (1920, 1080, 30), "device": (1920, 1080, 15)}
+DEFAULT_SOURCE_FORMAT = (1920, 1080, 30)
+# Width, height and frame rate of the low resolution rendition, see LOW_RENDITION_CAPS
+LOW_RENDITION_FORMAT = (480, 270, 15)
+# Queues whose threads feed the encoders, by encoder name
+ENCODER_QUEUES = {ENCODER_ELEMENT_NAME: "vencoder_queue", LOW_ENCODER_ELEMENT_NAME: "lowenc_queue"}
+# Policies for streams exceeding the budget
+POLICIES = ("downscale", "refuse")
+
+
+def parse_cpus(text: str) -> list:
+    """ Parse a CPU list such as '0-3,8,10-11'
+
+    Args:
+        text: comma separated CPU numbers and inclusive ranges
+
+    Returns:
+        sorted CPU numbers
+
+    Raises:
+        ValueError: on malformed lists
+    """
+    cpus = set()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return sorted(cpus)
+
+
+def format_cpus(cpus: list) -> str:
+    """ Format CPU numbers as a CPU list, the inverse of parse_cpus """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{first}-{last}" if first != last else f"{first}" for first, last in ranges)
+
+
+def encode_cost(width: int, height: int, framerate: int) -> float:
+    """ Cores needed to encode raw video of the given format """
+    return width * height * framerate / CORE_PIXEL_RATE
+
+
+class Placement(object):
+    """ Cores, threading and top rendition of a stream's encoders """
+    def __init__(self, label: str, cpus: list, rung: int, cost: float) -> None:
+        """ Construct the placement
+
+        Args:
+            label: label of the stream
+            cpus: cores the stream's encoders run on
+            rung: highest rendition of the rate controller's LADDER the stream may use
+            cost: estimated cores used by the stream at that rendition
+        """
+        self.label = label
+        self.cpus = cpus
+        self.rung = rung
+        self.cost = cost
+
+    @property
+    def threads(self) -> int:
+        """ Encoder threads, one per core """
+        return len(self.cpus)
+
+    def apply(self, pipeline) -> None:
+        """ Set the encoders' threading and pin the threads feeding them, before the pipeline runs
+
+        Args:
+            pipeline: pipeline of the stream, not yet started
+        """
+        for encoder_name, queue_name in ENCODER_QUEUES.items():
+            encoder = pipeline.get_by_name(encoder_name)
+            queue = pipeline.get_by_name(queue_name)
+            if encoder is None or queue is None:
+                continue
+            # The main encoder gets the stream's cores, the low rendition is cheap enough for one
+            threads = self.threads if encoder_name == ENCODER_ELEMENT_NAME else 1
+            encoder.set_property("threads", threads)
+            encoder.set_property("sliced-threads", threads > 1)
+            queue.get_static_pad("src").add_probe(Gst.PadProbeType.DATA_DOWNSTREAM, self.pin)
+
+    def pin(self, _, __) -> Gst.PadProbeReturn:
+        """ Pin the calling streaming thread to the stream's cores, once (streaming thread) """
+        os.sched_setaffinity(0, self.cpus)
+        return Gst.PadProbeReturn.REMOVE
+
+
+def source_rungs(width: int, height: int) -> list:
+    """ Indices of the LADDER renditions no larger than the source, highest first """
+    rungs = [index for index, (_, rung_width, rung_height, _) in enumerate(LADDER)
+             if rung_width <= width and rung_height <= height]
+    return rungs or [len(LADDER) - 1]
+
+
+def rung_cost(rung: int, framerate: int, renditions: bool) -> float:
+    """ Cores needed to encode a stream at a rendition of the LADDER, with its low rendition """
+    _, width, height, rung_framerate = LADDER[rung]
+    cost = encode_cost(width, height, min(framerate, rung_framerate or framerate))
+    return cost + (encode_cost(*LOW_RENDITION_FORMAT) if renditions else 0)
+
+
+def plan(labels: list, stream_type: str, cpus: list, policy: str="downscale",
+         renditions: bool=False) -> list:
+    """ Place the streams on the given cores within the CPU budget
+
+    Args:
+        labels: labels of the streams
+        stream_type: stream type of all streams, see SOURCE_FORMATS
+        cpus: cores available to the streams
+        policy: one of POLICIES, applied when the budget is exceeded
+        renditions: streams also encode the low resolution rendition
+
+    Returns:
+        placements of the accepted streams, in the order of their labels
+    """
+    assert policy in POLICIES, f"Invalid policy: {policy}"
+    width, height, framerate = SOURCE_FORMATS.get(stream_type, DEFAULT_SOURCE_FORMAT)
+    budget = len(cpus) * CORE_BUDGET
+    rungs = source_rungs(width, height)
+    rung = rungs[0]
+    if policy == "downscale":
+        rung = next((rung for rung in rungs
+                     if rung_cost(rung, framerate, renditions) * len(labels) <= budget), rungs[-1])
+    cost = rung_cost(rung, framerate, renditions)
+    accepted = min(len(labels), max(int(budget // cost), 1))
+    if accepted < len(labels):
+        LOGGER.error("Refusing %d streams from %s on: %d streams of %.2f cores each exceed the "
+                     "budget of %.1f cores", len(labels) - accepted, labels[accepted], len(labels),
+                     cost, budget)
+    if rung != rungs[0]:
+        _, rung_width, rung_height, _ = LADDER[rung]
+        LOGGER.warning("Downscaling streams to %dx%d to fit %d streams into %.1f cores",
+                       rung_width, rung_height, accepted, budget)
+    per_stream = max(len(cpus) // accepted, 1)
+    placements = []
+    for index, label in enumerate(labels[:accepted]):
+        if accepted <= len(cpus):
+            stream_cpus = cpus[index * per_stream:(index + 1) * per_stream]
+        else:
+            stream_cpus = [cpus[index % len(cpus)]]
+        placements.append(Placement(label, stream_cpus, rung, cost))
+        LOGGER.info("Stream %s placed on cores %s, encoder threads: %d, estimated cores: %.2f",
+                    label, format_cpus(stream_cpus), len(stream_cpus), cost)
+    return placements
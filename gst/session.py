@@ -0,0 +1,364 @@
+""" Manages the WebRTC sessions of concurrent viewers
+
+The pipeline encodes and payloads the stream once into a tee. Each viewer is served by a session: a
+queue and `webrtcbin` element fed from that tee, negotiated through its own messaging channel. One
+session is kept open (offered, awaiting an answer) at all times. When it is answered a new one is
+opened for the next viewer, and when its connection fails or closes it is removed from the pipeline.
+
+Once a viewer's connection is established a keyframe is requested, such that it need not wait for
+the next one of the stream's keyframe interval. Replayed files have no encoder to request it from,
+their last keyframe is replayed into the viewer's branch instead (see replay.py). The time from
+connecting until a keyframe leaves the session's branches for its `webrtcbin`, on whichever layer
+the viewer receives, is recorded as the viewer's time-to-first-frame.
+
+Pipelines with a low resolution rendition (see pipeline.py) offer each viewer both renditions as
+separate tracks, each fed through a valve from its own RTP tee. Only the viewer's chosen layer
+flows, the full one until the viewer requests another on the session's 'control' data channel with
+a message such as {"layer": "low"}.
+
+Standby managers (see standby.py) are prepared without a label: the pipeline plays with its RTP
+packets held back ahead of the RTP tees, and the first session's offer is produced but held until
+the manager is bound to a label, which sends the offer and releases the packets.
+
+@author lestarch
+"""
+import asyncio
+import functools
+import json
+import logging
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .bridge import EventBridge
+from .messaging import Messenger
+from .pipeline import ENCODER_ELEMENT_NAME, LOW_RTP_TEE_ELEMENT_NAME, RTP_TEE_ELEMENT_NAME, \
+    request_keyframe
+from .replay import KeyframeCache
+from .rtc import WebRTC
+from .telemetry import TelemetryHub
+
+LOGGER = logging.getLogger(__name__)
+
+# Layers of the stream by the name of their RTP tee, in the order their tracks are offered
+LAYERS = (("full", RTP_TEE_ELEMENT_NAME), ("low", LOW_RTP_TEE_ELEMENT_NAME))
+
+
+class Branch(object):
+    """ Elements feeding one layer of the stream to a session """
+    def __init__(self, tee, tee_pad, queue, valve=None) -> None:
+        """ Construct the branch
+
+        Args:
+            tee: RTP tee of the layer
+            tee_pad: request pad of the tee feeding this branch
+            queue: queue decoupling this branch from the tee
+            valve: valve passing the layer while chosen, None for streams with a single layer
+        """
+        self.tee = tee
+        self.tee_pad = tee_pad
+        self.queue = queue
+        self.valve = valve
+        # Keyframe requests of the viewer answered from the replayed stream's KeyframeCache
+        self.keyframes = None
+
+    @property
+    def elements(self) -> list:
+        """ Elements of the branch added to the pipeline """
+        return [self.queue] + ([self.valve] if self.valve is not None else [])
+
+
+class Session(object):
+    """ Elements and signaling of a single viewer """
+    def __init__(self, webrtc, rtc: WebRTC, branches: dict) -> None:
+        """ Construct the session
+
+        Args:
+            webrtc: `webrtcbin` element of this session
+            rtc: WebRTC to messaging bridge of this session
+            branches: branch of each layer, by layer name
+        """
+        self.webrtc = webrtc
+        self.rtc = rtc
+        self.branches = branches
+        self.attached = set(branches)
+        self.layer = "full"
+
+
+class SessionManager(object):
+    """ Fans the single encoded stream out to a WebRTC session per viewer
+
+    Sessions are added to and removed from the running pipeline. All methods run in the asyncio
+    loop. Several managers, each with its own pipeline and label, may share the messenger and
+    bridge.
+    """
+    def __init__(self, pipeline, messenger: Messenger, bridge: EventBridge,
+                 label: str=None, telemetry: bool=False, standby: bool=False) -> None:
+        """ Construct the session manager
+
+        Args:
+            pipeline: GStreamer pipeline containing properly named RTP tees
+            messenger: REST-like messaging API handler, opening a channel per session
+            bridge: event bridge running messaging work in the asyncio loop
+            label: label of the stream offered, defaults to the messenger's label
+            telemetry: offer each viewer a telemetry data channel, see telemetry.py
+            standby: leave the label unset until bound, see bind
+        """
+        self.pipeline = pipeline
+        self.tees = {
+            layer: pipeline.get_by_name(tee_name) for layer, tee_name in LAYERS
+            if pipeline.get_by_name(tee_name) is not None
+        }
+        self.messenger = messenger
+        self.bridge = bridge
+        self.label = None if standby else (label or messenger.label)
+        self.sessions = {}
+        self.stopped = False
+        # Pads and probe ids holding back the RTP packets of a prepared standby manager
+        self.holds = []
+        # Connection times of viewers awaiting their first keyframe and the measured times to it
+        self.awaiting_keyframe = {}
+        self.first_frame_times = []
+        # Pipelines payloading replayed H.264 as is (setup_pipeline's file streams) have no encoder
+        self.keyframes = None
+        if pipeline.get_by_name(ENCODER_ELEMENT_NAME) is None:
+            self.keyframes = KeyframeCache(self.tees["full"])
+        self.telemetry = TelemetryHub(self) if telemetry else None
+
+    def start(self) -> None:
+        """ Open the first session and start streaming the pipeline """
+        self.open_session()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def prepare(self) -> None:
+        """ Open the first session and start the pipeline, holding back its packets until bound
+
+        `webrtcbin` only asks for negotiation once the caps of its sinks are known, which the
+        payloaders only set from the first encoded frame. Live sources produce no frames while
+        paused, so the pipeline plays with the RTP packets blocked at each RTP tee instead: the caps
+        pass on to the session, whose offer is produced, but no packet does until bound.
+        """
+        for tee in self.tees.values():
+            pad = tee.get_static_pad("sink")
+            self.holds.append((pad, pad.add_probe(
+                Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                self.hold
+            )))
+        self.open_session()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    @staticmethod
+    def hold(_, __) -> Gst.PadProbeReturn:
+        """ Block RTP packets until the holding probe is removed (streaming thread) """
+        return Gst.PadProbeReturn.OK
+
+    async def bind(self, label: str) -> None:
+        """ Bind a prepared standby manager to a label, sending its offer and releasing its packets
+
+        Args:
+            label: label of the stream offered
+        """
+        self.label = label
+        holds, self.holds = self.holds, []
+        for pad, probe in holds:
+            pad.remove_probe(probe)
+        for session in list(self.sessions.values()):
+            await session.rtc.channel.bind(label)
+
+    async def stop(self) -> None:
+        """ Stop streaming the pipeline and close all sessions """
+        self.stopped = True
+        await asyncio.to_thread(self.pipeline.set_state, Gst.State.NULL)
+        sessions, self.sessions = list(self.sessions.values()), {}
+        await asyncio.gather(*(self.messenger.close_channel(session.rtc.channel)
+                               for session in sessions))
+
+    def open_session(self) -> Session:
+        """ Add a new session to the pipeline, which then negotiates its offer
+
+        Returns:
+            new session
+        """
+        if self.label is None:
+            channel = self.messenger.open_channel(standby=True)
+        else:
+            channel = self.messenger.open_channel(self.label)
+        LOGGER.info("Opening WebRTC session %s", channel.client_id)
+        webrtc = Gst.ElementFactory.make("webrtcbin", f"webrtc-{channel.client_id}")
+        webrtc.set_property("latency", 0)
+        layered = len(self.tees) > 1
+        rtc = WebRTC(webrtc, channel, self.bridge, self.on_answered, self.close_session,
+                     self.on_connected, self.on_control if layered else None,
+                     self.telemetry is not None)
+        self.pipeline.add(webrtc)
+
+        branches = {}
+        for layer, tee in self.tees.items():
+            suffix = f"{layer}-{channel.client_id}" if layered else channel.client_id
+            # Leaky such that a stalled viewer does not hold up the tee and thus everyone else
+            queue = Gst.ElementFactory.make("queue", f"queue-{suffix}")
+            queue.set_property("leaky", 2)
+            valve = None
+            if layered:
+                valve = Gst.ElementFactory.make("valve", f"valve-{suffix}")
+                valve.set_property("drop", layer != "full")
+            branch = Branch(tee, tee.request_pad_simple("src_%u"), queue, valve)
+            if self.keyframes is not None and layer == "full":
+                branch.keyframes = self.keyframes.attach(branch.tee_pad)
+            for element in branch.elements:
+                self.pipeline.add(element)
+            branch.tee_pad.link(queue.get_static_pad("sink"))
+            if valve is not None:
+                queue.link(valve)
+            branch.elements[-1].get_static_pad("src").link(webrtc.request_pad_simple("sink_%u"))
+            branches[layer] = branch
+        session = Session(webrtc, rtc, branches)
+        self.sessions[channel.client_id] = session
+        webrtc.sync_state_with_parent()
+        for branch in branches.values():
+            for element in branch.elements:
+                element.sync_state_with_parent()
+        return session
+
+    def on_answered(self, rtc: WebRTC) -> None:
+        """ Open a session for the next viewer once the open session is answered
+
+        Args:
+            rtc: WebRTC bridge of the answered session
+        """
+        LOGGER.info("WebRTC session %s answered by %s", rtc.channel.client_id,
+                    rtc.channel.remote_id)
+        if not self.stopped:
+            self.open_session()
+
+    def on_connected(self, rtc: WebRTC) -> None:
+        """ Request a keyframe for a newly connected viewer, watching its branches for it
+
+        Args:
+            rtc: WebRTC bridge of the connected session
+        """
+        session = self.sessions.get(rtc.channel.client_id, None)
+        if session is None:
+            return
+        self.awaiting_keyframe[rtc.channel.client_id] = time.monotonic()
+        # Closed valves pass nothing, so only the layer the viewer receives reports its keyframe
+        for branch in session.branches.values():
+            branch.elements[-1].get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                functools.partial(self.on_branch_output, rtc.channel.client_id)
+            )
+        branch = session.branches[session.layer]
+        if branch.keyframes is not None:
+            branch.keyframes.request()
+        elif not request_keyframe(self.pipeline, branch.tee.get_name()):
+            LOGGER.warning("Keyframe request for %s was not handled", rtc.channel.client_id)
+
+    def on_control(self, rtc: WebRTC, message: str) -> None:
+        """ Switch a session to the layer requested by its viewer
+
+        The requested layer's valve is opened and a keyframe of that layer requested before the
+        previous layer's valve is closed.
+
+        Args:
+            rtc: WebRTC bridge of the session
+            message: control message, a JSON object naming the 'layer'
+        """
+        session = self.sessions.get(rtc.channel.client_id, None)
+        try:
+            layer = json.loads(message).get("layer", None)
+        except (ValueError, AttributeError):
+            LOGGER.warning("Invalid control message from %s: %s", rtc.channel.client_id, message)
+            return
+        if session is None or layer == session.layer:
+            return
+        if layer not in session.branches:
+            LOGGER.warning("Invalid layer requested by %s: %s", rtc.channel.client_id, layer)
+            return
+        LOGGER.info("Switching %s from the %s to the %s layer", rtc.channel.client_id,
+                    session.layer, layer)
+        branch = session.branches[layer]
+        branch.valve.set_property("drop", False)
+        request_keyframe(self.pipeline, branch.tee.get_name())
+        session.branches[session.layer].valve.set_property("drop", True)
+        session.layer = layer
+
+    def on_branch_output(self, client_id: str, _, info) -> Gst.PadProbeReturn:
+        """ Hand the first keyframe sent to a connected viewer to the asyncio loop, then stop
+        watching the branch (streaming thread)
+
+        Args:
+            client_id: client id of the viewer's session
+            _: unused source pad of the branch
+            info: probe info of the packet or list of packets
+        """
+        if info.type & Gst.PadProbeType.BUFFER:
+            packet = info.get_buffer()
+        else:
+            packet = info.get_buffer_list().get(0)
+        if packet.has_flags(Gst.BufferFlags.DELTA_UNIT):
+            return Gst.PadProbeReturn.OK
+        self.bridge.submit(self.on_keyframe, client_id, time.monotonic())
+        return Gst.PadProbeReturn.REMOVE
+
+    def on_keyframe(self, client_id: str, sent: float) -> None:
+        """ Record the time-to-first-frame of a viewer, from the first keyframe sent to it
+
+        Args:
+            client_id: client id of the viewer's session
+            sent: monotonic time the keyframe left the session's branch
+        """
+        connected = self.awaiting_keyframe.pop(client_id, None)
+        if connected is None:
+            return
+        self.first_frame_times.append(sent - connected)
+        LOGGER.info("Time-to-first-frame of %s: %.3fs", client_id, sent - connected)
+
+    def close_session(self, rtc: WebRTC) -> None:
+        """ Detach a session from the tee, then remove it and its channel
+
+        Each tee pad is unlinked once idle such that no buffer is in flight. Once all are, the
+        elements are stopped and removed outside of the streaming thread.
+
+        Args:
+            rtc: WebRTC bridge of the session to close
+        """
+        self.awaiting_keyframe.pop(rtc.channel.client_id, None)
+        session = self.sessions.pop(rtc.channel.client_id, None)
+        if session is None:
+            return
+        LOGGER.info("Closing WebRTC session %s", rtc.channel.client_id)
+
+        def unlink(layer, pad, _):
+            """ Unlink and release the tee pad of a layer (streaming thread) """
+            branch = session.branches[layer]
+            pad.unlink(branch.queue.get_static_pad("sink"))
+            branch.tee.release_request_pad(pad)
+            self.bridge.submit(self.detach_branch, session, layer)
+            return Gst.PadProbeReturn.REMOVE
+        for layer, branch in session.branches.items():
+            branch.tee_pad.add_probe(Gst.PadProbeType.IDLE, functools.partial(unlink, layer))
+
+    async def detach_branch(self, session: Session, layer: str) -> None:
+        """ Note a layer's branch detached from its tee, removing the session once all are
+
+        Args:
+            session: closing session
+            layer: layer of the detached branch
+        """
+        session.attached.discard(layer)
+        if not session.attached:
+            await self.remove_session(session)
+
+    async def remove_session(self, session: Session) -> None:
+        """ Stop and remove the elements of a detached session, then close its channel
+
+        Args:
+            session: session detached from the tees
+        """
+        elements = [element for branch in session.branches.values() for element in branch.elements]
+        for element in elements + [session.webrtc]:
+            await asyncio.to_thread(element.set_state, Gst.State.NULL)
+            self.pipeline.remove(element)
+        await self.messenger.close_channel(session.rtc.channel)
@@ -0,0 +1,140 @@
+""" Pool of standby streams, built and offered ahead of demand
+
+Starting a stream from scratch imports GStreamer, initializes it, parses and starts the pipeline
+and only then produces the offer and posts it, seconds before a viewer sees the stream. With
+`--standby N` the streaming application instead keeps N streams prepared: their pipelines are
+parsed and playing with their RTP packets held back, and the offers of their first sessions
+produced (ICE candidates included) but held back too. Binding a standby stream to a label posts
+the held offer and releases the packets, leaving only the broker round trip. The pool is refilled
+in the background after each bind, one stream at a time with its pipeline built off the asyncio
+loop, such that signaling and the bound streams are not held up meanwhile.
+
+Labels are bound on demand by writing them to stdin, one per line.
+
+@author lestarch
+"""
+import asyncio
+import collections
+import functools
+import logging
+import sys
+from typing import Callable
+
+from .bridge import EventBridge, PipelineError
+from .messaging import Messenger
+from .session import SessionManager
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StandbyPool(object):
+    """ Keeps streams prepared and binds them to labels on demand
+
+    All methods run in the asyncio loop.
+    """
+    def __init__(self, size: int, build: Callable, messenger: Messenger, bridge: EventBridge,
+                 bound_cb: Callable, failed_cb: Callable, telemetry: bool=False) -> None:
+        """ Construct the pool, without preparing any stream yet
+
+        Args:
+            size: number of streams kept prepared
+            build: called without arguments to build a new, unstarted pipeline
+            messenger: REST-like messaging API handler
+            bridge: event bridge running messaging work in the asyncio loop
+            bound_cb: called with the session manager of each stream once bound
+            failed_cb: called with the session manager and reason of bound streams whose pipeline
+                       failed
+            telemetry: offer each viewer a telemetry data channel, see telemetry.py
+        """
+        self.size = size
+        self.build = build
+        self.messenger = messenger
+        self.bridge = bridge
+        self.bound_cb = bound_cb
+        self.failed_cb = failed_cb
+        self.telemetry = telemetry
+        self.ready = collections.deque()
+        self.labels = set()
+        self.filler = None
+
+    def fill(self) -> None:
+        """ Start refilling the pool in the background, unless it is being refilled already """
+        if self.filler is None or self.filler.done():
+            self.filler = asyncio.ensure_future(self.refill())
+
+    async def refill(self) -> None:
+        """ Prepare streams one at a time until the pool is full """
+        try:
+            while len(self.ready) < self.size:
+                self.ready.append(await self.prepare())
+        except PipelineError as exc:
+            LOGGER.error("Failed to prepare a standby stream: %s", exc)
+            return
+        LOGGER.info("%d standby streams ready", len(self.ready))
+
+    async def prepare(self) -> SessionManager:
+        """ Build a stream's pipeline in a worker thread, then prepare its first session
+
+        Returns:
+            session manager of the prepared stream
+        """
+        pipeline = await asyncio.to_thread(self.build)
+        sessions = SessionManager(pipeline, self.messenger, self.bridge, telemetry=self.telemetry,
+                                  standby=True)
+        self.bridge.watch_bus(sessions.pipeline, functools.partial(self.on_error, sessions))
+        sessions.prepare()
+        return sessions
+
+    async def on_error(self, sessions: SessionManager, reason: str) -> None:
+        """ Drop a failed standby stream, handing bound streams to `failed_cb`
+
+        Args:
+            sessions: session manager of the failed stream
+            reason: reason the pipeline failed
+        """
+        if sessions not in self.ready:
+            await self.failed_cb(sessions, reason)
+            return
+        LOGGER.error("Dropping standby stream on pipeline error: %s", reason)
+        self.ready.remove(sessions)
+        await sessions.stop()
+
+    async def bind(self, label: str) -> SessionManager:
+        """ Bind a prepared stream to a label, preparing just this one first when none is ready
+
+        Args:
+            label: label of the stream to start
+
+        Returns:
+            session manager of the bound stream
+        """
+        if self.ready:
+            sessions = self.ready.popleft()
+        else:
+            LOGGER.warning("No standby stream ready for %s, starting one cold", label)
+            sessions = await self.prepare()
+        await sessions.bind(label)
+        self.labels.add(label)
+        self.bound_cb(sessions)
+        # Refill once the bound stream's offer is out
+        self.fill()
+        return sessions
+
+    async def read_labels(self) -> None:
+        """ Bind a stream to each label read from stdin, until stdin closes """
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except ValueError:
+            LOGGER.warning("Standby streams cannot be bound, stdin is not a terminal or pipe")
+            return
+        while line := await reader.readline():
+            label = line.decode().strip()
+            if not label:
+                continue
+            if label in self.labels:
+                LOGGER.error("Cannot bind %s, a stream of this label is running already", label)
+                continue
+            LOGGER.info("Binding a standby stream to %s", label)
+            await self.bind(label)
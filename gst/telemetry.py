@@ -0,0 +1,192 @@
+""" Binary telemetry sent to viewers on a `webrtcbin` data channel
+
+With `--telemetry` each session's `webrtcbin` offers a 'telemetry' data channel. Records (per-frame
+metadata of the stream, or any other topic published) are queued per viewer and sent once per frame
+interval as a single binary batch:
+
+    batch:  u8 version, u8 flags, u16 record count, u32 batch sequence, f64 sent time (ms since
+            the Unix epoch), followed by the records
+    record: u32 payload length, u16 topic, f64 timestamp (ms since the Unix epoch), payload
+    frame:  (topic 1) u64 presentation timestamp (ns), u32 access unit size, u8 flags (bit 0 set on
+            keyframes)
+
+All values are big-endian. html/js/lib/telemetry.js decodes these batches.
+
+Viewers falling behind are detected by the channel's buffered amount. Above HIGH_WATERMARK nothing
+is sent and the queued records are coalesced to the latest of each topic, sending resumes once the
+buffered amount drops below LOW_WATERMARK. Batches following coalesced or dropped records carry the
+FLAG_DROPPED flag.
+
+@author lestarch
+"""
+import asyncio
+import collections
+import logging
+import struct
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+from gi.repository import GLib
+
+LOGGER = logging.getLogger(__name__)
+
+TELEMETRY_VERSION = 1
+# Batch flag: records were coalesced or dropped since the previous batch
+FLAG_DROPPED = 0x01
+# Topic of the per-frame metadata records
+FRAME_TOPIC = 1
+# Frame record flag: the access unit is a keyframe
+FRAME_KEYFRAME = 0x01
+BATCH_HEADER = struct.Struct(">BBHId")
+RECORD_HEADER = struct.Struct(">IHd")
+FRAME_RECORD = struct.Struct(">QIB")
+# Seconds between batches, one frame interval at 30 fps
+BATCH_INTERVAL = 1 / 30
+# Largest batch (bytes), well below the message size limits of browsers
+MAX_BATCH_BYTES = 64 * 1024
+# Records queued per viewer, the oldest are dropped beyond this
+MAX_PENDING = 1024
+# Buffered amounts (bytes) of the data channel at which sending pauses and resumes
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+
+def encode_batch(sequence: int, records: list, flags: int=0) -> bytes:
+    """ Encode records into a batch
+
+    Args:
+        sequence: sequence number of the batch
+        records: (topic, timestamp in ms since the epoch, payload bytes) tuples
+        flags: batch flags
+
+    Returns:
+        encoded batch
+    """
+    parts = [BATCH_HEADER.pack(TELEMETRY_VERSION, flags, len(records), sequence & 0xFFFFFFFF,
+                               time.time() * 1000)]
+    for topic, timestamp, payload in records:
+        parts.append(RECORD_HEADER.pack(len(payload), topic, timestamp))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+class TelemetrySender(object):
+    """ Queues records for one viewer and sends them in batches on its data channel """
+    def __init__(self, channel, bridge) -> None:
+        """ Construct the sender of a data channel
+
+        Args:
+            channel: `webrtcbin` data channel
+            bridge: event bridge of the asyncio loop
+        """
+        self.channel = channel
+        self.bridge = bridge
+        self.pending = collections.deque()
+        self.sequence = 0
+        self.flags = 0
+        self.records_sent = 0
+        self.records_dropped = 0
+        channel.set_property("buffered-amount-low-threshold", LOW_WATERMARK)
+        channel.connect("on-buffered-amount-low", self.on_buffered_amount_low)
+
+    def on_buffered_amount_low(self, _) -> None:
+        """ Resume sending once the viewer caught up (GStreamer thread) """
+        self.bridge.submit(self.flush)
+
+    def queue(self, record: tuple) -> None:
+        """ Queue a record, dropping the oldest beyond MAX_PENDING
+
+        Args:
+            record: (topic, timestamp, payload) tuple
+        """
+        self.pending.append(record)
+        if len(self.pending) > MAX_PENDING:
+            self.pending.popleft()
+            self.drop(1)
+
+    def drop(self, count: int) -> None:
+        """ Count dropped records, flagging the next batch """
+        self.records_dropped += count
+        self.flags |= FLAG_DROPPED
+
+    def coalesce(self) -> None:
+        """ Keep only the latest queued record of each topic """
+        latest = {}
+        for record in self.pending:
+            latest[record[0]] = record
+        if len(latest) < len(self.pending):
+            self.drop(len(self.pending) - len(latest))
+            self.pending = collections.deque(sorted(latest.values(), key=lambda record: record[1]))
+
+    def flush(self) -> None:
+        """ Send the queued records in batches while the viewer keeps up """
+        if self.channel.get_property("ready-state") != GstWebRTC.WebRTCDataChannelState.OPEN:
+            self.coalesce()
+            return
+        while self.pending:
+            if self.channel.get_property("buffered-amount") > HIGH_WATERMARK:
+                self.coalesce()
+                return
+            records = []
+            size = BATCH_HEADER.size
+            while self.pending and (not records or size + RECORD_HEADER.size +
+                                    len(self.pending[0][2]) <= MAX_BATCH_BYTES):
+                records.append(self.pending.popleft())
+                size += RECORD_HEADER.size + len(records[-1][2])
+            batch = encode_batch(self.sequence, records, self.flags)
+            self.channel.emit("send-data", GLib.Bytes.new(batch))
+            self.sequence += 1
+            self.flags = 0
+            self.records_sent += len(records)
+
+
+class TelemetryHub(object):
+    """ Publishes telemetry records to the viewers of a stream
+
+    Publishes the metadata of each access unit leaving the payload queue under FRAME_TOPIC. Other
+    topics may be published with `publish`. All methods but probes run in the asyncio loop.
+    """
+    def __init__(self, sessions) -> None:
+        """ Construct the hub, publishing frame metadata from now on
+
+        Args:
+            sessions: session manager of the stream
+        """
+        self.sessions = sessions
+        payload_queue = sessions.pipeline.get_by_name("payload_queue")
+        payload_queue.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_frame)
+
+    def on_frame(self, _, info) -> Gst.PadProbeReturn:
+        """ Publish the metadata of an access unit (streaming thread) """
+        if self.sessions.sessions:
+            buffer = info.get_buffer()
+            flags = 0 if buffer.has_flags(Gst.BufferFlags.DELTA_UNIT) else FRAME_KEYFRAME
+            pts = buffer.pts if buffer.pts != Gst.CLOCK_TIME_NONE else 0
+            payload = FRAME_RECORD.pack(pts, buffer.get_size(), flags)
+            self.sessions.bridge.submit(self.publish, FRAME_TOPIC, payload, time.time() * 1000)
+        return Gst.PadProbeReturn.OK
+
+    def publish(self, topic: int, payload: bytes, timestamp: float=None) -> None:
+        """ Queue a record for every connected viewer
+
+        Args:
+            topic: topic of the record
+            payload: payload bytes
+            timestamp: time of the record (ms since the epoch), defaults to now
+        """
+        record = (topic, timestamp if timestamp is not None else time.time() * 1000, payload)
+        for session in self.sessions.sessions.values():
+            if session.rtc.telemetry is not None:
+                session.rtc.telemetry.queue(record)
+
+    async def run(self) -> None:
+        """ Send the queued records of every viewer, once per batch interval """
+        while True:
+            for session in list(self.sessions.sessions.values()):
+                if session.rtc.telemetry is not None:
+                    session.rtc.telemetry.flush()
+            await asyncio.sleep(BATCH_INTERVAL)
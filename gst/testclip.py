@@ -0,0 +1,84 @@
+""" Pre-encoded test pattern clip, cached on disk
+
+With `--stream-type test-cached` the test pattern is encoded once, as a short clip ending just
+before a keyframe, and cached on disk keyed by its caps and encoder settings. Every stream then
+replays the cached access units from memory (see replay.py), such that no stream runs an encoder
+and its CPU use is little more than RTP payloading. Streams of the cached clip have no encoder to
+adapt, so rate control does not apply to them.
+
+@author lestarch
+"""
+import hashlib
+import logging
+import os
+from pathlib import Path
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from .bridge import PipelineError
+from .pipeline import ENCODED_CAPS, ENCODER_SETTINGS, TEST_CAPS
+
+LOGGER = logging.getLogger(__name__)
+
+# Frames of the clip at its frame rate, a multiple of key-int-max such that loops end on a GOP
+TEST_CLIP_FRAMES = 150
+TEST_CLIP_FRAMERATE = 30
+# Encodes the clip, the location is set on 'sink'
+TEST_CLIP_PIPELINE_DESC = f'''
+videotestsrc pattern=ball num-buffers={TEST_CLIP_FRAMES} !
+    {TEST_CAPS},framerate={TEST_CLIP_FRAMERATE}/1 !
+    x264enc {ENCODER_SETTINGS} !
+    {ENCODED_CAPS} !
+    h264parse !
+    mp4mux !
+    filesink name=sink
+'''
+
+
+def default_cache_dir() -> Path:
+    """ Cache directory following the XDG base directory convention """
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "webrtc-experiments"
+
+
+def cached_test_clip(cache_dir: Path) -> Path:
+    """ Path to the encoded test clip, encoding it first when it is not cached
+
+    The clip is keyed by a digest of its pipeline description, i.e. its caps, frame count and
+    encoder settings. It is written under a temporary name and renamed once complete, such that
+    concurrent processes never read a partial clip.
+
+    Args:
+        cache_dir: directory holding the cached clips
+
+    Returns:
+        path to the encoded clip
+
+    Raises:
+        PipelineError: when the clip cannot be encoded
+    """
+    digest = hashlib.sha256(" ".join(TEST_CLIP_PIPELINE_DESC.split()).encode()).hexdigest()[:16]
+    path = cache_dir / f"test-{digest}.mp4"
+    if path.exists():
+        LOGGER.info("Using cached test clip %s", path)
+        return path
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"{path.name}.{os.getpid()}.part")
+    LOGGER.info("Encoding test clip %s", path)
+    Gst.init(None)
+    pipeline = Gst.parse_launch(TEST_CLIP_PIPELINE_DESC)
+    pipeline.get_by_name("sink").set_property("location", str(partial))
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        message = pipeline.get_bus().timed_pop_filtered(
+            Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR
+        )
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+    if message.type == Gst.MessageType.ERROR:
+        partial.unlink(missing_ok=True)
+        error, _ = message.parse_error()
+        raise PipelineError(f"Failed to encode test clip: {error.message}")
+    partial.replace(path)
+    return path
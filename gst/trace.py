@@ -0,0 +1,207 @@
+""" Per-element latency and queue level tracing of GStreamer pipelines
+
+Enabled by the `--trace` option of the entry point. Pad probes on the sink and source pad of each
+single-input single-output element of a pipeline stamp the arrival time of each buffer (by its
+presentation timestamp) and measure the time until a buffer with that timestamp leaves the element.
+For queues this is the time spent queued. Queue overruns (queue full, upstream blocked) and
+underruns (queue empty, downstream starved) are counted.
+
+At exit a report of the processing time distribution of each element (p50/p95/p99 and a histogram)
+is logged and written as JSON.
+
+Probes run on every buffer and so add some overhead themselves. Elements with request or sometimes
+pads (e.g. tee, demuxers, webrtcbin) are not traced, nor are elements assigning new timestamps
+(see UNTRACED_FACTORIES) as their buffers cannot be matched. Encoders reordering frames (e.g.
+x264enc with B-frames) would be mismatched too; ENCODER_SETTINGS' zero latency tuning disables
+B-frames, such that frames leave the encoder in order and with their timestamps.
+
+@author lestarch
+"""
+import bisect
+import collections
+import json
+import logging
+import random
+import threading
+import time
+from pathlib import Path
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+LOGGER = logging.getLogger(__name__)
+
+# Timestamps of buffers in flight kept per element, older ones are forgotten
+MAX_IN_FLIGHT = 256
+# Samples kept per element, a uniform random sample is kept beyond this
+MAX_SAMPLES = 100000
+# Upper edges (milliseconds) of the histogram buckets, the last bucket is unbounded
+HISTOGRAM_EDGES = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+# Elements timestamping their output anew, such that it cannot be matched to their input
+UNTRACED_FACTORIES = ("videorate", "audiorate")
+
+
+class ElementTrace(object):
+    """ Processing times of a single element
+
+    The sink and source pads are probed from different streaming threads for elements starting a
+    thread of their own (e.g. queues), so buffers in flight and samples are guarded by a lock.
+    """
+    def __init__(self, element) -> None:
+        """ Attach probes to the element's sink and source pads
+
+        Args:
+            element: element with a single always sink pad and a single always source pad
+        """
+        self.name = element.get_name()
+        self.factory = element.get_factory().get_name()
+        self.lock = threading.Lock()
+        self.in_flight = collections.OrderedDict()
+        self.samples = []
+        self.count = 0
+        self.overruns = 0
+        self.underruns = 0
+        element.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_enter)
+        element.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_leave)
+        if self.factory == "queue":
+            element.connect("overrun", self.on_overrun)
+            element.connect("underrun", self.on_underrun)
+
+    def on_enter(self, _, info) -> Gst.PadProbeReturn:
+        """ Stamp the arrival of a buffer (streaming thread) """
+        pts = info.get_buffer().pts
+        if pts != Gst.CLOCK_TIME_NONE:
+            entered = time.perf_counter_ns()
+            with self.lock:
+                self.in_flight.setdefault(pts, entered)
+                while len(self.in_flight) > MAX_IN_FLIGHT:
+                    self.in_flight.popitem(last=False)
+        return Gst.PadProbeReturn.OK
+
+    def on_leave(self, _, info) -> Gst.PadProbeReturn:
+        """ Record the time since the same timestamp's buffer arrived (streaming thread)
+
+        Elements producing several buffers per input (e.g. payloaders) are measured to the first.
+        """
+        left = time.perf_counter_ns()
+        with self.lock:
+            entered = self.in_flight.pop(info.get_buffer().pts, None)
+            if entered is not None:
+                self.record((left - entered) / 1e6)
+        return Gst.PadProbeReturn.OK
+
+    def record(self, milliseconds: float) -> None:
+        """ Keep a sample, reservoir sampling once MAX_SAMPLES are kept, with the lock held """
+        self.count += 1
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(milliseconds)
+        else:
+            index = random.randrange(self.count)
+            if index < MAX_SAMPLES:
+                self.samples[index] = milliseconds
+
+    def on_overrun(self, _) -> None:
+        """ Count a queue overrun (streaming thread) """
+        self.overruns += 1
+
+    def on_underrun(self, _) -> None:
+        """ Count a queue underrun (streaming thread) """
+        self.underruns += 1
+
+    def report(self) -> dict:
+        """ Processing time distribution (milliseconds) and queue counts of the element """
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+
+        def percentile(fraction):
+            """ Sample at the given fraction of the sorted samples """
+            return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+        buckets = [0] * (len(HISTOGRAM_EDGES) + 1)
+        for sample in samples:
+            buckets[bisect.bisect_left(HISTOGRAM_EDGES, sample)] += 1
+        report = {
+            "element": self.name,
+            "factory": self.factory,
+            "buffers": count,
+            "mean": sum(samples) / len(samples) if samples else None,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "histogram": {
+                f"<={edge}" if index < len(HISTOGRAM_EDGES) else f">{HISTOGRAM_EDGES[-1]}": count
+                for index, (edge, count) in enumerate(zip(HISTOGRAM_EDGES + (None, ), buckets))
+            }
+        }
+        if self.factory == "queue":
+            report.update({"overruns": self.overruns, "underruns": self.underruns})
+        return report
+
+
+class PipelineTracer(object):
+    """ Traces every traceable element of a pipeline """
+    def __init__(self, pipeline, label: str) -> None:
+        """ Attach the traces to the pipeline's elements, before it is started
+
+        Args:
+            pipeline: pipeline as built by setup_pipeline
+            label: label of the pipeline's stream, used in the report
+        """
+        self.label = label
+        self.traces = []
+        iterator = pipeline.iterate_sorted()
+        while True:
+            result, element = iterator.next()
+            if result == Gst.IteratorResult.RESYNC:
+                iterator.resync()
+                continue
+            if result != Gst.IteratorResult.OK:
+                break
+            if self.traceable(element):
+                self.traces.append(ElementTrace(element))
+        # Elements are iterated sink to source, report them in stream order
+        self.traces.reverse()
+        LOGGER.info("Tracing %s: %s", label, ", ".join(trace.name for trace in self.traces))
+
+    @staticmethod
+    def traceable(element) -> bool:
+        """ True for elements with exactly one always sink pad and one always source pad, keeping
+        the timestamps of their buffers
+        """
+        if isinstance(element, Gst.Bin) or element.get_factory() is None or \
+                element.get_factory().get_name() in UNTRACED_FACTORIES:
+            return False
+        templates = element.get_factory().get_static_pad_templates()
+        directions = [template.direction for template in templates]
+        return all(template.presence == Gst.PadPresence.ALWAYS for template in templates) and \
+            directions.count(Gst.PadDirection.SINK) == 1 and \
+            directions.count(Gst.PadDirection.SRC) == 1
+
+    def report(self) -> dict:
+        """ Reports of each traced element, in stream order """
+        return {"label": self.label, "elements": [trace.report() for trace in self.traces]}
+
+
+def write_report(tracers: list, path: Path) -> None:
+    """ Log a summary of the traces and write the full report as JSON
+
+    Args:
+        tracers: pipeline tracers
+        path: file to write the report to
+    """
+    reports = [tracer.report() for tracer in tracers]
+    for report in reports:
+        LOGGER.info("Trace of %s (milliseconds):", report["label"])
+        for element in report["elements"]:
+            if not element["buffers"]:
+                LOGGER.info("  %-24s no buffers", element["element"])
+                continue
+            queue_counts = ""
+            if "overruns" in element:
+                queue_counts = f" overruns={element['overruns']} underruns={element['underruns']}"
+            LOGGER.info("  %-24s p50=%8.3f p95=%8.3f p99=%8.3f buffers=%d%s", element["element"],
+                        element["p50"], element["p95"], element["p99"], element["buffers"],
+                        queue_counts)
+    path.write_text(json.dumps(reports, indent=4))
+    LOGGER.info("Trace report written to %s", path)
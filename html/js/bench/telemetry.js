@@ -0,0 +1,154 @@
+/**
+ * Benchmark of the telemetry data channel (see lib/telemetry.js), run by opening
+ * telemetry-bench.html. Two peer connections of the page are connected to each other, one sending
+ * batches as fast as the channel's buffered amount allows (as gst/telemetry.py does) and the other
+ * decoding them. Reports records decoded per second and the per-record latency percentiles, then a
+ * decode-only run of the same batches without the channel.
+ *
+ * Query arguments: records (per batch, default 32), payload (bytes per record, default 13) and
+ * seconds (per run, default 5).
+ *
+ * @author LeStarch
+ */
+import { decodeBatch, encodeBatch, FRAME_TOPIC, TelemetryReceiver } from "../lib/telemetry.js";
+
+// Buffered amounts (bytes) at which sending pauses and resumes, as in gst/telemetry.py
+const HIGH_WATERMARK = 256 * 1024;
+const LOW_WATERMARK = 64 * 1024;
+
+/**
+ * Percentile of sorted values
+ *
+ * @param {Array} values: sorted values
+ * @param {number} percent: percentile to return
+ * @returns {number}: percentile, or null without values
+ */
+function percentile(values, percent) {
+    if (values.length === 0) {
+        return null;
+    }
+    return values[Math.min(values.length - 1, Math.floor(values.length * percent / 100))];
+}
+
+/**
+ * Build the records of a batch
+ *
+ * @param {number} count: records per batch
+ * @param {number} size: payload bytes per record
+ * @returns {Array}: records, timestamped now
+ */
+function makeRecords(count, size) {
+    let now = Date.now();
+    let records = [];
+    for (let i = 0; i < count; i++) {
+        records.push({topic: FRAME_TOPIC, timestamp: now, payload: new Uint8Array(size)});
+    }
+    return records;
+}
+
+/**
+ * Connect two peer connections of this page through a data channel
+ *
+ * @returns {Array}: [sending channel, receiving channel, peer connections]
+ */
+async function connectLoopback() {
+    let sender = new RTCPeerConnection();
+    let receiver = new RTCPeerConnection();
+    sender.addEventListener("icecandidate", (event) => receiver.addIceCandidate(event.candidate));
+    receiver.addEventListener("icecandidate", (event) => sender.addIceCandidate(event.candidate));
+    let channel = sender.createDataChannel("telemetry");
+    let received = new Promise((resolve) => {
+        receiver.addEventListener("datachannel", (event) => resolve(event.channel));
+    });
+    await sender.setLocalDescription(await sender.createOffer());
+    await receiver.setRemoteDescription(sender.localDescription);
+    await receiver.setLocalDescription(await receiver.createAnswer());
+    await sender.setRemoteDescription(receiver.localDescription);
+    await new Promise((resolve) => channel.addEventListener("open", resolve));
+    return [channel, await received, [sender, receiver]];
+}
+
+/**
+ * Send batches over a loopback data channel for the given duration
+ *
+ * @param {number} count: records per batch
+ * @param {number} size: payload bytes per record
+ * @param {number} seconds: duration of the run
+ * @returns {Object}: results of the run
+ */
+async function channelRun(count, size, seconds) {
+    let [channel, remote, peers] = await connectLoopback();
+    let latencies = [];
+    let receiver = new TelemetryReceiver(remote, (records) => {
+        let now = Date.now();
+        for (const record of records) {
+            latencies.push(now - record.timestamp);
+        }
+    });
+    channel.bufferedAmountLowThreshold = LOW_WATERMARK;
+    let sequence = 0;
+    let start = performance.now();
+    let end = start + seconds * 1000;
+    // Fill the channel up to the high watermark, resuming once it drained to the low one
+    while (performance.now() < end) {
+        while (channel.bufferedAmount < HIGH_WATERMARK && performance.now() < end) {
+            channel.send(encodeBatch(sequence++, makeRecords(count, size)));
+        }
+        if (channel.bufferedAmount > LOW_WATERMARK) {
+            await new Promise((resolve) => {
+                channel.addEventListener("bufferedamountlow", resolve, {once: true});
+            });
+        }
+    }
+    // Let the receiver drain what was sent
+    while (receiver.batches < sequence && performance.now() < end + 5000) {
+        await new Promise((resolve) => setTimeout(resolve, 10));
+    }
+    let elapsed = (performance.now() - start) / 1000;
+    peers.forEach((peer) => peer.close());
+    latencies.sort((a, b) => a - b);
+    return {
+        batches_sent: sequence,
+        batches_received: receiver.batches,
+        lost_batches: receiver.lost_batches,
+        records_per_second: Math.round(receiver.records / elapsed),
+        megabytes_per_second: +(receiver.records * (size + 14) / elapsed / 1e6).toFixed(2),
+        latency_ms_p50: percentile(latencies, 50),
+        latency_ms_p95: percentile(latencies, 95),
+        latency_ms_p99: percentile(latencies, 99)
+    };
+}
+
+/**
+ * Decode batches in a loop, without a channel, for the given duration
+ *
+ * @param {number} count: records per batch
+ * @param {number} size: payload bytes per record
+ * @param {number} seconds: duration of the run
+ * @returns {Object}: results of the run
+ */
+function decodeRun(count, size, seconds) {
+    let batch = encodeBatch(0, makeRecords(count, size));
+    let records = 0;
+    let start = performance.now();
+    let end = start + seconds * 1000;
+    while (performance.now() < end) {
+        for (let i = 0; i < 1000; i++) {
+            records += decodeBatch(batch).records.length;
+        }
+    }
+    let elapsed = (performance.now() - start) / 1000;
+    return {records_per_second: Math.round(records / elapsed)};
+}
+
+let query = new URLSearchParams(window.location.search);
+let count = parseInt(query.get("records") ?? "32");
+let size = parseInt(query.get("payload") ?? "13");
+let seconds = parseFloat(query.get("seconds") ?? "5");
+let results = {
+    parameters: {records: count, payload: size, seconds: seconds},
+    channel: await channelRun(count, size, seconds),
+    decode: decodeRun(count, size, seconds)
+};
+console.log(results);
+document.getElementById("results").textContent = JSON.stringify(results, null, 4);
@@ -0,0 +1,128 @@
+/**
+ * batch-poller.js:
+ *
+ * Class used to poll for answers and ICE candidate messages of every peer on the page through a
+ * single long-poll request, rather than one request per peer.
+ */
+import {pollBatch, pollLoop, LONG_POLL_WAIT} from "./fetcher.js";
+
+/**
+ * BatchPoller: polls for answers and ICE candidates on behalf of registered watchers and hands the
+ * results to their callbacks.
+ */
+export class BatchPoller {
+    static _singleton = null;
+    /**
+     * Singleton creator methods.
+     * @returns {BatchPoller}: batch poller singleton
+     */
+    static singleton() {
+        // Build singleton on the fly
+        if (BatchPoller._singleton == null) {
+            BatchPoller._singleton = new BatchPoller();
+        }
+        return BatchPoller._singleton;
+    }
+
+    /**
+     * Setup the poller. Polling starts once something is watched.
+     */
+    constructor() {
+        this.answer_callbacks = {};
+        this.ice_watches = {};
+        this.controller = null;
+        this.running = false;
+    }
+
+    /**
+     * Watch for the answer to an offer. The callback is called once with (answerer, answer).
+     * @param {string} offer_id: ID of the offering client
+     * @param {Function} callback: function called with the answering client ID and answer
+     */
+    watchAnswer(offer_id, callback) {
+        this.answer_callbacks[offer_id] = callback;
+        this.refresh();
+    }
+
+    /**
+     * Watch for ICE candidate messages from a remote client. The callback is called with each list
+     * of new messages until unwatched.
+     * @param {string} remote_id: ID of the remote client
+     * @param {Function} callback: function called with a list of new ICE candidate messages
+     */
+    watchIce(remote_id, callback) {
+        this.ice_watches[remote_id] = {cursor: 0, callback: callback};
+        this.refresh();
+    }
+
+    /**
+     * Stop watching for ICE candidate messages from a remote client.
+     * @param {string} remote_id: ID of the remote client
+     */
+    unwatchIce(remote_id) {
+        delete this.ice_watches[remote_id];
+    }
+
+    /**
+     * Restart polling such that the watched set takes effect. Cancels any outstanding long-poll as
+     * it was issued for the previous set.
+     */
+    refresh() {
+        if (this.controller) {
+            this.controller.abort();
+        }
+        if (!this.running) {
+            this.running = true;
+            pollLoop(this.poll.bind(this));
+        }
+    }
+
+    /**
+     * Long-poll once for everything watched and dispatch the results
+     * @returns {Promise<boolean>}: true to keep polling, false when nothing is watched
+     */
+    async poll() {
+        let offer_ids = Object.keys(this.answer_callbacks);
+        let ice_cursors = Object.fromEntries(
+            Object.entries(this.ice_watches).map(([remote_id, watch]) => [remote_id, watch.cursor])
+        );
+        if (offer_ids.length == 0 && Object.keys(ice_cursors).length == 0) {
+            this.running = false;
+            return false;
+        }
+        let success, answers, ice;
+        this.controller = new AbortController();
+        try {
+            [success, answers, ice] = await pollBatch(
+                offer_ids, ice_cursors, LONG_POLL_WAIT, this.controller.signal
+            );
+        } catch (e) {
+            // Aborted by a refresh, poll again with the updated watch set
+            if (e.name === "AbortError") {
+                return true;
+            }
+            throw e;
+        } finally {
+            this.controller = null;
+        }
+        if (!success) {
+            return true;
+        }
+        // Answers first such that remote descriptions are set before candidates arrive
+        for (const [offer_id, data] of Object.entries(answers)) {
+            let callback = this.answer_callbacks[offer_id];
+            delete this.answer_callbacks[offer_id];
+            if (callback) {
+                await callback(data.answerer, data.answer);
+            }
+        }
+        for (const [remote_id, data] of Object.entries(ice)) {
+            let watch = this.ice_watches[remote_id];
+            if (watch) {
+                watch.cursor = data.cursor;
+                await watch.callback(data.messages);
+            }
+        }
+        return true;
+    }
+}
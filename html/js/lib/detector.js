@@ -4,7 +4,7 @@
  * Class used to poll for offers and act as a central database for holding the
  * available offers to the system.
  */
-import {pollOffers} from "./fetcher.js";
+import {pollLoop, pollOffers} from "./fetcher.js";
 import {setListInPlace} from "./util.js";
 
 /**
@@ -29,18 +29,20 @@ export class Detector {
      * Setup detector and start polling.
      */
     constructor() {
-        let _ = setInterval(this.updateOffers.bind(this), 1000);
         this.streams = [];
         this.callbacks = [];
+        this.version = null;
+        pollLoop(this.updateOffers.bind(this));
     }
 
     /**
-     * Update offers by polling
-     * @returns {Promise<void>}
+     * Update offers by long-polling for a change to the offers version
+     * @returns {Promise<boolean>}: true to keep polling
      */
     async updateOffers() {
-        let [success, offers] = await pollOffers();
+        let [success, offers, version] = await pollOffers(this.version);
         if (success && offers) {
+            this.version = version;
             let changed = setListInPlace(this.streams, offers);
             if (changed) {
                 this.callbacks.forEach((item) => {
@@ -48,6 +50,7 @@ export class Detector {
                 });
             }
         }
+        return true;
     }
 
     /**
@@ -10,9 +10,19 @@
  *     ...data... 
  * }
  * 
+ * POLL functions are long-polls: the server holds the request open for up to `wait` seconds until
+ * there is new data to return. This allows callers to poll back-to-back without a timer.
+ *
  * @author LeStarch
  */
 
+// Seconds the server is asked to hold long-poll requests open
+export const LONG_POLL_WAIT = 10;
+// Minimum milliseconds between successive polls, guards against spinning on errors
+const MIN_POLL_INTERVAL = 100;
+// Milliseconds between heartbeats keeping an offer alive, must be below the server's session TTL
+export const HEARTBEAT_INTERVAL = 20000;
+
 /**
  * Perform HTML action (method) with given data to gievn server URL
  * 
@@ -22,9 +32,10 @@
  * @param url: URL to fetch using fetch API 
  * @param method: "GET", "POST", etc. Default: "GET"
  * @param data: data to yeet to the server. Default: unse
+ * @param signal: AbortSignal used to cancel the request. Default: unset
  * @returns: Array [status, returned data]
  */
-async function requestor(url, method, data) {
+async function requestor(url, method, data, signal) {
     // Base data structure
     let fetch_data = {
         method: (method) ? method : "GET",
@@ -33,9 +44,13 @@ async function requestor(url, method, data) {
         headers: {
             "Content-Type": "application/json",
         },
+        signal: signal,
     }
-    // Fetch data, await response
+    // Fetch data, await response. Not Modified carries no body and signals no new data
     let response = await fetch(url, fetch_data);
+    if (response.status == 304) {
+        return [true, {}];
+    }
     let response_data = await response.json();
     if (!response.ok) {
         console.error(response_data.status || "Unknown fetching error");
@@ -44,6 +59,33 @@ async function requestor(url, method, data) {
     return [true, response_data];
 }
 
+/**
+ * Run a long-poll function back-to-back until it asks to stop
+ * 
+ * Calls poll_function repeatedly. Each call is expected to perform one long-poll and return true
+ * to keep polling or false to stop. Errors are logged and polling continues. Calls returning faster
+ * than MIN_POLL_INTERVAL (e.g. errors, or nothing to poll for yet) are delayed to avoid spinning.
+ * 
+ * Note: this function is asynchronous
+ * 
+ * @param {Function} poll_function: async function performing a single poll, returns keep-polling
+ */
+export async function pollLoop(poll_function) {
+    let keep_polling = true;
+    while (keep_polling) {
+        let start = Date.now();
+        try {
+            keep_polling = await poll_function();
+        } catch (e) {
+            console.error("Polling failed:", e);
+        }
+        let remaining = MIN_POLL_INTERVAL - (Date.now() - start);
+        if (keep_polling && remaining > 0) {
+            await new Promise((resolve) => setTimeout(resolve, remaining));
+        }
+    }
+}
+
 /**
  * POST an offer from this client via the backend server
  * 
@@ -110,6 +152,34 @@ export async function sendIce(client_id, candidate) {
     return success;
 }
 
+/**
+ * POST a heartbeat for this client via the backend server
+ * 
+ * The server expires clients, and their offers, that have not been seen for a while. Offering
+ * clients should call this every HEARTBEAT_INTERVAL to keep their offer available.
+ * 
+ * Note: this function is asynchronous
+ * 
+ * @param {string} client_id: ID of this client
+ * @returns: success/failure of remote call
+ */
+export async function sendHeartbeat(client_id) {
+    let [success, _] = await requestor(`/heartbeat/${client_id}`, "POST");
+    return success;
+}
+
+/**
+ * Withdraw this client's offer and ICE candidates from the backend server
+ * 
+ * Uses a beacon such that the request is delivered even when called as the page is unloading.
+ * 
+ * @param {string} client_id: ID of this client
+ * @returns: true if the beacon was queued for delivery
+ */
+export function withdrawBeacon(client_id) {
+    return navigator.sendBeacon(`/withdraw/${client_id}`);
+}
+
 /**
  * POLL for answers to the given offering client
  * 
@@ -120,10 +190,11 @@ export async function sendIce(client_id, candidate) {
  * Note: this function is asynchronous
  *
  * @param {string} offer_id: ID of client which made previous answer
+ * @param {number} wait: seconds to long-poll for the answer. Default: LONG_POLL_WAIT
  * @returns: Array [success/failure of remote call, ID of answering client, returned answer data]
  */
-export async function pollAnswer(offer_id) {
-    let [success, data] = await requestor(`/answer/${offer_id}`);
+export async function pollAnswer(offer_id, wait = LONG_POLL_WAIT) {
+    let [success, data] = await requestor(`/answer/${offer_id}?wait=${wait}`);
     return [success, data.answerer || "", data.answer || {}]
 }
 
@@ -131,15 +202,43 @@ export async function pollAnswer(offer_id) {
  * POLL for offers from remote clients
  * 
  * POLL for WebRTC offers made from any remote client. Return a list of offers sent via the side
- * channel to this client.  These offers are not limited to a single client.
+ * channel to this client.  These offers are not limited to a single client. Only offer metadata
+ * (label and offerer) is returned, use fetchOffer to retrieve the offer itself.
+ *
+ * The server returns as soon as its offers version differs from the supplied version. Pass the
+ * returned version back in on the next call to wait for the next change. When nothing changed
+ * the returned list is null.
+ *
+ * Note: this function is asynchronous
+ * 
+ * @param {number} version: last offers version seen by the caller. Default: none seen
+ * @param {number} wait: seconds to long-poll for a change. Default: LONG_POLL_WAIT
+ * @param {Array} labels: only return offers with these labels. Default: all offers
+ * @returns Array [success/failure of remote call, list of offer metadata or null, offers version]
+ */
+export async function pollOffers(version = null, wait = LONG_POLL_WAIT, labels = null) {
+    let query = new URLSearchParams({"wait": wait, "metadata": 1});
+    if (version != null) {
+        query.append("version", version);
+    }
+    (labels || []).forEach((label) => query.append("label", label));
+    let [success, data] = await requestor(`/offers?${query}`);
+    return [success, data.offers || null, (data.version != null) ? data.version : version];
+}
+
+/**
+ * GET a single offer from a remote client
+ * 
+ * Retrieves the offer (SDP) of the given offering client, as listed by pollOffers.
  *
  * Note: this function is asynchronous
  * 
- * @returns Array [success/failure of remote call, list of offer objects]
+ * @param {string} offer_id: ID of the offering client
+ * @returns Array [success/failure of remote call, offer data]
  */
-export async function pollOffers() {
-    let [success, data] = await requestor(`/offers`);
-    return [success, data.offers || []];
+export async function fetchOffer(offer_id) {
+    let [success, data] = await requestor(`/offer/${offer_id}`);
+    return [success && (data.offer != null), data.offer || {}];
 }
 
 /**
@@ -152,12 +251,41 @@ export async function pollOffers() {
  * passed through the side channel, allow the WebRTC clients to connect directly across unknown
  * network and internet topologies.
  * 
+ * Candidates are sequenced by the server. Only candidates posted after the `since` cursor are
+ * returned, along with the cursor to supply on the next call. The server returns once such
+ * candidates are available.
+ *
  * Note: this function is asynchronous
  * 
  * @param {string} remote_id:: answerer or offerer ID to of the remote client
- * @returns: Array [success/failure of remote call, list of ICE candidate messages]
+ * @param {number} since: cursor returned by the previous call. Default: 0 (all candidates)
+ * @param {number} wait: seconds to long-poll for new messages. Default: LONG_POLL_WAIT
+ * @returns: Array [success/failure of remote call, list of new ICE candidate messages, cursor]
+ */
+export async function pollIce(remote_id, since = 0, wait = LONG_POLL_WAIT) {
+    let [success, ice] = await requestor(`/ice/${remote_id}?wait=${wait}&since=${since}`, "GET");
+    return [success, ice.messages || [], (ice.cursor != null) ? ice.cursor : since];
+}
+
+/**
+ * POLL for answers and ICE candidate messages of many clients in one request
+ * 
+ * Batched form of pollAnswer and pollIce for pages watching many streams. The server returns once
+ * any of the offers is answered or any of the clients has candidates after its cursor. Only clients
+ * with new data are present in the returned objects.
+ * 
+ * Note: this function is asynchronous
+ * 
+ * @param {Array} offer_ids: IDs of offering clients whose answers are wanted
+ * @param {Object} ice_cursors: remote client ID to cursor returned by the previous call
+ * @param {number} wait: seconds to long-poll for new data. Default: LONG_POLL_WAIT
+ * @param {AbortSignal} signal: signal used to cancel the poll. Default: unset
+ * @returns: Array [success/failure of remote call, offer ID to {answerer, answer} object,
+ *                  remote ID to {messages, cursor} object]
  */
-export async function pollIce(remote_id) {
-    let [success, ice] = await requestor("/ice/" + remote_id, "GET");
-    return [success, ice.messages || []];
+export async function pollBatch(offer_ids, ice_cursors, wait = LONG_POLL_WAIT, signal = undefined) {
+    let [success, data] = await requestor(
+        `/poll?wait=${wait}`, "POST", {"answers": offer_ids, "ice": ice_cursors}, signal
+    );
+    return [success, data.answers || {}, data.ice || {}];
 }
\ No newline at end of file
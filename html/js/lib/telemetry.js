@@ -0,0 +1,172 @@
+/**
+ * Decoding (and encoding, for benchmarks) of the binary telemetry batches sent by the streaming
+ * application on the "telemetry" data channel. See gst/telemetry.py for the producing side.
+ *
+ * Batch layout, all values big-endian:
+ *
+ * batch:  u8 version, u8 flags, u16 record count, u32 batch sequence, f64 sent time (ms since the
+ *         Unix epoch), followed by the records
+ * record: u32 payload length, u16 topic, f64 timestamp (ms since the Unix epoch), payload
+ * frame:  (topic 1) u64 presentation timestamp (ns), u32 access unit size, u8 flags (bit 0 set on
+ *         keyframes)
+ *
+ * Record payloads are decoded as views onto the received buffer, without copying.
+ *
+ * @author LeStarch
+ */
+
+export const TELEMETRY_VERSION = 1;
+// Batch flag: the producer coalesced or dropped records since the previous batch
+export const FLAG_DROPPED = 0x01;
+// Topic of the per-frame metadata records
+export const FRAME_TOPIC = 1;
+const BATCH_HEADER_SIZE = 16;
+const RECORD_HEADER_SIZE = 14;
+const FRAME_RECORD_SIZE = 13;
+
+/**
+ * Encode records into a batch, as the streaming application does
+ *
+ * @param {number} sequence: sequence number of the batch
+ * @param {Array} records: records of {topic, timestamp, payload (Uint8Array)}
+ * @param {number} flags: batch flags. Default: 0
+ * @returns {ArrayBuffer}: encoded batch
+ */
+export function encodeBatch(sequence, records, flags) {
+    let size = BATCH_HEADER_SIZE;
+    for (const record of records) {
+        size += RECORD_HEADER_SIZE + record.payload.byteLength;
+    }
+    let buffer = new ArrayBuffer(size);
+    let view = new DataView(buffer);
+    let bytes = new Uint8Array(buffer);
+    view.setUint8(0, TELEMETRY_VERSION);
+    view.setUint8(1, flags || 0);
+    view.setUint16(2, records.length);
+    view.setUint32(4, sequence >>> 0);
+    view.setFloat64(8, Date.now());
+    let offset = BATCH_HEADER_SIZE;
+    for (const record of records) {
+        view.setUint32(offset, record.payload.byteLength);
+        view.setUint16(offset + 4, record.topic);
+        view.setFloat64(offset + 6, record.timestamp);
+        bytes.set(record.payload, offset + RECORD_HEADER_SIZE);
+        offset += RECORD_HEADER_SIZE + record.payload.byteLength;
+    }
+    return buffer;
+}
+
+/**
+ * Decode a batch
+ *
+ * @param {ArrayBuffer} buffer: received batch
+ * @returns {Object}: batch of {version, flags, sequence, sent, records}, records being
+ *     {topic, timestamp, payload (Uint8Array view)}
+ * @throws {Error}: on unknown versions and truncated batches
+ */
+export function decodeBatch(buffer) {
+    let view = new DataView(buffer);
+    if (buffer.byteLength < BATCH_HEADER_SIZE || view.getUint8(0) !== TELEMETRY_VERSION) {
+        throw new Error("Invalid telemetry batch");
+    }
+    let count = view.getUint16(2);
+    let records = new Array(count);
+    let offset = BATCH_HEADER_SIZE;
+    for (let i = 0; i < count; i++) {
+        if (offset + RECORD_HEADER_SIZE > buffer.byteLength) {
+            throw new Error("Truncated telemetry batch");
+        }
+        let length = view.getUint32(offset);
+        let start = offset + RECORD_HEADER_SIZE;
+        if (start + length > buffer.byteLength) {
+            throw new Error("Truncated telemetry record");
+        }
+        records[i] = {
+            topic: view.getUint16(offset + 4),
+            timestamp: view.getFloat64(offset + 6),
+            payload: new Uint8Array(buffer, start, length)
+        };
+        offset = start + length;
+    }
+    return {
+        version: view.getUint8(0),
+        flags: view.getUint8(1),
+        sequence: view.getUint32(4),
+        sent: view.getFloat64(8),
+        records: records
+    };
+}
+
+/**
+ * Decode the payload of a frame metadata record (FRAME_TOPIC)
+ *
+ * @param {Uint8Array} payload: record payload
+ * @returns {Object}: frame metadata {pts (ns), size (bytes), keyframe}
+ */
+export function decodeFrame(payload) {
+    if (payload.byteLength < FRAME_RECORD_SIZE) {
+        throw new Error("Truncated frame record");
+    }
+    let view = new DataView(payload.buffer, payload.byteOffset, payload.byteLength);
+    return {
+        pts: Number(view.getBigUint64(0)),
+        size: view.getUint32(8),
+        keyframe: (view.getUint8(12) & 0x01) !== 0
+    };
+}
+
+/**
+ * Receives the telemetry batches of a data channel and keeps statistics of them
+ */
+export class TelemetryReceiver {
+    /**
+     * Start receiving on the given data channel
+     *
+     * @param {RTCDataChannel} channel: telemetry data channel
+     * @param {function} callback: called with the records of each batch. Default: unset
+     */
+    constructor(channel, callback) {
+        this.callback = callback || null;
+        this.batches = 0;
+        this.records = 0;
+        this.lost_batches = 0;
+        this.dropped_batches = 0;
+        this.last_sequence = null;
+        this.last_latency = null;
+        this.last_frame = null;
+        channel.binaryType = "arraybuffer";
+        channel.addEventListener("message", (event) => this.receive(event.data));
+    }
+
+    /**
+     * Decode a received batch and update the statistics
+     *
+     * @param {ArrayBuffer} data: received batch
+     */
+    receive(data) {
+        let batch = null;
+        try {
+            batch = decodeBatch(data);
+        } catch (e) {
+            console.error("Failed to decode telemetry:", e);
+            return;
+        }
+        if (this.last_sequence !== null) {
+            this.lost_batches += (batch.sequence - this.last_sequence - 1) >>> 0;
+        }
+        this.last_sequence = batch.sequence;
+        this.dropped_batches += (batch.flags & FLAG_DROPPED) ? 1 : 0;
+        this.batches += 1;
+        this.records += batch.records.length;
+        let now = Date.now();
+        for (const record of batch.records) {
+            this.last_latency = now - record.timestamp;
+            if (record.topic === FRAME_TOPIC) {
+                this.last_frame = decodeFrame(record.payload);
+            }
+        }
+        if (this.callback) {
+            this.callback(batch.records);
+        }
+    }
+}
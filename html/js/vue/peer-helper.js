@@ -13,7 +13,8 @@
  * @author LeStarch
  */
 import { createPeerConnection } from "../lib/rtc.js";
-import { pollIce, sendIce } from "../lib/fetcher.js";
+import { sendIce } from "../lib/fetcher.js";
+import { BatchPoller } from "../lib/batch-poller.js";
 
 /**
  * Set-up WebRTC peer, affiliated data, and begin handling ICE candidate events
@@ -24,11 +25,11 @@ import { pollIce, sendIce } from "../lib/fetcher.js";
  * message to the client message server, and incoming ICE messages must be POLLed from the same
  * server.
  * 
- * The peer and ID objects are created. An ICE POLLer is started to find remote ICE candidate
- * messages and an ICE event listener is registered to pass local ICE candidate messages down
- * to the server.
+ * The peer and ID objects are created and an ICE event listener is registered to pass local ICE
+ * candidate messages down to the server. Remote ICE candidate messages are POLLed once the remote
+ * peer is known, see setRemote.
  * 
- * @returns {Object}: object with peer, local peer id, remote peer id, and ICE POLLer ID fields.
+ * @returns {Object}: object with peer, local peer id, and remote peer id fields.
  */
 export function setupPeerData() {
     let [peer, peer_id] = createPeerConnection();
@@ -36,15 +37,33 @@ export function setupPeerData() {
     let data = {
         peer: peer,
         peer_id: peer_id,
-        remote_id: null,
-        ice_poll_id: null,
-        ice_candidates: []
+        remote_id: null
     }
-    data.ice_poll_id = setInterval(icePoller.bind(undefined, data), 200);
     peer.addEventListener("icecandidate", iceCandidateSender.bind(undefined, data.peer_id));
     return data;
 }
 
+/**
+ * Set the remote peer and begin handling its ICE candidate messages
+ * 
+ * Registers the remote peer ID with the page's BatchPoller such that ICE candidate messages from
+ * the remote are POLLed (alongside those of every other peer on the page) and supplied to the local
+ * peer. Polling stops once the ICE connection is established, or the peer is closed.
+ * 
+ * @param {Object} data: peer data as produced by setupPeerData
+ * @param {string} remote_id: ID of the remote client
+ */
+export function setRemote(data, remote_id) {
+    data.remote_id = remote_id;
+    let poller = BatchPoller.singleton();
+    data.peer.addEventListener("iceconnectionstatechange", () => {
+        if (["connected", "completed", "closed"].includes(data.peer.iceConnectionState)) {
+            poller.unwatchIce(remote_id);
+        }
+    });
+    poller.watchIce(remote_id, iceReceiver.bind(undefined, data.peer));
+}
+
 /**
  * Handle a local ICE candidate event by sending it to the client managing server
  * 
@@ -69,42 +88,24 @@ async function iceCandidateSender(peer_id, event) {
 }
 
 /**
- * POLL and handle ICE candidate messages once the remote candidate is established
+ * Handle ICE candidate messages received from the remote peer
  * 
  * In order to finalize the connection between WebRTC candidates, ICE candidate messages need to be
- * received from the client managing server and handed back to the WebRTC peer. This is
- * accomplished by POLLing the client managing server for ICE candidate messages from the remote
- * peer ID. Once these messages are received they are supplied to the local peer.
- * 
- * Note: this function is intended to be setup to POLL on a quick timed interval (< 1 second) in
- * order to receive and handle messages before the ICE connection timeout terminates the
- * connection.
+ * received from the client managing server and handed back to the WebRTC peer. The BatchPoller
+ * POLLs the client managing server for ICE candidate messages from the remote peer ID and supplies
+ * only the new messages to this callback, which passes them to the local peer.
  * 
- * Note 2: data is bound in as an object such that changes to remote-id are tracked as a raw
- * reference would not track the update. This implies that the function does nothing until the
- * remote ID is set.
+ * Note: this function is intended as a peer-bound callback for BatchPoller.watchIce.
  * 
- * @param {Object} data: defining remote_id field eventually set to remote client ID and peer
- *     field set to the local peer object.
+ * @param {RTCPeerConnection} peer: local peer object
+ * @param {Array} messages: new ICE candidate messages from the remote peer
  */
-async function icePoller(data) {
-    if (!data.remote_id) {
-        return;
-    }
-    let [success, messages] = await pollIce(data.remote_id);
-    if (!success) {
-        return;
-    }
-    // Push received ICE candidates to the local peer
-    await messages.forEach(async (candidate) => {
+async function iceReceiver(peer, messages) {
+    for (const candidate of messages) {
         try {
-            let candidate_string = JSON.stringify(candidate);
-            if (data.ice_candidates.indexOf(candidate_string) == -1) {
-                data.ice_candidates.push(candidate_string);
-                await data.peer.addIceCandidate(new RTCIceCandidate(candidate));
-            }
+            await peer.addIceCandidate(new RTCIceCandidate(candidate));
         } catch (e) {
             console.error("Failed to add ICE candidate:", e);
         }
-    });
-}
\ No newline at end of file
+    }
+}
@@ -2,8 +2,9 @@ import { localVideoDevices, openLocalVideoDevice } from "../lib/video.js";
 import { createPeerConnection, attachTracks, createOffer, handleAnswer } from "../lib/rtc.js";
 import { setListInPlace } from "../lib/util.js";
 import { initial_select_text, producer_template } from "./producer-template.js"
-import { sendOffer, pollAnswer } from "../lib/fetcher.js"
-import { setupPeerData } from "./peer-helper.js"
+import { sendOffer, sendHeartbeat, withdrawBeacon, HEARTBEAT_INTERVAL } from "../lib/fetcher.js"
+import { BatchPoller } from "../lib/batch-poller.js"
+import { setRemote, setupPeerData } from "./peer-helper.js"
 
 export default {
     template: producer_template,
@@ -13,7 +14,6 @@ export default {
             devices: [],
             selected: initial_select_text,
             stream_id: "Stream 1",
-            poll_id: null,
             answered: false
         });
         return data;
@@ -47,18 +47,21 @@ export default {
             // Send an offer and look for an answer
             let success = await sendOffer(this.stream_id, this.peer_id, offer);
             if (success) {
-                this.poll_id = setInterval(this.checkAnswer.bind(this), 1000);
+                setInterval(sendHeartbeat.bind(undefined, this.peer_id), HEARTBEAT_INTERVAL);
+                window.addEventListener("pagehide", withdrawBeacon.bind(undefined, this.peer_id));
+                BatchPoller.singleton().watchAnswer(this.peer_id, this.onAnswer.bind(this));
             }
         },
 
-        async checkAnswer() {
-            let [success, answerer, answer] = await pollAnswer(this.peer_id);
-            if (success && answerer && answer) {
-                clearInterval(this.poll_id);
-                this.remote_id = answerer;
-                this.answered = true;
-                handleAnswer(this.peer, answer);
-            }
+        /**
+         * Handle the answer to the offer, then start handling the answerer's ICE candidates
+         * @param {string} answerer: ID of the answering client
+         * @param {Object} answer: answer data
+         */
+        async onAnswer(answerer, answer) {
+            this.answered = true;
+            await handleAnswer(this.peer, answer);
+            setRemote(this, answerer);
         }
     }
 }
\ No newline at end of file
@@ -8,15 +8,23 @@
 // Initial text for within the select drop-down
 export let initial_select_text = "Select Remote Stream";
 
+// Styles of the video in its tile and when enlarged to fill the page (grid tiles only)
+export let tile_style = "width: 100%; border: 1px solid black;";
+export let enlarged_style = "position: fixed; top: 0; left: 0; width: 100vw; height: 100vh; " +
+    "z-index: 10; background: black;";
+
 /**
  * Streamer template providing a video selection drop-down to control the selection of remote video
  * streams and a video tag for rendering the video from the WebRTC peer.
  */
 export let streamer_template = `
 <div style="width: 100%">
-    <h4>{{ (stream != null) ? stream : peer_id }}</h4>
-    <video class="video" autoplay playsinline controls="false"
-        style="width: 100%; border: 1px solid black;">
+    <h4>
+        {{ (stream != null) ? stream : peer_id }}
+        <small v-if="first_frame_ms != null">(first frame {{ first_frame_ms }} ms)</small>
+    </h4>
+    <video class="video" autoplay playsinline controls="false" @click="toggleEnlarged"
+        :style="enlarged ? enlarged_style : tile_style">
     </video>
     <div>
         <span v-if="stream == null">
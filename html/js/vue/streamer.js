@@ -1,9 +1,15 @@
 
 import { createAnswer } from "../lib/rtc.js";
-import { initial_select_text, streamer_template } from "./streamer-template.js"
-import { sendAnswer } from "../lib/fetcher.js"
-import { setupPeerData } from "./peer-helper.js"
+import {
+    enlarged_style, initial_select_text, streamer_template, tile_style
+} from "./streamer-template.js"
+import { fetchOffer, sendAnswer } from "../lib/fetcher.js"
+import { setRemote, setupPeerData } from "./peer-helper.js"
 import {Detector} from "../lib/detector.js";
+import {TelemetryReceiver} from "../lib/telemetry.js";
+
+// Layers of streams with renditions, in the order of their tracks (see gst/session.py)
+const LAYERS = ["full", "low"];
 
 export default {
     template: streamer_template,
@@ -20,6 +26,14 @@ export default {
             selected: initial_select_text,
             poll_id: null,
             answered: false,
+            answered_at: null,
+            first_frame_ms: null,
+            tracks: {},
+            control: null,
+            telemetry: null,
+            enlarged: false,
+            enlarged_style: enlarged_style,
+            tile_style: tile_style,
             ready: false
         });
         return data;
@@ -30,29 +44,79 @@ export default {
         let video_element = this.$el.querySelector(".video");
         this.peer.addEventListener('track', async (event) => {
             console.log("Detected new stream");
-            const [remoteStream] = event.streams;
-            video_element.srcObject = remoteStream;
+            // Streams with renditions have a track per layer, shown one at a time
+            let index = this.peer.getTransceivers().indexOf(event.transceiver);
+            this.tracks[LAYERS[index] ?? LAYERS[0]] = event.track;
+            this.showLayer();
+        });
+        // Streams with renditions offer a control channel to choose the layer sent, streams with
+        // telemetry a telemetry channel
+        this.peer.addEventListener('datachannel', (event) => {
+            if (event.channel.label === "control") {
+                this.control = event.channel;
+                this.control.addEventListener("open", () => this.requestLayer());
+            } else if (event.channel.label === "telemetry") {
+                this.telemetry = new TelemetryReceiver(event.channel);
+            }
+        });
+        // Time-to-first-frame: from sending the answer until the first frame is decoded
+        video_element.addEventListener("loadeddata", () => {
+            if (this.answered_at != null && this.first_frame_ms == null) {
+                this.first_frame_ms = Math.round(performance.now() - this.answered_at);
+                let name = this.stream ?? this.peer_id;
+                console.log(`Time to first frame of ${name}: ${this.first_frame_ms} ms`);
+            }
         });
     },
     computed: {
         playable() {
             return this.ready && !this.answered;
+        },
+        layer() {
+            // Grid tiles are thumbnails until enlarged
+            return ((this.stream == null) || this.enlarged) ? "full" : "low";
+        }
+    },
+    watch: {
+        layer() {
+            this.requestLayer();
+            this.showLayer();
         }
     },
     methods: {
+        toggleEnlarged() {
+            this.enlarged = (this.stream != null) && !this.enlarged;
+        },
+        requestLayer() {
+            if (this.control?.readyState === "open") {
+                this.control.send(JSON.stringify({layer: this.layer}));
+            }
+        },
+        showLayer() {
+            let track = this.tracks[this.layer] ?? this.tracks[LAYERS[0]];
+            let video_element = this.$el.querySelector(".video");
+            if (track && video_element.srcObject?.getVideoTracks()[0] !== track) {
+                video_element.srcObject = new MediaStream([track]);
+            }
+        },
         async streamRemote() {
             console.assert(
-                ((this.selected != initial_select_text) && this.selected.offer),
+                ((this.selected != initial_select_text) && this.selected.offerer),
                 `Invalid stream selected: ${this.selected}`
             );
             // Prevent problems after assertion
-            if (!this.selected?.offer) {
+            if (!this.selected?.offerer) {
                 return;
             }
-            this.remote_id = this.selected.offerer;
-
-            // Produce an answer
-            let answer = await createAnswer(this.peer, this.selected.offer);
+            // Offers are listed without SDP, fetch the chosen one
+            let [success, offer] = await fetchOffer(this.selected.offerer);
+            if (!success) {
+                return;
+            }
+            // Produce an answer, then handle the offerer's ICE candidates
+            let answer = await createAnswer(this.peer, offer);
+            setRemote(this, this.selected.offerer);
+            this.answered_at = performance.now();
             this.answered = await sendAnswer(this.selected.offerer, this.peer_id, answer);
             if (this.answered) {
                 clearInterval(this.poll_id);
@@ -61,13 +125,12 @@ export default {
         },
         updateOffers(streams) {
             this.streams = streams;
-            if ((this.stream != null) && (this.selected === initial_select_text)) {
+            // Answered offers are no longer listed, so follow the label to its current open offer
+            if ((this.stream != null) && !this.answered) {
                 let labels = this.streams.map(item => item.label);
                 let stream_index = labels.indexOf(this.stream);
-                if (stream_index !== -1) {
-                    this.ready = true;
-                    this.selected = this.streams[stream_index];
-                }
+                this.ready = stream_index !== -1;
+                this.selected = this.ready ? this.streams[stream_index] : initial_select_text;
             }
         }
     }
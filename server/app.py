@@ -1,12 +1,62 @@
+import os
+
 from flask import Flask
+from flask import json
 from flask import request
 
-def create_app():
-    """ Create the flask application """
-    offers_db = {}
-    ice_db = {}
+from . import metrics
+from .store import MemoryStore
+from .sqlite_store import SqliteStore
+
+# Upper bound on how long a long-poll request may be held open (seconds)
+LONG_POLL_MAX = 30.0
+# Number of distinct /offers queries whose serialized responses are cached
+OFFERS_CACHE_SIZE = 64
+
+
+def create_app(config: dict=None):
+    """ Create the flask application
 
+    Store settings come from the defaults below, overridden by FLASK_ prefixed environment variables
+    (e.g. FLASK_SESSION_TTL=30) and then by the supplied config dictionary. STORE selects where the
+    sessions are kept: "memory" for a single broker process, or "sqlite" for the database at
+    STORE_PATH shared by several broker processes.
+
+    Args:
+        config: optional configuration overrides
+    """
     app = Flask(__name__, static_url_path="", static_folder="../html", instance_relative_config=True)
+    app.config.update(
+        SESSION_TTL=60.0,
+        MAX_CANDIDATES=64,
+        EVICTION_INTERVAL=5.0,
+        STORE="memory",
+        STORE_PATH=os.path.join(app.instance_path, "broker.sqlite3"),
+    )
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+    store_settings = {
+        "session_ttl": float(app.config["SESSION_TTL"]),
+        "max_candidates": int(app.config["MAX_CANDIDATES"]),
+        "eviction_interval": float(app.config["EVICTION_INTERVAL"])
+    }
+    if app.config["STORE"] == "memory":
+        store = MemoryStore(**store_settings)
+    elif app.config["STORE"] == "sqlite":
+        os.makedirs(os.path.dirname(os.path.abspath(app.config["STORE_PATH"])), exist_ok=True)
+        store = SqliteStore(app.config["STORE_PATH"], **store_settings)
+    else:
+        raise ValueError(f"Invalid store choice: {app.config['STORE']}")
+
+    offers_cache = {}
+
+    def flag(name):
+        """ Boolean query argument: present and not '0'/'false' """
+        return request.args.get(name, "0").lower() not in ("0", "false", "")
+
+    def wait_time():
+        """ Long-poll time requested via the 'wait' query argument (seconds), bounded """
+        return min(max(request.args.get("wait", 0.0, type=float), 0.0), LONG_POLL_MAX)
 
     @app.before_request
     def log_request():
@@ -21,19 +71,54 @@ def create_app():
 
     @app.route("/offers", methods=("GET", ))
     def get_offers():
-        """ GET to see current offers """
-        return {
-            "status": "Yehaw",
-            "offers": [{
-                    "label": data["label"], "offerer": offerer, "offer": data["offer"]
-                } for offerer, data in offers_db.items()]
-        }, 200
+        """ GET to see current offers
+
+        The offers version is the response's ETag. When the client's version, supplied by the
+        'version' argument or an If-None-Match header, is current this long-polls until it changes
+        and responds 304 if it does not. Only open (unanswered) offers are listed. 'label' arguments
+        filter the offers by label and 'metadata' omits the offer SDP (see /offer/<offerer>).
+        Serialized responses are cached per version.
+        """
+        known_version = request.args.get("version", None, type=int)
+        if known_version is None:
+            known_version = next(
+                (int(etag) for etag in request.if_none_match.as_set() if etag.isdigit()), None
+            )
+        version = store.wait_offers(known_version, wait_time())
+        if version == known_version:
+            response = app.response_class(status=304)
+            response.set_etag(str(version))
+            return response
+
+        labels = request.args.getlist("label") or None
+        key = (tuple(sorted(labels)) if labels else None, flag("metadata"))
+        cached = offers_cache.get(key, None)
+        if cached is None or cached[0] != version:
+            version, offers = store.get_offers(labels, key[1])
+            if len(offers_cache) >= OFFERS_CACHE_SIZE:
+                offers_cache.clear()
+            cached = offers_cache[key] = (version, json.dumps({
+                "status": "Yehaw",
+                "version": version,
+                "offers": offers
+            }))
+        response = app.response_class(cached[1], mimetype="application/json")
+        response.set_etag(str(cached[0]))
+        response.cache_control.no_cache = True
+        return response
+
+    @app.route("/offer/<offerer>", methods=("GET", ))
+    def get_offer(offerer):
+        """ GET a single offer including its SDP """
+        offer = store.get_offer(offerer)
+        if offer is None:
+            return {"status": f"No offer from {offerer}"}, 404
+        return {"status": "Yehaw", **offer}, 200
 
     @app.route("/answer/<offerer>", methods=("GET", ))
     def get_answer(offerer):
-        """ GET to see current offers """
-        answer = offers_db.get(offerer, {}).get("answer", None)
-        answerer = offers_db.get(offerer, {}).get("answerer", None)
+        """ GET to see the answer to an offer, long-polls until an answer is available """
+        answer, answerer = store.get_answer(offerer, wait_time())
 
         if answer is None or answerer is None:
             return {"status": "No answer available"}, 200
@@ -50,15 +135,14 @@ def create_app():
         offerer = offer_package.get("offerer", None)
         offer = offer_package.get("offer", None)
         label = offer_package.get("label", None)
-        ice_db[offerer] = []
         if offerer is None or offer is None or label is None:
             return {"status": "Offer must supply 'label', 'offerer' and 'offer' data"}, 500
-        offers_db[offerer] = {"offer": offer, "label": label, "answer": None, "answerer": None}
+        store.make_offer(offerer, label, offer)
         return {"status": "Yehaw"}, 200
 
     @app.route("/make-answer", methods=("POST",))
     def make_answer():
-        """ POST to handle a client making an offer """
+        """ POST to handle a client answering an offer, taking it from the listed offers """
         answer_package = request.get_json()
         offerer = answer_package.get("offerer", None)
         answer = answer_package.get("answer", None)
@@ -66,17 +150,88 @@ def create_app():
 
         if offerer is None or answer is None or answerer is None:
             return {"status": "Answer must supply 'answerer', 'offerer', and 'answer' data"}, 500
-        offers_db[offerer].update({"answer": answer, "answerer": answerer})
+        if not store.make_answer(offerer, answerer, answer):
+            return {"status": f"No open offer from {offerer}"}, 404
+        return {"status": "Yehaw"}, 200
+
+    @app.route("/heartbeat/<client_id>", methods=("POST",))
+    def heartbeat(client_id):
+        """ POST to keep a client's offer and candidates from expiring """
+        store.heartbeat(client_id)
+        return {"status": "Yehaw"}, 200
+
+    @app.route("/withdraw/<client_id>", methods=("POST",))
+    def withdraw(client_id):
+        """ POST to remove a client's offer and candidates immediately """
+        store.withdraw(client_id)
+        return {"status": "Yehaw"}, 200
+
+    @app.route("/poll", methods=("POST",))
+    def poll():
+        """ POST to poll answers and ICE candidates for many clients in one request
+
+        Takes a list of offerer ids under 'answers' and a mapping of client id to cursor under 'ice'.
+        Returns the available answers and the candidates after each cursor, long-polling until any
+        are available. Clients without new data are omitted from the response.
+        """
+        poll_package = request.get_json()
+        answer_ids = poll_package.get("answers", [])
+        ice_cursors = poll_package.get("ice", {})
+        if not isinstance(answer_ids, list) or not isinstance(ice_cursors, dict):
+            return {"status": "Poll must supply an 'answers' list and an 'ice' dictionary"}, 500
+        try:
+            ice_cursors = {client_id: int(since) for client_id, since in ice_cursors.items()}
+        except (TypeError, ValueError):
+            return {"status": "ICE cursors must be integers"}, 500
+        answers, ice = store.poll(answer_ids, ice_cursors, wait_time())
+        return {
+            "status": "Yehaw",
+            "answers": {
+                offerer: {"answer": answer, "answerer": answerer}
+                for offerer, (answer, answerer) in answers.items()
+            },
+            "ice": {
+                client_id: {"messages": messages, "cursor": cursor}
+                for client_id, (messages, cursor) in ice.items()
+            }
+        }, 200
+
+    @app.route("/metrics", methods=("POST", "GET"))
+    def producer_metrics():
+        """ POST and GET producer metrics
+
+        POST takes a producer's latest report: its 'producer' id and 'streams' mapping each stream
+        label to its metrics. GET returns the latest reports of all producers in the Prometheus text
+        format. Producers that stop reporting are evicted like any other client.
+        """
+        if request.method == "GET":
+            return app.response_class(metrics.render(store.get_metrics()),
+                                      mimetype="text/plain; version=0.0.4")
+        report = request.get_json()
+        producer = report.get("producer", None)
+        streams = report.get("streams", None)
+        if producer is None or not isinstance(streams, dict):
+            return {"status": "Metrics must supply 'producer' and 'streams' data"}, 500
+        store.put_metrics(producer, {"streams": streams})
         return {"status": "Yehaw"}, 200
 
     @app.route("/ice/<ice_id>", methods=("POST", "GET"))
     def ice(ice_id):
-        """ POST and GET ICE coordination requests """
+        """ POST and GET ICE coordination requests
+
+        POST takes a single candidate or a list of candidates posted together. Each stored candidate
+        is tagged with a monotonically increasing sequence number. GET returns only the candidates
+        after the 'since' cursor along with the cursor to supply next time, and long-polls until
+        such candidates are available.
+        """
         if request.method == "GET":
-            return {"status": "Yehaw", "messages": ice_db.get(ice_id, [])}, 200
+            since = request.args.get("since", 0, type=int)
+            messages, cursor = store.get_ice(ice_id, since, wait_time())
+            return {"status": "Yehaw", "messages": messages, "cursor": cursor}, 200
         elif request.method == "POST":
-            candidate = request.get_json()
-            ice_db[ice_id] = ice_db.get(ice_id, [])
-            ice_db[ice_id].append(candidate)
+            candidates = request.get_json()
+            candidates = candidates if isinstance(candidates, list) else [candidates]
+            if not store.add_ice(ice_id, candidates):
+                return {"status": f"Candidate limit reached for {ice_id}"}, 429
             return {"status": "Yehaw"}, 200
     return app
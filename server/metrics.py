@@ -0,0 +1,85 @@
+""" Prometheus exposition of the metrics reported by producers
+
+Producers (the `gst` processes) POST the metrics of their streams to the broker (see
+gst/metrics.py). This file renders the latest metrics of all producers in the Prometheus text
+format, labelled by producer and stream label (and queue name for queue levels).
+
+@author lestarch
+"""
+
+# Stream metrics as (report key, metric name, type, help)
+STREAM_METRICS = (
+    ("viewers", "webrtc_stream_viewers", "gauge", "Viewers connected to the stream"),
+    ("bytes_sent", "webrtc_stream_sent_bytes_total", "counter", "Bytes sent to all viewers"),
+    ("packets_sent", "webrtc_stream_sent_packets_total", "counter", "Packets sent to all viewers"),
+    ("packets_lost", "webrtc_stream_lost_packets_total", "counter",
+     "Packets reported lost by viewers"),
+    ("frames_encoded", "webrtc_stream_encoded_frames_total", "counter", "Frames encoded"),
+    ("encoder_bitrate", "webrtc_stream_encoder_bitrate_bps", "gauge", "Encoder target bitrate"),
+    ("encoder_threads", "webrtc_stream_encoder_threads", "gauge",
+     "Encoder threads, 0 when chosen by the encoder"),
+    ("encode_time_p50", "webrtc_stream_encode_time_p50_seconds", "gauge",
+     "Median time frames spent in the encoder since the previous report"),
+    ("encode_time_p95", "webrtc_stream_encode_time_p95_seconds", "gauge",
+     "95th percentile of the time frames spent in the encoder since the previous report"),
+    ("encode_time_max", "webrtc_stream_encode_time_max_seconds", "gauge",
+     "Highest time a frame spent in the encoder since the previous report"),
+    ("rtt", "webrtc_stream_rtt_seconds", "gauge", "Highest round-trip time among viewers"),
+    ("jitter", "webrtc_stream_jitter_seconds", "gauge", "Highest jitter reported by viewers"),
+    ("latency", "webrtc_stream_pipeline_latency_seconds", "gauge", "Pipeline minimum latency"),
+    ("time_to_first_frame", "webrtc_stream_time_to_first_frame_seconds", "gauge",
+     "Highest time from a viewer connecting to its first keyframe since the previous report"),
+    ("running", "webrtc_stream_running", "gauge", "1 while the stream's pipeline is running"),
+)
+# Queue metrics as (queue report key, metric name, type, help)
+QUEUE_METRICS = (
+    ("buffers", "webrtc_queue_level_buffers", "gauge", "Buffers held in a pipeline queue"),
+    ("seconds", "webrtc_queue_level_seconds", "gauge", "Seconds of data held in a pipeline queue"),
+)
+
+
+def escape(value: str) -> str:
+    """ Escape a label value for the Prometheus text format """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def labels(**pairs) -> str:
+    """ Prometheus label set of the given label names and values """
+    return ",".join(f'{name}="{escape(value)}"' for name, value in pairs.items())
+
+
+def render(reports: dict) -> str:
+    """ Render the metrics of all producers in the Prometheus text format
+
+    Metrics a producer did not report (e.g. frames of a stream without an encoder) are omitted.
+
+    Args:
+        reports: dictionary of producer id to its report, a dictionary with a 'streams' dictionary
+                 of stream label to metrics
+
+    Returns:
+        metrics text
+    """
+    streams = [
+        (producer, label, metrics)
+        for producer, report in sorted(reports.items())
+        for label, metrics in sorted(report.get("streams", {}).items())
+    ]
+    lines = []
+    for key, name, kind, description in STREAM_METRICS:
+        lines.extend([f"# HELP {name} {description}", f"# TYPE {name} {kind}"])
+        for producer, label, metrics in streams:
+            value = metrics.get(key, None)
+            if value is not None:
+                lines.append(f"{name}{{{labels(producer=producer, label=label)}}} {float(value)}")
+    for key, name, kind, description in QUEUE_METRICS:
+        lines.extend([f"# HELP {name} {description}", f"# TYPE {name} {kind}"])
+        for producer, label, metrics in streams:
+            for queue, levels in sorted(metrics.get("queues", {}).items()):
+                value = levels.get(key, None)
+                if value is not None:
+                    lines.append(
+                        f"{name}{{{labels(producer=producer, label=label, queue=queue)}}} "
+                        f"{float(value)}"
+                    )
+    return "\n".join(lines) + "\n"
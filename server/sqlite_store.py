@@ -0,0 +1,321 @@
+""" SQLite session storage for the signaling broker
+
+Keeps the signaling sessions in a SQLite database in WAL mode such that several broker worker
+processes (e.g. gunicorn workers) on one host share the same offers, answers and candidates. Each
+thread uses its own connection. Writes run in short immediate transactions, and WAL lets readers
+proceed while a write is in progress.
+
+Waiting reads cannot be woken by other processes, so they check the connection's `data_version`,
+which changes whenever another connection commits, and only re-run their query when it has changed.
+
+@author lestarch
+"""
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+
+from .store import SessionStore
+
+# Seconds between checks for changes committed by other connections while waiting
+WAIT_POLL_INTERVAL = 0.02
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clients (
+    client_id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS offers (
+    offerer TEXT PRIMARY KEY,
+    label TEXT NOT NULL,
+    offer TEXT NOT NULL,
+    answer TEXT,
+    answerer TEXT
+);
+CREATE TABLE IF NOT EXISTS ice (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_id TEXT NOT NULL,
+    candidate TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ice_by_client ON ice (client_id, seq);
+CREATE TABLE IF NOT EXISTS metrics (
+    producer TEXT PRIMARY KEY,
+    metrics TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('offers_version', 0), ('last_eviction', 0);
+'''
+
+
+class SqliteStore(SessionStore):
+    """ SQLite store of signaling sessions shared between processes
+
+    Last-seen times are wall-clock times as they are compared across processes.
+    """
+
+    def __init__(self, path: str, session_ttl: float=60.0, max_candidates: int=64,
+                 eviction_interval: float=5.0) -> None:
+        """ Construct the store, creating the database when needed
+
+        Args:
+            path: path to the SQLite database file
+            session_ttl: seconds a client may go unseen before its session is evicted
+            max_candidates: maximum number of ICE candidates stored per client
+            eviction_interval: minimum seconds between eviction passes
+        """
+        super().__init__(session_ttl, max_candidates, eviction_interval)
+        self.path = path
+        self.local = threading.local()
+        self.next_eviction = 0.0
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Connection of the current thread, opened on first use """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self, write: bool=True):
+        """ Run a block in a transaction, immediate (write locked) by default """
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _wait_for(self, predicate, wait: float) -> bool:
+        """ Wait up to 'wait' seconds for predicate(db) to become true
+
+        The predicate is re-evaluated only when another connection has committed a change.
+        """
+        self._evict()
+        db = self._connection()
+        deadline = time.monotonic() + wait
+        version = None
+        while True:
+            data_version = db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != version:
+                version = data_version
+                if predicate(db):
+                    return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(WAIT_POLL_INTERVAL, remaining))
+
+    @staticmethod
+    def _touch(db: sqlite3.Connection, client_id: str) -> None:
+        """ Mark client as seen now (in transaction) """
+        db.execute(
+            "INSERT INTO clients (client_id, last_seen) VALUES (?, ?) "
+            "ON CONFLICT (client_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (client_id, time.time())
+        )
+
+    @staticmethod
+    def _touch_known(db: sqlite3.Connection, client_id: str) -> None:
+        """ Mark client as seen now if it is known (in transaction), ignoring unknown ids """
+        db.execute("UPDATE clients SET last_seen = ? WHERE client_id = ?", (time.time(), client_id))
+
+    @staticmethod
+    def _bump_version(db: sqlite3.Connection) -> None:
+        """ Increment the offers version (in transaction) """
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = 'offers_version'")
+
+    @staticmethod
+    def _version(db: sqlite3.Connection) -> int:
+        """ Current offers version """
+        return int(db.execute("SELECT value FROM counters WHERE name = 'offers_version'").fetchone()[0])
+
+    @staticmethod
+    def _answered(db: sqlite3.Connection, offerers: list) -> dict:
+        """ Offerer to (answer, answerer) for those of the offerers with an answer """
+        rows = db.execute(
+            f"SELECT offerer, answer, answerer FROM offers WHERE answerer IS NOT NULL "
+            f"AND offerer IN ({','.join('?' * len(offerers))})", offerers
+        ).fetchall()
+        return {offerer: (json.loads(answer), answerer) for offerer, answer, answerer in rows}
+
+    @staticmethod
+    def _cursors(db: sqlite3.Connection, client_ids: list) -> dict:
+        """ Client id to the sequence number of its latest ICE candidate, for clients with any """
+        return dict(db.execute(
+            f"SELECT client_id, MAX(seq) FROM ice WHERE client_id IN "
+            f"({','.join('?' * len(client_ids))}) GROUP BY client_id", client_ids
+        ).fetchall())
+
+    @staticmethod
+    def _ice_since(db: sqlite3.Connection, client_id: str, since: int):
+        """ ICE candidates of a client after the 'since' cursor and the next cursor """
+        rows = db.execute(
+            "SELECT seq, candidate FROM ice WHERE client_id = ? AND seq > ? ORDER BY seq",
+            (client_id, since)
+        ).fetchall()
+        return [json.loads(candidate) for _, candidate in rows], rows[-1][0] if rows else since
+
+    def _evict(self) -> None:
+        """ Evict clients not seen within the session TTL, rate limited across processes """
+        if time.monotonic() < self.next_eviction:
+            return
+        self.next_eviction = time.monotonic() + self.eviction_interval
+        now = time.time()
+        with self._transaction() as db:
+            last_eviction = db.execute(
+                "SELECT value FROM counters WHERE name = 'last_eviction'"
+            ).fetchone()[0]
+            if now - last_eviction < self.eviction_interval:
+                return
+            db.execute("UPDATE counters SET value = ? WHERE name = 'last_eviction'", (now, ))
+            expired = "SELECT client_id FROM clients WHERE last_seen < ?"
+            cutoff = (now - self.session_ttl, )
+            db.execute(f"DELETE FROM ice WHERE client_id IN ({expired})", cutoff)
+            db.execute(f"DELETE FROM metrics WHERE producer IN ({expired})", cutoff)
+            if db.execute(f"DELETE FROM offers WHERE offerer IN ({expired})", cutoff).rowcount:
+                self._bump_version(db)
+            db.execute("DELETE FROM clients WHERE last_seen < ?", cutoff)
+
+    def heartbeat(self, client_id: str) -> None:
+        """ Record that a client is still alive """
+        with self._transaction() as db:
+            self._touch(db, client_id)
+        self._evict()
+
+    def withdraw(self, client_id: str) -> bool:
+        """ Remove a client's offer and candidates immediately """
+        with self._transaction() as db:
+            db.execute("DELETE FROM clients WHERE client_id = ?", (client_id, ))
+            db.execute("DELETE FROM ice WHERE client_id = ?", (client_id, ))
+            db.execute("DELETE FROM metrics WHERE producer = ?", (client_id, ))
+            removed = db.execute("DELETE FROM offers WHERE offerer = ?", (client_id, )).rowcount > 0
+            if removed:
+                self._bump_version(db)
+        return removed
+
+    def make_offer(self, offerer: str, label: str, offer: dict) -> None:
+        """ Store an offer, replacing any previous offer and candidates from the offerer """
+        with self._transaction() as db:
+            self._touch(db, offerer)
+            db.execute("DELETE FROM ice WHERE client_id = ?", (offerer, ))
+            db.execute(
+                "INSERT OR REPLACE INTO offers (offerer, label, offer, answer, answerer) "
+                "VALUES (?, ?, ?, NULL, NULL)", (offerer, label, json.dumps(offer))
+            )
+            self._bump_version(db)
+        self._evict()
+
+    def make_answer(self, offerer: str, answerer: str, answer: dict) -> bool:
+        """ Store an answer to an offer """
+        with self._transaction() as db:
+            self._touch(db, answerer)
+            if db.execute(
+                "UPDATE offers SET answer = ?, answerer = ? "
+                "WHERE offerer = ? AND (answerer IS NULL OR answerer = ?)",
+                (json.dumps(answer), answerer, offerer, answerer)
+            ).rowcount == 0:
+                return False
+            self._bump_version(db)
+            return True
+
+    def add_ice(self, client_id: str, candidates: list) -> bool:
+        """ Store ICE candidates posted by a client, each tagged with the next sequence number """
+        with self._transaction() as db:
+            self._touch(db, client_id)
+            count = db.execute(
+                "SELECT COUNT(*) FROM ice WHERE client_id = ?", (client_id, )
+            ).fetchone()[0]
+            accepted = candidates[:max(self.max_candidates - count, 0)]
+            db.executemany("INSERT INTO ice (client_id, candidate) VALUES (?, ?)",
+                           [(client_id, json.dumps(candidate)) for candidate in accepted])
+            return len(accepted) == len(candidates)
+
+    def wait_offers(self, known_version: int=None, wait: float=0) -> int:
+        """ Wait until the offers version differs from known_version """
+        self._wait_for(lambda db: self._version(db) != known_version, wait)
+        return self._version(self._connection())
+
+    def get_offers(self, labels: list=None, metadata_only: bool=False):
+        """ Get the current open (unanswered) offers """
+        self._evict()
+        columns = "label, offerer" if metadata_only else "label, offerer, offer"
+        query = f"SELECT {columns} FROM offers WHERE answerer IS NULL"
+        if labels is not None:
+            query += f" AND label IN ({','.join('?' * len(labels))})"
+        with self._transaction(write=False) as db:
+            rows = db.execute(query, labels or []).fetchall()
+            version = self._version(db)
+        offers = [{"label": row[0], "offerer": row[1]} for row in rows]
+        if not metadata_only:
+            for offer, row in zip(offers, rows):
+                offer["offer"] = json.loads(row[2])
+        return version, offers
+
+    def get_offer(self, offerer: str):
+        """ Get a single offer """
+        row = self._connection().execute(
+            "SELECT label, offer FROM offers WHERE offerer = ?", (offerer, )
+        ).fetchone()
+        if row is None:
+            return None
+        return {"label": row[0], "offerer": offerer, "offer": json.loads(row[1])}
+
+    def get_answer(self, offerer: str, wait: float=0):
+        """ Get the answer to an offer, waiting until one is available """
+        with self._transaction() as db:
+            self._touch_known(db, offerer)
+        self._wait_for(lambda db: self._answered(db, [offerer]), wait)
+        return self._answered(self._connection(), [offerer]).get(offerer, (None, None))
+
+    def get_ice(self, client_id: str, since: int=0, wait: float=0):
+        """ Get the ICE candidates of a client posted after the 'since' cursor """
+        self._wait_for(lambda db: self._cursors(db, [client_id]).get(client_id, 0) > since, wait)
+        return self._ice_since(self._connection(), client_id, since)
+
+    def put_metrics(self, producer: str, metrics: dict) -> None:
+        """ Store the latest metrics reported by a producer, replacing its previous ones """
+        with self._transaction() as db:
+            self._touch(db, producer)
+            db.execute("INSERT OR REPLACE INTO metrics (producer, metrics) VALUES (?, ?)",
+                       (producer, json.dumps(metrics)))
+        self._evict()
+
+    def get_metrics(self) -> dict:
+        """ Get the latest metrics of all producers """
+        self._evict()
+        rows = self._connection().execute("SELECT producer, metrics FROM metrics").fetchall()
+        return {producer: json.loads(metrics) for producer, metrics in rows}
+
+    def poll(self, answer_ids: list, ice_cursors: dict, wait: float=0):
+        """ Get answers and ICE candidates for many clients at once """
+        if answer_ids:
+            with self._transaction() as db:
+                for offerer in answer_ids:
+                    self._touch_known(db, offerer)
+        client_ids = list(ice_cursors.keys())
+
+        def ready(db):
+            """ Any offer answered or any client with candidates after its cursor """
+            return bool(self._answered(db, answer_ids)) or any(
+                cursor > ice_cursors[client_id]
+                for client_id, cursor in self._cursors(db, client_ids).items()
+            )
+        self._wait_for(ready, wait)
+        with self._transaction(write=False) as db:
+            answers = self._answered(db, answer_ids)
+            ice = {
+                client_id: self._ice_since(db, client_id, ice_cursors[client_id])
+                for client_id, cursor in self._cursors(db, client_ids).items()
+                if cursor > ice_cursors[client_id]
+            }
+        return answers, ice
@@ -0,0 +1,351 @@
+""" Session storage for the signaling broker
+
+Holds the offers, answers and ICE candidates passed between WebRTC clients. Clients are tracked by a
+last-seen time updated whenever they post or heartbeat, and clients not seen within the session
+time-to-live are evicted along with their offer and candidates. Eviction is lazy: it runs as part
+of regular store access at most once per eviction interval.
+
+Reads may long-poll: they block until there is something new to return or the requested wait time
+expires.
+
+Two stores are available: `MemoryStore` keeping sessions in the broker process, and `SqliteStore`
+(see sqlite_store.py) keeping sessions in a SQLite database shared by several broker processes.
+
+@author lestarch
+"""
+import bisect
+import threading
+import time
+
+
+class SessionStore(object):
+    """ Interface of the stores of signaling sessions
+
+    Stores must be thread-safe as the broker serves requests, and holds long-polls, on many threads.
+    """
+
+    def __init__(self, session_ttl: float=60.0, max_candidates: int=64,
+                 eviction_interval: float=5.0) -> None:
+        """ Construct the store
+
+        Args:
+            session_ttl: seconds a client may go unseen before its session is evicted
+            max_candidates: maximum number of ICE candidates stored per client
+            eviction_interval: minimum seconds between eviction passes
+        """
+        self.session_ttl = session_ttl
+        self.max_candidates = max_candidates
+        self.eviction_interval = eviction_interval
+
+    def heartbeat(self, client_id: str) -> None:
+        """ Record that a client is still alive """
+        raise NotImplementedError()
+
+    def withdraw(self, client_id: str) -> bool:
+        """ Remove a client's offer and candidates immediately
+
+        Returns:
+            True if the client had an offer, False otherwise
+        """
+        raise NotImplementedError()
+
+    def make_offer(self, offerer: str, label: str, offer: dict) -> None:
+        """ Store an offer, replacing any previous offer and candidates from the offerer """
+        raise NotImplementedError()
+
+    def make_answer(self, offerer: str, answerer: str, answer: dict) -> bool:
+        """ Store an answer to an offer
+
+        An answered offer is taken: it is no longer listed and only its answerer may answer again.
+
+        Returns:
+            True if the offer exists and is open to the answerer, False otherwise
+        """
+        raise NotImplementedError()
+
+    def add_ice(self, client_id: str, candidates: list) -> bool:
+        """ Store ICE candidates posted by a client, each tagged with the next sequence number
+
+        Candidates beyond the client's candidate limit are dropped.
+
+        Returns:
+            True if all were stored, False if the client has reached the candidate limit
+        """
+        raise NotImplementedError()
+
+    def wait_offers(self, known_version: int=None, wait: float=0) -> int:
+        """ Wait until the offers version differs from known_version
+
+        Returns:
+            current offers version
+        """
+        raise NotImplementedError()
+
+    def get_offers(self, labels: list=None, metadata_only: bool=False):
+        """ Get the current open (unanswered) offers
+
+        Args:
+            labels: only return offers with one of these labels, None for all offers
+            metadata_only: omit the offer SDP, returning only label and offerer
+
+        Returns:
+            tuple of offers version and a list of offer dictionaries
+        """
+        raise NotImplementedError()
+
+    def get_offer(self, offerer: str):
+        """ Get a single offer
+
+        Returns:
+            offer dictionary or None when the offerer has no offer
+        """
+        raise NotImplementedError()
+
+    def get_answer(self, offerer: str, wait: float=0):
+        """ Get the answer to an offer, waiting until one is available
+
+        Polling for an answer counts as a heartbeat from the offerer, once it is known to the
+        store. Polling for unknown ids does not create client records.
+
+        Returns:
+            tuple of answer and answerer, both None when no answer is available
+        """
+        raise NotImplementedError()
+
+    def get_ice(self, client_id: str, since: int=0, wait: float=0):
+        """ Get the ICE candidates of a client posted after the 'since' cursor
+
+        Waits until such candidates are available.
+
+        Returns:
+            tuple of list of candidates and the cursor to supply next time
+        """
+        raise NotImplementedError()
+
+    def put_metrics(self, producer: str, metrics: dict) -> None:
+        """ Store the latest metrics reported by a producer, replacing its previous ones
+
+        Reporting counts as a heartbeat from the producer, and its metrics are evicted with it.
+        """
+        raise NotImplementedError()
+
+    def get_metrics(self) -> dict:
+        """ Get the latest metrics of all producers
+
+        Returns:
+            dictionary of producer id to its metrics
+        """
+        raise NotImplementedError()
+
+    def poll(self, answer_ids: list, ice_cursors: dict, wait: float=0):
+        """ Get answers and ICE candidates for many clients at once
+
+        Waits until any of the offers is answered or any of the clients has candidates after its
+        cursor. Polling for answers counts as a heartbeat from each offerer known to the store.
+
+        Args:
+            answer_ids: offerer ids whose answers are wanted
+            ice_cursors: dictionary of client id to 'since' cursor for wanted ICE candidates
+            wait: seconds to wait for any data to be available
+
+        Returns:
+            tuple of dictionaries: offerer to (answer, answerer) for answered offers, and client id
+            to (candidates, cursor) for clients with new candidates
+        """
+        raise NotImplementedError()
+
+
+class MemoryStore(SessionStore):
+    """ In-memory store of signaling sessions
+
+    Sessions live in the broker process and so are only visible to a single worker process. Waiting
+    reads block on a condition variable notified by every change.
+    """
+
+    def __init__(self, session_ttl: float=60.0, max_candidates: int=64,
+                 eviction_interval: float=5.0) -> None:
+        """ Construct the store, see SessionStore """
+        super().__init__(session_ttl, max_candidates, eviction_interval)
+        self.offers = {}
+        self.ice = {}
+        self.last_seen = {}
+        self.metrics = {}
+        self.offers_version = 0
+        self.ice_sequence = 0
+        self.last_eviction = time.monotonic()
+        self.changed = threading.Condition()
+
+    def _touch(self, client_id: str) -> None:
+        """ Mark client as seen now (lock held) """
+        self.last_seen[client_id] = time.monotonic()
+
+    def _touch_known(self, client_id: str) -> None:
+        """ Mark client as seen now if it is known (lock held), ignoring unknown ids """
+        if client_id in self.last_seen:
+            self._touch(client_id)
+
+    def _remove(self, client_id: str) -> bool:
+        """ Remove all data of a client (lock held), returns True if an offer was removed """
+        self.last_seen.pop(client_id, None)
+        self.ice.pop(client_id, None)
+        self.metrics.pop(client_id, None)
+        if self.offers.pop(client_id, None) is not None:
+            self.offers_version += 1
+            return True
+        return False
+
+    def _evict(self) -> None:
+        """ Evict clients not seen within the session TTL (lock held), rate limited """
+        now = time.monotonic()
+        if now - self.last_eviction < self.eviction_interval:
+            return
+        self.last_eviction = now
+        expired = [
+            client_id for client_id, seen in self.last_seen.items()
+            if now - seen > self.session_ttl
+        ]
+        for client_id in expired:
+            self._remove(client_id)
+        if expired:
+            self.changed.notify_all()
+
+    def _wait_for(self, predicate, wait: float) -> bool:
+        """ Wait up to 'wait' seconds for predicate to become true (lock held) """
+        self._evict()
+        return self.changed.wait_for(predicate, timeout=wait)
+
+    def _answer(self, offerer: str):
+        """ Answer and answerer to an offer (lock held), both None when unanswered """
+        data = self.offers.get(offerer, {})
+        return data.get("answer", None), data.get("answerer", None)
+
+    def _cursor(self, client_id: str) -> int:
+        """ Sequence number of the latest ICE candidate of a client (lock held), 0 when none """
+        return (self.ice.get(client_id) or [(0, None)])[-1][0]
+
+    def _ice_since(self, client_id: str, since: int):
+        """ ICE candidates of a client after the 'since' cursor and the next cursor (lock held) """
+        entries = self.ice.get(client_id, [])
+        delta = entries[bisect.bisect_left(entries, (since + 1, )):]
+        return [candidate for _, candidate in delta], delta[-1][0] if delta else since
+
+    def heartbeat(self, client_id: str) -> None:
+        """ Record that a client is still alive """
+        with self.changed:
+            self._touch(client_id)
+            self._evict()
+
+    def withdraw(self, client_id: str) -> bool:
+        """ Remove a client's offer and candidates immediately """
+        with self.changed:
+            removed = self._remove(client_id)
+            self.changed.notify_all()
+            return removed
+
+    def make_offer(self, offerer: str, label: str, offer: dict) -> None:
+        """ Store an offer, replacing any previous offer and candidates from the offerer """
+        with self.changed:
+            self._touch(offerer)
+            self.ice[offerer] = []
+            self.offers[offerer] = {"offer": offer, "label": label, "answer": None, "answerer": None}
+            self.offers_version += 1
+            self._evict()
+            self.changed.notify_all()
+
+    def make_answer(self, offerer: str, answerer: str, answer: dict) -> bool:
+        """ Store an answer to an offer """
+        with self.changed:
+            self._touch(answerer)
+            if self._answer(offerer)[1] not in (None, answerer) or offerer not in self.offers:
+                return False
+            self.offers[offerer].update({"answer": answer, "answerer": answerer})
+            self.offers_version += 1
+            self.changed.notify_all()
+            return True
+
+    def add_ice(self, client_id: str, candidates: list) -> bool:
+        """ Store ICE candidates posted by a client, each tagged with the next sequence number """
+        with self.changed:
+            self._touch(client_id)
+            entries = self.ice.setdefault(client_id, [])
+            accepted = candidates[:max(self.max_candidates - len(entries), 0)]
+            for candidate in accepted:
+                self.ice_sequence += 1
+                entries.append((self.ice_sequence, candidate))
+            if accepted:
+                self.changed.notify_all()
+            return len(accepted) == len(candidates)
+
+    def wait_offers(self, known_version: int=None, wait: float=0) -> int:
+        """ Wait until the offers version differs from known_version """
+        with self.changed:
+            self._wait_for(lambda: self.offers_version != known_version, wait)
+            return self.offers_version
+
+    def get_offers(self, labels: list=None, metadata_only: bool=False):
+        """ Get the current open (unanswered) offers """
+        with self.changed:
+            self._evict()
+            offers = [
+                {"label": data["label"], "offerer": offerer, "offer": data["offer"]}
+                for offerer, data in self.offers.items()
+                if data["answerer"] is None and (labels is None or data["label"] in labels)
+            ]
+            if metadata_only:
+                for offer in offers:
+                    del offer["offer"]
+            return self.offers_version, offers
+
+    def get_offer(self, offerer: str):
+        """ Get a single offer """
+        with self.changed:
+            data = self.offers.get(offerer, None)
+            if data is None:
+                return None
+            return {"label": data["label"], "offerer": offerer, "offer": data["offer"]}
+
+    def get_answer(self, offerer: str, wait: float=0):
+        """ Get the answer to an offer, waiting until one is available """
+        with self.changed:
+            self._touch_known(offerer)
+            self._wait_for(lambda: self._answer(offerer)[1] is not None, wait)
+            return self._answer(offerer)
+
+    def get_ice(self, client_id: str, since: int=0, wait: float=0):
+        """ Get the ICE candidates of a client posted after the 'since' cursor """
+        with self.changed:
+            self._wait_for(lambda: self._cursor(client_id) > since, wait)
+            return self._ice_since(client_id, since)
+
+    def put_metrics(self, producer: str, metrics: dict) -> None:
+        """ Store the latest metrics reported by a producer, replacing its previous ones """
+        with self.changed:
+            self._touch(producer)
+            self.metrics[producer] = metrics
+            self._evict()
+
+    def get_metrics(self) -> dict:
+        """ Get the latest metrics of all producers """
+        with self.changed:
+            self._evict()
+            return dict(self.metrics)
+
+    def poll(self, answer_ids: list, ice_cursors: dict, wait: float=0):
+        """ Get answers and ICE candidates for many clients at once """
+        with self.changed:
+            for offerer in answer_ids:
+                self._touch_known(offerer)
+            self._wait_for(lambda: (
+                any(self._answer(offerer)[1] is not None for offerer in answer_ids) or
+                any(self._cursor(client_id) > since for client_id, since in ice_cursors.items())
+            ), wait)
+            answers = {
+                offerer: self._answer(offerer) for offerer in answer_ids
+                if self._answer(offerer)[1] is not None
+            }
+            ice = {
+                client_id: self._ice_since(client_id, since)
+                for client_id, since in ice_cursors.items()
+                if self._cursor(client_id) > since
+            }
+            return answers, ice